@@ -1,42 +1,21 @@
 from __future__ import annotations
 import math
-from typing import List, TYPE_CHECKING
-from collections import deque
+from typing import TYPE_CHECKING
 from mesa.discrete_space import CellAgent, Cell
 import numpy as np
 from utils.terrains import Terrain
 if TYPE_CHECKING:
     from model import ParkModel
 
-import functools
-import time
-import logging
-
-from typing import TYPE_CHECKING
-
-if TYPE_CHECKING:
-    from model import ParkModel
-
-_logger = logging.getLogger("AgentTiming")
-
-
-def log_time(func):
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        start = time.perf_counter()
-        result = func(*args, **kwargs)
-        end = time.perf_counter()
-
-        _logger.info(f"{func.__name__} took {end - start:.6f}s")
-        return result
-
-    return wrapper
-
 class ParkAgent(CellAgent):
+    # Agent and CellAgent keep their own attributes in __dict__, the state of the park agent lives in the slots
+    __slots__ = ("origin", "target", "angle", "distance", "subtarget", "tile_weight", "distance_weight", "previous_cell",
+                 "visited", "vision_range", "obstacle_percentage", "slot")
 
     def __init__(self, model: ParkModel, cell:Cell, target: Cell, angle: int = 120, distance: int = 12, tile_weight: float = 3, distance_weight: float = 0.3):
         super().__init__(model)
         self.cell = cell
+        self.origin = cell
         self.target = target
         self.angle = angle
         self.distance = distance
@@ -46,11 +25,20 @@ class ParkAgent(CellAgent):
         # else it will not reach the destination in some scenarios
         # cuz it will wiggle around the destination
         self.previous_cell: Cell | None = None
-        self.previous_cells: List[Cell] = []
-        self.last_10_cells = deque(maxlen=10)
-        self.steps_count = 0
-        self.vision_range = []
+        # flat indices (x * height + y) of the cells the agent entered, so the size is bounded by the grid
+        self.visited: set[int] = set()
+        # cells seen in the last scan with their affordances, kept only for the visualisation (ParkModel.show_vision)
+        self.vision_range: list[tuple[Cell, float]] = []
         self.obstacle_percentage = 0.2
+        # position, target, steps count and the last visited cells live in the occupancy index of the model
+        self.slot = model.occupancy.add(self)
+
+    def visit(self, cell: Cell) -> None:
+        x, y = cell.coordinate
+        self.visited.add(x * self.model.grid.height + y)
+
+    def has_visited(self, x: int, y: int) -> bool:
+        return x * self.model.grid.height + y in self.visited
 
 
 
@@ -64,101 +52,28 @@ class ParkAgent(CellAgent):
 
         """Find which point in the vision arc is best for next destination of the agent"""
         if self.subtarget is None:
-            candidates = self.select_subtarget()
-            self.vision_range = candidates
-            best_cell = None
-            best_aff = float('-inf')
-            for candidate, candidate_aff in candidates:
-                self.model.grid.VISION.data[candidate.coordinate] = 1
-                if candidate_aff > best_aff:
-                    best_aff = candidate_aff
-                    best_cell = candidate
-            self.subtarget = best_cell
+            with self.model.profiler.section("vision"):
+                self.subtarget = self.select_subtarget()
 
         if self.subtarget:
             self.model.grid.SUBTARGETS.data[self.subtarget.coordinate] += 1
 
-        self.cell = self.model.metric.get_cells_rank(self)[0][0]
-        self.previous_cells.append(self.cell)
-
-    """ Function that returns the visible tiles by the agent"""
-    def select_subtarget(self) -> list[tuple[Cell, float]]:
-
-        def get_cell_vec(cell1: Cell, cell2: Cell) -> np.array:
-            return np.array(cell1.coordinate) - np.array(cell2.coordinate)
-
-        def cell_in_radius(vec: np.array) -> bool:
-            return (np.power(vec, 2)).sum() <= np.power(self.distance, 2)
-
-        def cell_in_angle(vec: np.array) -> bool:
-            return np.dot(vec, target_vector)/(np.linalg.norm(vec) * np.linalg.norm(target_vector)) >= np.cos(np.deg2rad(self.angle/2))
-
-        """Recursively starts finding candidates starting from closest points"""
-        def rec_find_cells(parent_cell: Cell, main_vec: np.array) -> None:
-            parent_vec = get_cell_vec(parent_cell, self.cell)
-
-            """If cell in in the radius and cosine of the destination vector and candidate vector is bigger than vision angle
-             and the cell is not obstacle, then cell is in the vision arc of the agent """
-            if cell_in_radius(parent_vec) and cell_in_angle(parent_vec) and parent_cell.OBSTACLE == 0:
-
-
-
-                cells.append((parent_cell, self.return_cell_affordance(parent_cell)))
-                visited.add(parent_cell)
-
-                for cell_child in parent_cell.neighborhood:
-                    if cell_child not in visited:
-                        rec_find_cells(cell_child, main_vec)
-            else:
-                return
-
-
-        target_vector = get_cell_vec(self.target, self.cell)
-        cells = []
-
-        visited = set()
-        for cell in self.cell.neighborhood:
-            rec_find_cells(cell, target_vector)
-
-
-        # grid_w, grid_h = self.model.grid.width, self.model.grid.height
-        # x, y = self.cell.coordinate
-        # x_min, x_max = max(0, x - self.distance), min(grid_w, x + self.distance + 1)
-        # y_min, y_max = max(0, y - self.distance), min(grid_h, y + self.distance + 1)
-        #
-        # x_grid, y_grid = np.meshgrid(np.arange(x_min, x_max), np.arange(y_min, y_max), indexing='ij')
-        # vec_x = x_grid - x
-        # vec_y = y_grid - y
-        # norms = np.sqrt(vec_x ** 2 + vec_y ** 2)
-        # target_norm = np.linalg.norm(target_vector)
-        #
-        # with np.errstate(divide='ignore', invalid='ignore'):
-        #     dot_products = (vec_x * target_vector[0]) + (vec_y * target_vector[1])
-        #     cosines = dot_products / (norms * target_norm)
-        #
-        # min_cos = np.cos(np.deg2rad(self.angle / 2))
-        # angle_mask = cosines >= min_cos
-        #
-        # dist_mask = (norms <= self.distance) & (norms > 0)
-        #
-        # combined_masks = angle_mask & dist_mask
-        #
-        # valid_cells_coords = np.argwhere(combined_masks)
-        #
-        # for local_x, local_y in valid_cells_coords:
-        #     gx = x_min + local_x
-        #     gy = y_min + local_y
-        #
-        #     grid_cells = self.model.grid.all_cells.cells
-        #
-        #     if (gx, gy) in grid_cells:
-        #         cell_candidate = grid_cells[(gx, gy)]
-        #
-        #         if cell_candidate.OBSTACLE == 0:
-        #             affordance = self.return_cell_affordance(cell_candidate)
-        #             cells.append((cell_candidate, affordance))
-
-        return cells
+        with self.model.profiler.section("metric_ranking"):
+            self.cell = self.model.metric.get_cells_rank(self)[0][0]
+        self.model.occupancy.move(self)
+        self.model.occupancy.record_step(self)
+        self.visit(self.cell)
+
+    """ Function that marks the tiles visible by the agent and returns the best of them (see utils.vision.VisionEngine)"""
+    def select_subtarget(self) -> Cell | None:
+        coords, affordances, best = self.model.vision.scan(self)
+        if self.model.show_vision:
+            self.model.grid.VISION.data[coords[:, 0], coords[:, 1]] = 1
+            self.vision_range = [(self.model.grid[(x, y)], aff) for (x, y), aff in zip(coords.tolist(), affordances.tolist())]
+
+        if best is None:
+            return None
+        return self.model.grid[tuple(coords[best].tolist())]
 
 
 
@@ -178,14 +93,14 @@ class ParkAgent(CellAgent):
 
         tile_val = self.tile_weight * ParkAgent.get_tile_value(cell)
 
-        distance_diff = ParkAgent.calc_dest_dist(cell, self.cell) + ParkAgent.calc_dest_dist(self.target,
-                                                                                             cell) - self.curr_distance()
+        distance_diff = ParkAgent.calc_dest_dist(cell, self.cell) + self.model.distance_to(self.target, *cell.coordinate) \
+                        - self.curr_distance()
         distance_val = distance_diff * self.distance_weight
 
         return max(tile_val - distance_val, 0)
 
     def curr_distance(self):
-        return ParkAgent.calc_dest_dist(self.target, self.cell)
+        return self.model.distance_to(self.target, *self.cell.coordinate)
 
 
     @staticmethod
@@ -208,7 +123,7 @@ class ParkAgent(CellAgent):
 
         """Calculating distance to the target for each cell in neighbourhood"""
         for cell in possible_cells:
-            distance = ParkAgent.calc_dest_dist(cell, self.target)
+            distance = self.model.distance_to(self.target, *cell.coordinate)
             best_cells_distance.append((cell, distance))
 
         best_cells_distance = sorted(best_cells_distance,
@@ -222,7 +137,7 @@ class ParkAgent(CellAgent):
         else:
             found_cell = False
             for cell in best_cells_distance:
-                if cell[0] in self.previous_cells: pass
+                if self.has_visited(*cell[0].coordinate): pass
                 if cell[0].GRASS == Terrain.GRASS.value:
                     """Probability of entering a grass cell"""
                     possibility = self.random.randint(Terrain.GRASS.value, 100) <= cell[0].GRASS_POPULARITY
@@ -232,7 +147,7 @@ class ParkAgent(CellAgent):
                         break
                 elif cell[0].SIDEWALK == Terrain.SIDEWALK.value:
                     """Promoting sidewalks if they are better than the previous cell"""
-                    if self.previous_cell and cell[1] < ParkAgent.calc_dest_dist(self.previous_cell, self.target):
+                    if self.previous_cell and cell[1] < self.model.distance_to(self.target, *self.previous_cell.coordinate):
                         self._update_cell_parameters(cell[0])
                         found_cell = True
                         break
@@ -241,5 +156,7 @@ class ParkAgent(CellAgent):
 
     def _update_cell_parameters(self, new_cell: Cell) -> None:
         self.previous_cell = self.cell
-        self.previous_cells.append(self.cell)
+        self.visit(self.cell)
         self.cell = new_cell
+        self.model.occupancy.move(self)
+        self.model.occupancy.record_step(self)
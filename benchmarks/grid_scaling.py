@@ -0,0 +1,50 @@
+"""
+Benchmark of how the model setup and step time scale with the grid size
+run from the repository root: python -m benchmarks.grid_scaling --sizes 100 250 500
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import time
+
+from model import ParkModel
+from utils.step_metrics import AffordanceMetric
+
+
+def measure(size: int, park: str, steps: int, seed: int) -> dict:
+    start = time.perf_counter()
+    model = ParkModel(AffordanceMetric(), width=size, height=size, park_name=park, seed=seed,
+                      agent_params={"distance": 10, "angle": 90, "tile_weight": 0.9, "distance_weight": 0.3})
+    model.setup()
+    setup_time = time.perf_counter() - start
+
+    step_times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(steps):
+            start = time.perf_counter()
+            model.step()
+            step_times.append(time.perf_counter() - start)
+
+    return {
+        "size": size,
+        "cells": size * size,
+        "park": park,
+        "steps": steps,
+        "setup_s": setup_time,
+        "mean_step_ms": 1000 * sum(step_times) / len(step_times),
+        "max_step_ms": 1000 * max(step_times),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 250, 500])
+    parser.add_argument("--park", default="hyde")
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    results = [measure(size, args.park, args.steps, args.seed) for size in args.sizes]
+    print(json.dumps(results, indent=2))
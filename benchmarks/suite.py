@@ -0,0 +1,181 @@
+"""
+Benchmark suite of the model - TestEnvironment.create, ParkModel.setup, ParkModel.step of every metric on every park,
+the accuracy and the GridSearch.run_models throughput for several worker counts. The results are written as JSON
+and --compare lists the benchmarks which got slower than in a previous result file (exit code 1 if there are any).
+run from the repository root: python -m benchmarks.suite --output bench.json --compare baseline.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from importlib import metadata
+
+from environment import TestEnvironment
+from model import ParkModel
+from utils.GridSearch import GridSearch
+
+METRICS = ("normal", "affordance", "balanced", "mixed")
+AGENT_PARAMS = {"distance": 10, "angle": 90, "tile_weight": 0.9, "distance_weight": 0.3}
+
+
+def measure(func, repeat: int, prepare=None) -> dict:
+    """Times func(prepare()) repeat times, prepare is not timed. The first run pays for the cold caches,
+    so it is reported on its own as well"""
+    times = []
+    for _ in range(repeat):
+        argument = prepare() if prepare is not None else None
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func(argument)
+        times.append(time.perf_counter() - start)
+    return {"first_s": times[0], "min_s": min(times), "median_s": statistics.median(times),
+            "mean_s": statistics.fmean(times), "repeat": repeat}
+
+
+def _model(park: str, metric: str, size: int, steps: int = 0) -> ParkModel:
+    model = ParkModel(GridSearch._create_metric(metric), width=size, height=size, park_name=park, seed=42,
+                      agent_params=AGENT_PARAMS)
+    model.setup()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(steps):
+            model.step()
+    return model
+
+
+def environment_create(park: str, size: int, repeat: int) -> dict:
+    return measure(lambda _: TestEnvironment(size, size, park_name=park).create(), repeat)
+
+
+def model_setup(park: str, size: int, repeat: int) -> dict:
+    return measure(lambda model: model.setup(), repeat,
+                   prepare=lambda: ParkModel(GridSearch._create_metric("normal"), width=size, height=size,
+                                             park_name=park, seed=42, agent_params=AGENT_PARAMS))
+
+
+def model_step(park: str, metric: str, size: int, steps: int, repeat: int) -> dict:
+    """Time of steps steps of a set up model, per_step_ms is the median divided by steps"""
+    def run(model: ParkModel) -> None:
+        for _ in range(steps):
+            model.step()
+
+    result = measure(run, repeat, prepare=lambda: _model(park, metric, size))
+    result["per_step_ms"] = 1000 * result["median_s"] / steps
+    return result
+
+
+def accuracy(park: str, size: int, steps: int, repeat: int, method: str = "calculate_accuracy") -> dict:
+    """Time of the accuracy method of a model after steps steps"""
+    model = _model(park, "affordance", size, steps)
+    return measure(lambda _: getattr(model, method)(), repeat)
+
+
+def grid_search(park: str, workers: int, samples: int, steps: int, batch_size: int) -> dict:
+    """One run_models of samples models in a temporary directory, runs_per_s is the throughput. The plan of the
+    models is drawn with a fixed seed, so every run of the suite measures the same models"""
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as directory:
+        search = GridSearch(directory=directory, parks=park, seeds=list(range(samples)), metric=list(METRICS),
+                            samples=samples, n_workers=workers, stop_step=steps, batch_size=batch_size,
+                            **{name: [value] for name, value in AGENT_PARAMS.items()})
+        result = measure(lambda _: search.run_models(resume=False), 1)
+    result["runs_per_s"] = samples / result["median_s"]
+    return result
+
+
+def environment() -> dict:
+    """Machine and versions the results were measured with"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    versions = {}
+    for package in ("mesa", "numpy", "scipy", "numba"):
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return {"commit": commit, "python": platform.python_version(), "platform": platform.platform(),
+            "cpu_count": os.cpu_count(), "versions": versions, "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def run_suite(args: argparse.Namespace) -> dict:
+    benchmarks = {}
+
+    def record(name: str, benchmark, *params) -> None:
+        if args.only and not any(pattern in name for pattern in args.only):
+            return
+        print(f"running {name}", file=sys.stderr)
+        benchmarks[name] = benchmark(*params)
+
+    for park in args.parks:
+        record(f"environment_create/{park}", environment_create, park, args.size, args.repeat)
+        record(f"model_setup/{park}", model_setup, park, args.size, args.repeat)
+        for metric in args.metrics:
+            record(f"model_step/{park}/{metric}", model_step, park, metric, args.size, args.steps, args.repeat)
+        for method in ("calculate_accuracy", "accuracy"):
+            record(f"{method}/{park}", accuracy, park, args.size, args.steps, args.repeat, method)
+    for workers in args.workers:
+        record(f"grid_search/{args.parks[0]}/workers_{workers}", grid_search, args.parks[0], workers, args.samples,
+               args.steps, args.batch_size)
+
+    return {"environment": environment(), "config": vars(args), "benchmarks": benchmarks}
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> list[dict]:
+    """Benchmarks whose median time is more than tolerance (a fraction) over the baseline"""
+    regressions = []
+    for name, result in current["benchmarks"].items():
+        before = baseline["benchmarks"].get(name)
+        if before is None:
+            continue
+        ratio = result["median_s"] / before["median_s"]
+        if ratio > 1 + tolerance:
+            regressions.append({"benchmark": name, "baseline_s": before["median_s"], "current_s": result["median_s"],
+                                "ratio": ratio})
+    return regressions
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--parks", nargs="+", default=["hyde", "greenwich"])
+    parser.add_argument("--metrics", nargs="+", default=list(METRICS), choices=METRICS)
+    parser.add_argument("--size", type=int, default=100)
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--samples", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--only", nargs="+", help="run only the benchmarks whose names contain one of these")
+    parser.add_argument("--output", help="JSON file for the results, stdout if not given")
+    parser.add_argument("--compare", help="JSON results of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="slowdown fraction reported as a regression")
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+
+    results = run_suite(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        for regression in regressions:
+            print(f"{regression['benchmark']}: {regression['baseline_s']:.4f}s -> {regression['current_s']:.4f}s "
+                  f"({regression['ratio']:.2f}x)", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
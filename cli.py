@@ -0,0 +1,230 @@
+"""
+Headless command line runner - one model, a grid search (or a multi-park sweep) or the benchmark suite from a JSON or
+TOML config file, the results are printed as JSON (or written to --output). The model, the grid search, the plotting
+libraries and the profilers are imported only by the commands and outputs which need them. The startup of a
+headless run is still about 1.7 s - ParkModel is a mesa.Model, and importing mesa alone takes about 1.1 s.
+run from the repository root:
+    python -m cli run model.json --output result.json
+    python -m cli sweep sweep.toml --profile sampling
+    python -m cli bench bench.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+PROFILES = ("cprofile", "sampling")
+MAP_OUTPUTS = {"map": False, "map_heat": True}
+PLOTS = ("plot_heatmaps", "plot_maps", "plot_maps_heats", "get_acc", "render_maps", "render_maps_heats")
+
+
+def load_config(path: str) -> dict:
+    with open(path, "rb") as f:
+        if path.endswith(".toml"):
+            import tomllib
+            return tomllib.load(f)
+        return json.load(f)
+
+
+@contextlib.contextmanager
+def stdout_to_stderr():
+    """Sends everything printed to stdout - the progress of the models and of the worker processes - to stderr and
+    yields the real stdout, so it holds only the JSON results"""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    os.dup2(2, 1)
+    try:
+        with os.fdopen(os.dup(saved), "w") as stdout:
+            yield stdout
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+
+
+def run_model(config: dict, sections: bool = False) -> dict:
+    """
+    Runs one ParkModel until stop_step or until it stops. The config holds "model" - the ParkModel params,
+    "metric" - the metric name (see step_metrics.create_metric), "stop_step", optionally "early_stopping" - the
+    ConvergenceMonitor args, "snapshot" - a snapshot to continue from, and "outputs" - the files written after the run:
+    "snapshot" (see ParkModel.snapshot), "map" and "map_heat" (PNG images, see utils.rendering).
+    With sections the sections of the steps are timed (see Profiler).
+    """
+    start = time.perf_counter()
+    from model import ParkModel
+    from utils.convergence import ConvergenceMonitor
+    from utils.profiling import Profiler
+    from utils.step_metrics import create_metric
+    imported = time.perf_counter()
+
+    params = dict(config.get("model", {}))
+    if config.get("early_stopping") is not None:
+        params["monitor"] = ConvergenceMonitor(**config["early_stopping"])
+    profiler = Profiler(enabled=sections)
+    params["profiler"] = profiler
+    metric = config.get("metric", "normal")
+    if config.get("snapshot"):
+        model = ParkModel.restore(config["snapshot"], create_metric(metric), **params)
+    else:
+        model = ParkModel(create_metric(metric), **params)
+        model.setup()
+    set_up = time.perf_counter()
+
+    first_step = model.step_count
+    stop_step = config.get("stop_step", 100)
+    while model.running and model.step_count < stop_step:
+        model.step()
+    steps = model.step_count - first_step
+    finished = time.perf_counter()
+    model.close_trips()
+
+    outputs = config.get("outputs", {})
+    if "snapshot" in outputs:
+        model.snapshot(outputs["snapshot"])
+    if any(name in outputs for name in MAP_OUTPUTS):
+        from utils import rendering
+        model_data = {"cells": (model.grid.GRASS_POPULARITY.data + model.grid.SIDEWALK.data).astype("uint8"),
+                      "heatmap": model.heatmap, "agents": [agent.cell.coordinate for agent in model.agents]}
+        for name, heat in MAP_OUTPUTS.items():
+            if name in outputs:
+                rendering.write_png(outputs[name], rendering.render_map(model_data, heat=heat))
+
+    result = {
+        "park": model.park_name,
+        "size": [model.grid.width, model.grid.height],
+        "seed": model._seed,
+        "metric": metric,
+        "agent_params": model.agent_params,
+        "step_count": model.step_count,
+        "stop_reason": model.stop_reason or ConvergenceMonitor.MAX_STEPS,
+        "agents": len(model.agents),
+        "accuracy": float(model.accuracy()),
+        "score": {name: values.tolist() for name, values in model.score().items()},
+        "timings": {"import_s": imported - start, "setup_s": set_up - imported, "run_s": finished - set_up,
+                    "steps_per_s": steps / (finished - set_up) if finished > set_up else 0.0},
+        "outputs": outputs,
+    }
+    if sections:
+        result["sections"] = profiler.summary()
+    return result
+
+
+def run_sweep(config: dict, sections: bool = False, top: int = 10) -> dict:
+    """
+    Runs a GridSearch created with the "grid_search" params of the config (with sweep true a multi-park sweep) and
+    then its "plots" - names of the GridSearch plot functions. Gives the top best models and the leaderboard of a sweep.
+    """
+    start = time.perf_counter()
+    from utils.GridSearch import GridSearch
+    imported = time.perf_counter()
+
+    grid = GridSearch(**{"profile": sections, **config["grid_search"]})
+    grid.run_models(resume=config.get("resume", True))
+    finished = time.perf_counter()
+    for plot in config.get("plots", []):
+        if plot not in PLOTS:
+            raise ValueError(f"Unknown plot {plot}, use one of {list(PLOTS)}")
+        getattr(grid, plot)()
+    plotted = time.perf_counter()
+
+    models = grid.models_data
+    index = models.store.index.iloc[models.rows].drop(columns=["key", "agents"])
+    result = {
+        "directory": grid.directory,
+        "models": len(models),
+        "best": json.loads(index.sort_values("accuracy", ascending=False).head(top).to_json(orient="records")),
+        "timings": {"import_s": imported - start, "run_s": finished - imported, "plots_s": plotted - finished},
+    }
+    if grid.leaderboard is not None:
+        result["leaderboard"] = json.loads(grid.leaderboard.ranking().head(top).to_json(orient="records"))
+    if grid.profiler.enabled:
+        result["sections"] = grid.profiler.summary()
+    return result
+
+
+def run_bench(config: dict, sections: bool = False) -> dict:
+    """
+    Runs the benchmark suite with the config as its arguments (see benchmarks.suite, e.g. {"parks": ["hyde"],
+    "only": ["model_step"], "compare": "baseline.json"}), the regressions against compare are added to the results
+    """
+    from benchmarks import suite
+
+    args = suite.build_parser().parse_args([])
+    for name, value in config.items():
+        name = name.replace("-", "_")
+        if not hasattr(args, name):
+            raise ValueError(f"Unknown benchmark argument {name}")
+        setattr(args, name, value)
+    result = suite.run_suite(args)
+    if args.compare:
+        with open(args.compare) as f:
+            result["regressions"] = suite.compare(json.load(f), result, args.tolerance)
+    return result
+
+
+COMMANDS = {"run": run_model, "sweep": run_sweep, "bench": run_bench}
+
+
+def profiled(command, config: dict, sections: bool, profile: str | None, profile_output: str | None,
+             top: int = 20) -> dict:
+    """Runs the command under the profiler, the profile is written to profile_output (pstats of cProfile, collapsed
+    stacks of the sampling profiler) and its top functions are added to the results"""
+    if profile is None:
+        return command(config, sections)
+
+    if profile == "cprofile":
+        import cProfile
+        import pstats
+
+        profiler = cProfile.Profile()
+        result = profiler.runcall(command, config, sections)
+        stats = pstats.Stats(profiler)
+        if profile_output:
+            stats.dump_stats(profile_output)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE)
+        functions = [{"function": f"{name} ({os.path.basename(file)}:{line})", "calls": calls,
+                      "total_s": total, "cumulative_s": cumulative}
+                     for (file, line, name), (_, calls, total, cumulative, _) in stats.stats.items()]
+        functions.sort(key=lambda function: function["cumulative_s"], reverse=True)
+    else:
+        from utils.profiling import SamplingProfiler
+
+        with SamplingProfiler() as sampler:
+            result = command(config, sections)
+        if profile_output:
+            sampler.write_collapsed(profile_output)
+        functions = sampler.summary(top)
+
+    result["profile"] = {"profiler": profile, "output": profile_output, "top": functions[:top]}
+    return result
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=list(COMMANDS))
+    parser.add_argument("config", help="JSON or TOML config file")
+    parser.add_argument("--output", help="JSON file for the results, stdout if not given")
+    parser.add_argument("--sections", action="store_true", help="time the sections of the model steps (Profiler)")
+    parser.add_argument("--profile", choices=PROFILES, help="profile the whole command")
+    parser.add_argument("--profile-output", help="pstats (cprofile) or collapsed stacks (sampling) file")
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    config = load_config(args.config)
+
+    with stdout_to_stderr() as stdout:
+        result = profiled(COMMANDS[args.command], config, args.sections, args.profile, args.profile_output)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(result, f, indent=2)
+        else:
+            json.dump(result, stdout, indent=2)
+            stdout.write("\n")
+
+    if result.get("regressions"):
+        sys.exit(1)
@@ -1,24 +1,9 @@
-import numpy as np
-from matplotlib.figure import Figure
-from mesa.visualization import SolaraViz
-from mesa.visualization.components.matplotlib_components import make_mpl_space_component
-from utils.step_metrics import ClosestMetric, AffordanceMetric
 import solara
-import seaborn as sns
+from matplotlib.figure import Figure
 
 from model import ParkModel
-from visualisation import *
-
-import logging
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("simulation_performance.log"),
-        logging.StreamHandler()
-    ]
-)
+from utils.live import LiveRunner, Frame
+from utils.step_metrics import AffordanceMetric
 
 
 model_params = {
@@ -51,47 +36,93 @@ model_params = {
         "max": 500,
         "step": 1,
     },
-    "metric" : AffordanceMetric()
 }
 
-model = ParkModel(AffordanceMetric(), 5,100,100, )
-model.setup()
+# path of a ParkModel.snapshot to start the app from its step instead of the empty park
+SNAPSHOT = None
+
+# seconds between the frames the background thread publishes, the UI is redrawn at most that often
+PUBLISH_INTERVAL = 0.25
+
+
+def create_model(seed=42, num_agents=5, width=100, height=100) -> ParkModel:
+    if SNAPSHOT:
+        return ParkModel.restore(SNAPSHOT, AffordanceMetric(), show_vision=True)
+    model = ParkModel(AffordanceMetric(), num_agents, width, height, seed=seed, show_vision=True)
+    model.setup()
+    return model
+
+
+# the model is stepped by the runner thread, the components only draw the frames it publishes
+runner = LiveRunner(create_model(), PUBLISH_INTERVAL)
+
+
+def use_frame() -> Frame:
+    """Latest frame of the runner - a thread polls it and re-renders the page only when a new one was published"""
+    frame, set_frame = solara.use_state(runner.frame)
+
+    def poll(cancel):
+        version = frame.version
+        while not cancel.wait(PUBLISH_INTERVAL / 2):
+            if runner.frame.version != version:
+                version = runner.frame.version
+                set_frame(runner.frame)
 
-def post_process(ax):
-    fig = ax.get_figure()
-    fig.set_size_inches(10,10)
+    solara.use_thread(poll, dependencies=[])
+    return frame
 
 
 @solara.component
-def HeatMap(model:ParkModel):
-    print("HeatMap", type(model))
-    fig = Figure(figsize=(20,14), dpi=150)
-    ax = fig.subplots()
-
-    sns.heatmap(
-        data=np.transpose(model.heatmap),
-        ax=ax,
-        cmap="Oranges",
-        vmin=0,
-        vmax=model.heatmap.max(),
-    )
-    ax.invert_yaxis()
-    ax.set_title(f"Tiles visitation density for step {model.step_count}")
-
-    return solara.FigureMatplotlib(fig)
-
-
-space = make_mpl_space_component(
-    agent_portrayal=agent_portrayal,
-    propertylayer_portrayal=propertylayer_portrayal,
-    draw_grid=True,
-    post_process=post_process
-)
-
-
-page = SolaraViz(
-    model,
-    components=[space, (HeatMap, 1)],
-    model_params=model_params,
-    name="Test model"
-)
+def Map(frame: Frame, heat: bool):
+    # the image is rendered once per frame (Frame.png caches it) and not again when only the controls change
+    png = solara.use_memo(lambda: frame.png(heat), dependencies=[frame.version, heat])
+    solara.Image(png, width="100%")
+
+
+@solara.component
+def HeatMap(frame: Frame):
+    def draw():
+        fig = Figure(figsize=(10, 7), dpi=100)
+        ax = fig.subplots()
+        image = ax.imshow(frame.heatmap.T, origin="lower", cmap="Oranges", vmin=0, vmax=frame.heatmap.max())
+        fig.colorbar(image, ax=ax)
+        ax.set_title(f"Tiles visitation density for step {frame.step}")
+        return fig
+
+    fig = solara.use_memo(draw, dependencies=[frame.version])
+    solara.FigureMatplotlib(fig, dependencies=[frame.version])
+
+
+@solara.component
+def Page():
+    frame = use_frame()
+    _, set_playing = solara.use_state(runner.playing)
+    heat, set_heat = solara.use_state(False)
+    params = {name: solara.use_reactive(param["value"]) for name, param in model_params.items()}
+
+    def toggle():
+        runner.pause() if runner.playing else runner.play()
+        set_playing(runner.playing)
+
+    def reset():
+        runner.reset(create_model(**{name: int(value.value) for name, value in params.items()}))
+        set_playing(False)
+
+    solara.Title("Test model")
+    with solara.Sidebar():
+        with solara.Row():
+            solara.Button("Pause" if runner.playing else "Play", on_click=toggle)
+            solara.Button("Step", on_click=runner.step, disabled=runner.playing)
+            solara.Button("Reset", on_click=reset)
+        solara.Checkbox(label="Heatmap overlay", value=heat, on_value=set_heat)
+        solara.Text(f"Step {frame.step}, {runner.steps_per_second:.0f} steps/s")
+        for name, param in model_params.items():
+            if param["type"] == "SliderInt":
+                solara.SliderInt(param["label"], value=params[name], min=param["min"], max=param["max"],
+                                 step=param["step"])
+            else:
+                solara.InputInt(param["label"], value=params[name])
+
+    with solara.Columns([1, 1]):
+        Map(frame, heat)
+        HeatMap(frame)
@@ -1,23 +1,27 @@
-import math
-
 import mesa
-from mesa import DataCollector
-from mesa.discrete_space import OrthogonalMooreGrid, CellAgent
+from mesa.discrete_space import OrthogonalMooreGrid, CellAgent, Cell
 from mesa.experimental.cell_space import PropertyLayer
 from scipy.ndimage import binary_dilation
 
 from environment import TestEnvironment
 from agent import ParkAgent
-from utils import entrances
+from utils import distance_fields, entrances, grass
 from utils.terrains import Terrain
-from utils.images import binarize_desired_paths
-from utils.data_collecting import gather_steps
+from utils import images, scoring, snapshot
+from utils.array_step import ArrayStepper
+from utils.convergence import ConvergenceMonitor
+from utils.data_collecting import TrajectoryRecorder, TripExporter
+from utils.occupancy import OccupancyIndex
+from utils.profiling import Profiler, DISABLED
+from utils.terrain_index import TerrainIndex, distance
+from utils.vision import VisionEngine
+import math
 import numpy as np
 from utils.step_metrics import AbstractMetric, ClosestMetric, AffordanceMetric
 
 
 class ParkModel(mesa.Model):
-    def __init__(self, metric: AbstractMetric,  num_agents=5, width=100, height=100,park_name: str = "doria_pamphil", seed = 42, kind="normal", grass_decay_rate=0.2, grass_growth_probability=0.3, agent_params : dict = None, obstacle_margin_percentage=0.5):
+    def __init__(self, metric: AbstractMetric,  num_agents=5, width=100, height=100,park_name: str = "doria_pamphil", seed = 42, kind="normal", grass_decay_rate=0.2, grass_growth_probability=0.3, agent_params : dict = None, obstacle_margin_percentage=0.5, grass_rng="numpy", monitor: ConvergenceMonitor | None = None, max_agents=15, geodesic_distance=False, backend="mesa", profiler: Profiler | None = None, show_vision=False, trips_directory: str | None = None, remove_stuck=True):
         super().__init__(seed=seed)
         self.num_agents = num_agents
         self.park_name = park_name
@@ -25,15 +29,30 @@ class ParkModel(mesa.Model):
         self.environment = TestEnvironment(width, height, park_name = self.park_name)
         self.step_count = 0
         self.spawn_cells = None
-        self.data_collector = DataCollector(
-            model_reporters={"Steps": gather_steps}
-        )
         self.heatmap = np.zeros((width, height), dtype=np.uint32)
+        self.trajectories = TrajectoryRecorder(self.heatmap)
+        # the trips of the removed agents are streamed to this directory, see TripExporter and close_trips
+        self.trips = TripExporter(trips_directory) if trips_directory is not None else None
+        # agents per cell and the compact state of every agent, see OccupancyIndex
+        self.occupancy = OccupancyIndex((width, height))
+        # new agents are spawned every 10 steps while there are at most max_agents of them
+        self.max_agents = max_agents
+        # the agents going back and forth between two cells are removed (see OccupancyIndex.stuck), False reproduces
+        # the runs made before the steps of the agents were recorded, where they were never removed
+        self.remove_stuck = remove_stuck
+        # distances to the entrances walk around the obstacles (see distance_to) instead of the straight line
+        self.geodesic_distance = geodesic_distance
+        self.gradient_maps = {}
         self.agent_params = agent_params
         self.kind = kind
         self.grass_decay_rate = grass_decay_rate
         self.obstacle_margin_percentage = obstacle_margin_percentage
         self.grass_growth_probability = grass_growth_probability
+        # "numpy" - regrowth draws come from self.rng (seeded with seed), "legacy" - from self.random,
+        # which reproduces the runs made before the grass kernel was vectorized
+        self.grass_rng = grass_rng
+        # the agents mark the cells they see on the VISION layer and keep them in vision_range, only for the visualisation
+        self.show_vision = show_vision
         self.agents_vision = PropertyLayer(
             "VISION", dimensions=(width, height), default_value=0, dtype=int
         )
@@ -41,12 +60,22 @@ class ParkModel(mesa.Model):
             "SUBTARGETS", dimensions=(width, height), default_value=0, dtype=int
         )
         self.metric = metric
+        self.terrain = None
+        self.vision = None
+        # stops the run early (self.running = False) and sets the reason, see ConvergenceMonitor
+        self.monitor = monitor
+        self.stop_reason = None
+        # times the sections of the step (vision, metric_ranking, decay, growth, data_collection), see Profiler
+        self.profiler = profiler if profiler is not None else DISABLED
+        # "mesa" - every agent steps with ParkAgent.action, "numpy" or "numba" - all agents at once with ArrayStepper
+        self.backend = backend
+        self.stepper = ArrayStepper(self, backend) if backend != "mesa" else None
 
 
     def __str__(self):
         return f"Model with params: {self.agent_params} and seed {self._seed} on map {self.park_name}"
 
-    def setup(self):
+    def setup(self, initial_agents=3):
         terrain, obstacles, obstacles_margin, grass, grass_popularity = self.environment.create()
         self.grid.add_property_layer(terrain)
         self.grid.add_property_layer(grass)
@@ -55,14 +84,21 @@ class ParkModel(mesa.Model):
         self.grid.add_property_layer(grass_popularity)
         self.grid.add_property_layer(self.agents_vision)
         self.grid.add_property_layer(self.targets_vision)
+        self.terrain = TerrainIndex.from_grid(self.grid)
+        fields = (None, None)
+        if self.geodesic_distance:
+            self.gradient_maps = self.environment.create_gradient_maps()
+            fields = distance_fields.stack_fields(self.gradient_maps, (self.grid.width, self.grid.height))
+        self.vision = VisionEngine(self.terrain, *fields)
+        if self.stepper is not None:
+            self.stepper.setup()
 
 
-        self.spawn_cells = [
-            cell
-            for cell in self.grid.all_cells
-            if cell.coordinate in entrances.entrances_map[self.park_name]
-        ]
-        self.spawn_agents(3)
+        size = (self.grid.width, self.grid.height)
+        entrance_coords = entrances.get_spawn_coordinates(self.park_name, size, self.terrain.free, images.base_size)
+        self.spawn_cells = [self.grid[coord] for coord in entrance_coords]
+        if initial_agents:
+            self.spawn_agents(initial_agents)
 
 
 
@@ -73,7 +109,8 @@ class ParkModel(mesa.Model):
             self.agent_params = {}
 
         starting_points = self.random.sample(self.spawn_cells, k=num_agents)
-        finish_points = [self.random.choice(list(set(self.spawn_cells) - {starting_points[i]})) for i in range(num_agents)]
+        # list keeps the order of the spawn cells, choosing from a set made the runs depend on the memory layout
+        finish_points = [self.random.choice([c for c in self.spawn_cells if c is not starting_points[i]]) for i in range(num_agents)]
 
         ParkAgent.create_agents(
             model=self,
@@ -84,81 +121,122 @@ class ParkModel(mesa.Model):
         )
 
     def step(self):
-        self.data_collector.collect(self)
-        self.grid.VISION.data = self.grid.VISION.data * 0
-        self.populate_heatmap()
+        if self.show_vision:
+            self.grid.VISION.data = self.grid.VISION.data * 0
+        with self.profiler.section("data_collection"):
+            self.populate_heatmap()
 
         self.step_count += 1
-        if self.step_count % 10 == 0 and len(self.agents) <= 15:
+        if self.step_count % 10 == 0 and len(self.occupancy) <= self.max_agents:
             self.spawn_agents(3)
 
-        stuck_agents = [agent for agent in self.agents if len(set(agent.last_10_cells)) == 2 and agent.steps_count > 10]
-        self.remove_agents(stuck_agents)
-        del_agents= [agent for agent in self.agents if agent.target == agent.cell]
-        self.remove_agents(del_agents)
+        if self.remove_stuck:
+            self.remove_agents(self.occupancy.stuck(), TripExporter.STUCK)
+        self.remove_agents(self.occupancy.arrived(), TripExporter.ARRIVED)
+
+        if self.stepper is None:
+            self.agents.shuffle_do("step")
+        else:
+            self.stepper.step()
+        with self.profiler.section("decay"):
+            agent_counts = self._handle_grass_decay()
+        with self.profiler.section("growth"):
+            self._handle_grass_growth(agent_counts)
 
-        self.agents.shuffle_do("step")
-        agent_cells = self._handle_grass_decay()
-        self._handle_grass_growth(agent_cells)
+        if self.monitor is not None and self.step_count % self.monitor.interval == 0:
+            with self.profiler.section("monitor"):
+                self.monitor.observe(self)
 
         if self.step_count%100 == 0:
-            print("Step: ", self.step_count, ",accuracy: ", self.calculate_accuracy()[0])
-
-    """Function that simulates grass decay"""
-    def _handle_grass_decay(self):
-        agent_cells = []
-        for agent in self.agents:
-            agent_cells.append(agent.cell)
-            if agent.cell.GRASS == Terrain.GRASS.value:
-                value = self.grid.GRASS_POPULARITY.data[agent.cell.coordinate]
-                increment = max(1, math.ceil(self.grass_decay_rate * value))
-                if value + increment > 100:
-                    self.grid.GRASS_POPULARITY.data[agent.cell.coordinate] = 100
-                else:
-                    self.grid.GRASS_POPULARITY.data[agent.cell.coordinate] += math.ceil(increment)
-            if agent.cell.OBSTACLE_MARGIN == Terrain.OBSTACLE_MARGIN.value:
-                value = self.obstacle_margin_percentage * self.grid.GRASS_POPULARITY.data[agent.cell.coordinate]
-                increment = max(1, math.ceil(self.grass_decay_rate * value * self.obstacle_margin_percentage))
-                if value + increment > 40:
-                    self.grid.GRASS_POPULARITY.data[agent.cell.coordinate] = 40
-                else:
-                    self.grid.GRASS_POPULARITY.data[agent.cell.coordinate] += math.ceil(increment)
-        return agent_cells
+            print("Step: ", self.step_count, ",accuracy: ", self.accuracy())
+
+    """Function that simulates grass decay, returns the number of agents on each cell"""
+    def _handle_grass_decay(self) -> np.ndarray:
+        agent_counts = self.occupancy.counts
+        grass.decay_grass(self.grid.GRASS_POPULARITY.data, self.terrain.grass, self.terrain.margin, agent_counts,
+                          self.grass_decay_rate, self.obstacle_margin_percentage)
+        return agent_counts
 
     """Function that simulates grass regrowth"""
-    def _handle_grass_growth(self, agent_cells):
-        for cell in self.grid.all_cells:
-            if cell.GRASS == Terrain.GRASS.value and cell not in agent_cells:
-                value = self.grid.GRASS_POPULARITY.data[cell.coordinate]
-
-                """Reducing only the medium paths"""
-                if 40 < value < 60 and self.random.random() < self.grass_growth_probability:
-                    self.grid.GRASS_POPULARITY.data[cell.coordinate] -= 5
-            if cell.OBSTACLE_MARGIN == Terrain.OBSTACLE_MARGIN.value and cell not in agent_cells:
-                self.grid.GRASS_POPULARITY.data[cell.coordinate] *= self.obstacle_margin_percentage
-
-    def remove_agents(self, agents: list[ParkAgent]) -> None:
+    def _handle_grass_growth(self, agent_counts: np.ndarray) -> None:
+        grass.regrow_grass(self.grid.GRASS_POPULARITY.data, self.terrain.grass, self.terrain.margin, agent_counts,
+                           self.grass_growth_probability, self.obstacle_margin_percentage,
+                           lambda cells: self._grass_draws(len(cells)))
+
+    """Random numbers for the regrowth, legacy mode draws them one by one from self.random like the old per cell loop"""
+    def _grass_draws(self, n: int):
+        if self.grass_rng == "legacy":
+            return [self.random.random() for _ in range(n)]
+        return self.rng.random(n)
+
+    def remove_agents(self, agents: list[ParkAgent], outcome: str = TripExporter.UNFINISHED) -> None:
         for agent in agents:
+            if self.trips is not None:
+                self.trips.finish(agent, self.step_count, outcome)
 
             if agent.subtarget:
                 self.grid.SUBTARGETS.data[agent.subtarget.coordinate] -= 1
 
             self.agents.remove(agent)
             self.grid[agent.cell.coordinate].remove_agent(agent)
+            self.occupancy.remove(agent)
+
+    """Distance from (x, y) to the cell - geodesic for the entrances when the model uses geodesic_distance,
+    euclidean for the other cells and the cells the entrance cannot be reached from"""
+    def distance_to(self, cell: Cell, x: int, y: int) -> float:
+        field = self.gradient_maps.get(cell.coordinate)
+        if field is not None:
+            value = field[x, y]
+            if value != math.inf:
+                return float(value)
+        return distance(*cell.coordinate, x, y)
+
+    """Saves the state of the model (layers, heatmap, trajectories, agents and random generators) to one npz file"""
+    def snapshot(self, path: str) -> None:
+        snapshot.save(self, path)
+
+    """Model continuing the run saved with snapshot. params (other than the park and the grid size) replace the saved
+    ParkModel params, agent_params apply to the agents spawned after the restore. With seed the random generators are
+    seeded again, so many runs can be forked from one warmed up snapshot, without it the restored run makes the same
+    steps as the saved one. The monitor and the profiler are not saved, pass new ones in params"""
+    @classmethod
+    def restore(cls, path: str, metric: AbstractMetric, seed: int | None = None, **params) -> "ParkModel":
+        meta, arrays = snapshot.read(path)
+        model = cls(metric, **snapshot.model_params(meta, seed, params))
+        model.setup(initial_agents=0)
+        snapshot.load(model, meta, arrays, keep_random=seed is None)
+        return model
 
     def populate_heatmap(self):
-        steps = self.data_collector.get_model_vars_dataframe()['Steps'].iloc[self.step_count]
+        self.trajectories.record(self.step_count, self.agents)
+        if self.trips is not None:
+            self.trips.record(self.step_count, self.agents)
+
+    """Writes the trips of the agents still walking (as unfinished) and the buffered trips, call it after the run"""
+    def close_trips(self) -> None:
+        if self.trips is not None:
+            self.trips.close(self.agents, self.step_count)
+
+    """Share of the desired paths covered by the created paths, the accuracy of calculate_accuracy without the matrices"""
+    def accuracy(self, include_dilatation=True) -> float:
+        return scoring.accuracy(self.grid.GRASS_POPULARITY.data, self.reference_paths(), dilation=int(include_dilatation))
+
+    """Recall, precision, IoU and F1 of the created paths for every threshold and dilation, see scoring.score"""
+    def score(self, thresholds=(scoring.ACCURACY_THRESHOLD,), dilations=(1,)) -> dict[str, np.ndarray]:
+        return scoring.score(self.grid.GRASS_POPULARITY.data, self.reference_paths(), thresholds, dilations)
 
-        for (x, y) in steps:
-            self.heatmap[x, y] += 1
+    """Desired paths mask of the park in the grid orientation"""
+    def reference_paths(self) -> np.ndarray:
+        return scoring.reference_mask(self.environment.park_name, (self.grid.width, self.grid.height))
 
+    """Accuracy with the created and desired paths matrices in the image orientation, used for the plots"""
     def calculate_accuracy(self, include_dilatation=True):
         terrain_after_simulation = self.grid.GRASS_POPULARITY.data
         #we have to determine the threshold
         created_paths = (terrain_after_simulation > 10).astype(int)
         created_paths = np.rot90(created_paths, k=1)
         if include_dilatation:  created_paths = binary_dilation(created_paths, iterations=1).astype(int)
-        reference_paths = np.load(f"utils/desired_paths_matrixes/" + self.environment.park_name + ".npy")
+        reference_paths = images.load_reference_paths(self.environment.park_name, (self.grid.width, self.grid.height))
         mask = reference_paths==1
         accuracy = np.sum(created_paths[mask] == 1) / np.sum(mask)
         return accuracy, created_paths, reference_paths
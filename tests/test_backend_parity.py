@@ -0,0 +1,56 @@
+"""
+Parity of the array backends of ParkModel with the mesa backend (ParkAgent.action) - for fixed seeds every backend
+must give the same heatmap, trajectories, grass and agents, with the euclidean and with the geodesic distances
+run from the repository root: python -m pytest tests
+"""
+
+import contextlib
+import functools
+import io
+
+import numpy as np
+import pytest
+
+from model import ParkModel
+from utils.step_metrics import create_metric
+
+PARK = "hyde"
+STEPS = 100
+# (seed, agent params) of the compared runs
+RUNS = [
+    (1, {"distance": 7, "angle": 90, "tile_weight": 0.9, "distance_weight": 0.3}),
+    (42, {"distance": 12, "angle": 150, "tile_weight": 3, "distance_weight": 0.3}),
+]
+
+
+@functools.lru_cache(maxsize=None)
+def run(backend: str, metric: str, run_index: int, geodesic: bool) -> dict:
+    seed, params = RUNS[run_index]
+    model = ParkModel(create_metric(metric), agent_params=params, seed=seed, park_name=PARK, backend=backend,
+                      geodesic_distance=geodesic)
+    model.setup()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(STEPS):
+            model.step()
+    return {
+        "heatmap": model.heatmap.copy(),
+        "trajectories": model.trajectories.history,
+        "grass": model.grid.GRASS_POPULARITY.data.copy(),
+        "subtargets": model.grid.SUBTARGETS.data.copy(),
+        "agents": [(agent.unique_id, agent.cell.coordinate, agent.subtarget.coordinate if agent.subtarget else None)
+                   for agent in model.agents],
+    }
+
+
+@pytest.mark.parametrize("geodesic", [False, True], ids=["euclidean", "geodesic"])
+@pytest.mark.parametrize("metric", ["normal", "affordance", "balanced", "mixed"])
+@pytest.mark.parametrize("run_index", range(len(RUNS)))
+@pytest.mark.parametrize("backend", ["numpy", "numba"])
+def test_backend_matches_mesa(backend: str, run_index: int, metric: str, geodesic: bool):
+    expected = run("mesa", metric, run_index, geodesic)
+    actual = run(backend, metric, run_index, geodesic)
+
+    assert len(expected["trajectories"]) > 0
+    for key in ("heatmap", "trajectories", "grass", "subtargets"):
+        np.testing.assert_array_equal(actual[key], expected[key], err_msg=key)
+    assert actual["agents"] == expected["agents"]
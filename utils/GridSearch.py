@@ -1,20 +1,40 @@
+from __future__ import annotations
+
+import collections
+import contextlib
+import functools
+import hashlib
+import itertools
+import json
 import os
 import multiprocessing as mp
+import shutil
+from typing import TYPE_CHECKING
 
 from model import ParkModel
-import random
-import seaborn as sns
-import matplotlib.pyplot as plt
 import numpy as np
 
 from utils.step_metrics import *
 from utils.terrains import Terrain
+from utils.result_store import Leaderboard, ResultStore, StoredModels
+from utils.batch import BatchParkModel
+from utils.convergence import ConvergenceMonitor
+from utils.profiling import Profiler
+from utils.samplers import Sampler, create_sampler
+from utils.shared_terrain import SharedTerrain, attach
+
+if TYPE_CHECKING:
+    import matplotlib.pyplot as plt
+
+# matplotlib, seaborn and utils.rendering are imported by the plot functions only, so the workers running the models
+# and the headless runs do not load them
 
 class GridSearch:
     """
         GridSearch like class for generating many simulations with different params at once
         use run_models to run the simulations, use plot_heatmaps, plot_maps, plot_maps_heats and get_acc to create plots
         and slice_models to remove models with acc less than provided threshold
+        results are kept on disk in <directory>/runs (see ResultStore) and read lazily by the plot functions
 
 
         :param directory: The base directory where simulation artifacts (logs, plots, data)
@@ -44,10 +64,70 @@ class GridSearch:
                           a run is forcibly terminated. Defaults to 100.
         :type stop_step: int
 
+        :param batch_size: The number of models on the same park run together by a worker in one BatchParkModel.
+                           Defaults to 1 - every model is run in its own ParkModel.
+        :type batch_size: int
+
+        :param early_stopping: Arguments of the ConvergenceMonitor stopping the runs which converged before stop_step.
+                               Defaults to None - every run makes stop_step steps. Not supported with batch_size > 1.
+        :type early_stopping: dict | None
+
+        :param prune_quantile: With early_stopping, runs whose accuracy at a step is under this quantile of the
+                               accuracies the finished runs had at the same step are pruned. Defaults to None.
+        :type prune_quantile: float | None
+
+        :param profile: Times the sections of the model steps in every run (see Profiler), the profiles of all the runs
+                        are merged into profiler and saved in runs/profile.json and runs/profile.csv. Defaults to False.
+        :type profile: bool
+
+        :param warm_start: Path of a ParkModel snapshot (see ParkModel.snapshot) every run is forked from instead of
+                           the empty park - the run continues from the saved step with its own seed, metric and
+                           agent params for the new agents, so it must be a snapshot of the searched park.
+                           Defaults to None. Not supported with batch_size > 1 and with sweep.
+        :type warm_start: str | None
+
+        :param search: How the params are drawn - "random" (every param independently), "lhs" (latin hypercube without
+                       repeated models), "halving" (successive halving - short runs of samples models, longer runs of
+                       the best of them) and "surrogate" (gaussian process proposing the next models from the accuracies
+                       so far), or a Sampler from utils.samplers. The adaptive searches ("halving", "surrogate") run
+                       the models round by round in the same pool and always start over. Defaults to "random".
+        :type search: str | Sampler
+
+        :param search_seed: Seed of the search, None draws from the global random module. Defaults to None.
+        :type search_seed: int | None
+
+        :param sweep: Runs every sampled configuration (agent params, seed and metric) on every park of parks instead
+                      of a random one and ranks the configurations by their mean and min accuracy across the parks in
+                      runs/leaderboard.csv as the runs finish. The plots of every park go to <directory>/<park>.
+                      Defaults to False. Not supported with the adaptive searches and with warm_start.
+        :type sweep: bool
+
         :param kwargs: additional arguments for agents see ParkAgent class for possible args.
     """
-    def __init__(self, directory:str = os.getcwd(), parks: str|list[str] = "doria_pamphil", seeds: int|list[int] = 42 , metric: str | list[str] = "normal" ,samples:int = 5,   n_workers : int = 1, stop_step:int = 100, **kwargs):
+    PRUNE_MIN_RUNS = 5
+
+    def __init__(self, directory:str = os.getcwd(), parks: str|list[str] = "doria_pamphil", seeds: int|list[int] = 42 , metric: str | list[str] = "normal" ,samples:int = 5,   n_workers : int = 1, stop_step:int = 100, batch_size: int = 1, early_stopping: dict | None = None, prune_quantile: float | None = None, profile: bool = False, warm_start: str | None = None, search: str | Sampler = "random", search_seed: int | None = None, sweep: bool = False, **kwargs):
+        if early_stopping is not None and batch_size > 1:
+            raise ValueError("early_stopping is not supported with batch_size > 1")
+        if warm_start is not None and batch_size > 1:
+            raise ValueError("warm_start is not supported with batch_size > 1")
+        if warm_start is not None and sweep:
+            raise ValueError("warm_start is not supported with sweep, the snapshot holds the map of a single park")
+        self.sampler = create_sampler(search, search_seed) if isinstance(search, str) else search
+        self.search_seed = search_seed
+        if self.sampler.adaptive and batch_size > 1:
+            raise ValueError("adaptive searches are not supported with batch_size > 1")
+        if self.sampler.adaptive and sweep:
+            raise ValueError("sweep is not supported with adaptive searches")
+        self.sweep = sweep
+        self.leaderboard = None
         self.directory = directory
+        self.batch_size = batch_size
+        self.early_stopping = early_stopping
+        self.prune_quantile = prune_quantile
+        self.profile = profile
+        self.profiler = Profiler(enabled=profile)
+        self.warm_start = warm_start
         self.seeds = seeds
         self.samples = samples
         self.n_workers = n_workers
@@ -59,47 +139,58 @@ class GridSearch:
         self.models_data = []
 
 
-    def initialize(self) -> list[tuple[dict, int]]:
-        params = []
-        for i in range(self.samples):
-            agent_params = dict()
-            for name, param in self.model_params.items():
-
-                if isinstance(param, list):
-                    agent_params[name] = random.choice(param)
-                else:
-                    agent_params[name] = param
-
-            if isinstance(self.seeds, list):
-                model_seed = random.choice(self.seeds)
-            else:
-                model_seed = self.seeds
-
-            if isinstance(self.metric, list):
-                model_metric = random.choice(self.metric)
-            else:
-                model_metric = self.metric
+    """params of the models drawn by the sampler, the adaptive searches draw them in run_models, the sweep runs every
+    drawn configuration on every park"""
+    def initialize(self) -> list[tuple[dict, int, str, str]]:
+        if self.sampler.adaptive:
+            return []
+        if not self.sweep:
+            return [self.model_item(point) for point in self.sampler.sample(self.space(), self.samples)]
+        points = self.sampler.sample({**self.space(), "park": None}, self.samples)
+        return [self.model_item({**point, "park": park}) for point in points for park in self.park_list()]
+
+    """settings of the search the results in the store depend on, kept in plan.json so a search is resumed only
+    with the same settings"""
+    def plan_config(self) -> dict:
+        config = {"space": self.space(), "samples": self.samples, "stop_step": self.stop_step,
+                  "early_stopping": self.early_stopping, "prune_quantile": self.prune_quantile,
+                  "search": type(self.sampler).__name__, "search_seed": self.search_seed, "sweep": self.sweep,
+                  "warm_start": self.warm_start}
+        return json.loads(json.dumps(config, sort_keys=True))
+
+    def _write_plan(self, plan_path: str) -> None:
+        with open(plan_path, "w") as f:
+            json.dump({"config": self.plan_config(), "params": self.params}, f)
+
+    def park_list(self) -> list[str]:
+        return list(dict.fromkeys(self.parks)) if isinstance(self.parks, list) else [self.parks]
+
+    """the searched values of every param (a list) or its fixed value, see utils.samplers"""
+    def space(self) -> dict:
+        return {**self.model_params, "seed": self.seeds, "metric": self.metric, "park": self.parks}
 
-            if isinstance(self.parks, list):
-                model_park = random.choice(self.parks)
-            else:
-                model_park = self.parks
-
-            params.append((agent_params, model_seed, model_metric, model_park))
+    @staticmethod
+    def model_item(point: dict) -> tuple[dict, int, str, str]:
+        agent_params = {name: value for name, value in point.items() if name not in ("seed", "metric", "park")}
+        return agent_params, point["seed"], point["metric"], point["park"]
 
-        return params
+    @staticmethod
+    def model_point(model_item: tuple[dict, int, str, str]) -> dict:
+        return {**model_item[0], "seed": model_item[1], "metric": model_item[2], "park": model_item[3]}
 
 
     """plots heatmaps of agents movements from created simulations"""
     @staticmethod
-    def _create_heatmaps(directory: str, models_data: list[dict]) -> None:
+    def _create_heatmaps(directory: str, models_data: list[dict], offset: int = 0) -> None:
+
+        import matplotlib.pyplot as plt
 
         plot_dirname = "heatmaps"
 
         GridSearch.check_create_dir(directory, plot_dirname)
 
 
-        for index, model in enumerate(models_data):
+        for index, model in enumerate(models_data, start=offset):
 
             plt.figure(figsize=(20, 14), dpi=300)
             ax = plt.gca()
@@ -114,11 +205,13 @@ class GridSearch:
 
     """function for getting the score of the simulation compared to the real emerged paths"""
     @staticmethod
-    def _create_acc(directory: str, models_data: list[dict]):
+    def _create_acc(directory: str, models_data: list[dict], offset: int = 0):
+        import matplotlib.pyplot as plt
+
         plot_dirname = "accuracy"
         GridSearch.check_create_dir(directory, plot_dirname)
 
-        for idx, model in enumerate(models_data):
+        for idx, model in enumerate(models_data, start=offset):
             acc = model["accuracy"][0]
             created_paths = model["accuracy"][1]
             original_paths = model["accuracy"][2]
@@ -128,8 +221,7 @@ class GridSearch:
             ax.imshow(np.ma.masked_where(original_paths == 0, original_paths), cmap="Blues", alpha=0.7, vmin=0, vmax=1)
             ax.set_title(f"Accuracy: {acc}")
 
-            p = model['params']
-            safe_name = f"dist{p[0]['distance']}_ang{p[0]['angle']}_tile{p[0]['tile_weight']}_dw{p[0]['distance_weight']}_{p[1]}_{p[2]}_{p[3]}"
+            safe_name = GridSearch.model_file_name(model['params'])
             save_path = os.path.join(directory, plot_dirname, f"{safe_name}_{idx}.jpg")
             plt.savefig(save_path)
             plt.close(f)
@@ -138,13 +230,15 @@ class GridSearch:
 
     """plots maps states and heatmaps of agents movement together from created simulations"""
     @staticmethod
-    def _create_map_and_heat(directory:str,models_data: list[dict], agents: bool = True) -> None:
+    def _create_map_and_heat(directory:str,models_data: list[dict], agents: bool = True, offset: int = 0) -> None:
+
+        import matplotlib.pyplot as plt
 
         plot_dirname = "combined"
 
         GridSearch.check_create_dir(directory, plot_dirname)
 
-        for index, model in enumerate(models_data):
+        for index, model in enumerate(models_data, start=offset):
             acc = model["accuracy"][0]
             model_map_data = model["cells"]
 
@@ -156,8 +250,7 @@ class GridSearch:
             ax.set_aspect("equal")
             ax.set_title(f"Accuracy: {acc}")
 
-            p = model['params']
-            model_name = f"dist{p[0]['distance']}_ang{p[0]['angle']}_tile{p[0]['tile_weight']}_dw{p[0]['distance_weight']}_{p[1]}_{p[2]}_{p[3]}"
+            model_name = GridSearch.model_file_name(model['params'])
 
             GridSearch.get_map_state(ax, model, plot_agents=agents, alpha=1)
             GridSearch.get_heatmap(ax, model, alpha=0.3)
@@ -169,13 +262,15 @@ class GridSearch:
 
     """plots maps state from created simulations"""
     @staticmethod
-    def _create_map_state(directory:str,models_data: list[dict], agents: bool = True) -> None:
+    def _create_map_state(directory:str,models_data: list[dict], agents: bool = True, offset: int = 0) -> None:
+
+        import matplotlib.pyplot as plt
 
         plot_dirname = "maps"
 
         GridSearch.check_create_dir(directory, plot_dirname)
 
-        for index, model in enumerate(models_data):
+        for index, model in enumerate(models_data, start=offset):
 
             model_name = model["params"]
             model_map_data = model["cells"]
@@ -194,6 +289,27 @@ class GridSearch:
             plt.savefig(f"{directory}/{plot_dirname}/{model_name}{index}.png")
             plt.close()
 
+    """writes map states (with the heatmaps blended over them if heat) as PNG images rendered straight from the arrays,
+    see utils.rendering, scale is the number of pixels per cell. They go to their own directories, so they do not
+    overwrite the figures of plot_maps and plot_maps_heats"""
+    @staticmethod
+    def _render_maps(directory: str, models_data: list[dict], heat: bool = False, agents: bool = True, scale: int = 8,
+                     offset: int = 0) -> None:
+        from utils import rendering
+
+        plot_dirname = "combined_raster" if heat else "maps_raster"
+
+        GridSearch.check_create_dir(directory, plot_dirname)
+
+        for index, model in enumerate(models_data, start=offset):
+            save_path = os.path.join(directory, plot_dirname, f"{GridSearch.model_file_name(model['params'])}_{index}.png")
+            rendering.write_png(save_path, rendering.render_map(model, heat=heat, agents=agents, scale=scale))
+
+    """name of the model files made of its params"""
+    @staticmethod
+    def model_file_name(params: tuple[dict, int, str, str]) -> str:
+        return f"dist{params[0]['distance']}_ang{params[0]['angle']}_tile{params[0]['tile_weight']}_dw{params[0]['distance_weight']}_{params[1]}_{params[2]}_{params[3]}"
+
     """Task function for running a plot function"""
     @staticmethod
     def _plot_task(function_name:str, models_data: list[dict], directory: str, func_params: dict) -> None:
@@ -203,19 +319,27 @@ class GridSearch:
         target_func(directory, models_data, **func_params)
 
     """Function that takes the function name and its args in kwargs to run the plots in multiple processes
-    Required params are: directory name, data of the models and function name - func_params are kwargs for the function arguments"""
-    def _plot_functions(self, function_name:str, **kwargs) -> None:
+    Required params are: directory name, data of the models and function name - func_params are kwargs for the function arguments.
+    The models are handed to the workers chunk_size at a time (one image per task by default), so a slow image does not hold
+    back a whole chunk of the models"""
+    def _plot_functions(self, function_name:str, chunk_size: int = 1, **kwargs) -> None:
 
-        chunk_size = (len(self.models_data) + self.n_workers - 1) // self.n_workers
-        processes = []
+        groups = [(self.directory, self.models_data)]
+        if self.sweep and len(self.models_data):
+            """every park in its own directory"""
+            parks = self.models_data.park
+            groups = [(os.path.join(self.directory, park), self.models_data.where(parks == park)) for park in self.park_list()]
 
-        for i in range(self.n_workers):
-            start_index: int = i * chunk_size
-            end_index: int = start_index + chunk_size
-            processes.append((function_name, self.models_data[start_index: end_index], self.directory, kwargs))
+        processes = [(function_name, models_data[start: start + chunk_size], directory, {**kwargs, "offset": start})
+                     for directory, models_data in groups for start in range(0, len(models_data), chunk_size)]
+
+        if self.n_workers == 1:
+            for process in processes:
+                GridSearch._plot_task(*process)
+            return
 
         with mp.Pool(processes=self.n_workers) as pool:
-            pool.starmap(GridSearch._plot_task, processes)
+            pool.starmap(GridSearch._plot_task, processes, chunksize=1)
 
 
     def plot_heatmaps(self) -> None:
@@ -230,9 +354,17 @@ class GridSearch:
     def get_acc(self) -> None:
         self._plot_functions("_create_acc")
 
+    """raster versions of plot_maps and plot_maps_heats - much faster, without the titles and axes"""
+    def render_maps(self, agents: bool = True, scale: int = 8) -> None:
+        self._plot_functions("_render_maps", agents=agents, scale=scale)
+
+    def render_maps_heats(self, agents: bool = True, scale: int = 8) -> None:
+        self._plot_functions("_render_maps", heat=True, agents=agents, scale=scale)
+
     """creates heatmap plot"""
     @staticmethod
     def get_heatmap(ax: plt.Axes, models_data: dict, alpha: float = 1, ) -> None:
+        import seaborn as sns
 
         heatmap_data = models_data["heatmap"]
 
@@ -250,125 +382,274 @@ class GridSearch:
     """creates map state plot"""
     @staticmethod
     def get_map_state(ax: plt.Axes, models_data: dict, alpha: float = 1, plot_agents: bool = True) -> None:
-
-        def get_cell_color(val: int):
-            if val >= Terrain.SIDEWALK.value:
-                return "grey"
-            elif val == 0:
-                return "black"
-            else:
-                cmap = plt.get_cmap("summer")
-                norm = plt.Normalize(vmin=1, vmax=100)
-                return cmap(norm(val))
+        import matplotlib.pyplot as plt
+        from matplotlib.collections import PatchCollection
+        from utils import rendering
 
         model_map_data = models_data["cells"]
         model_agents_pos = models_data["agents"]
 
-        y, x = model_map_data.shape
-
-        for j in range(y):
-            for i in range(x):
-                color = get_cell_color(model_map_data[j, i])
-                ax.add_patch(plt.Rectangle((j, i), 1, 1, facecolor=color, edgecolor=None, alpha=alpha))
+        """one image coloured with the lookup table (sidewalks grey, obstacles black, grass in the summer colormap)
+        instead of a patch for every cell"""
+        width, height = model_map_data.shape
+        ax.imshow(rendering.map_colors(model_map_data, alpha).transpose(1, 0, 2), origin="lower",
+                  extent=(0, width, 0, height), interpolation="nearest")
 
-        if plot_agents:
-            for (j, i) in model_agents_pos:
-                ax.add_patch(plt.Circle((j, i), 1, facecolor="red", edgecolor=None, alpha=alpha))
+        if plot_agents and len(model_agents_pos):
+            ax.add_collection(PatchCollection([plt.Circle((j, i), 1) for (j, i) in model_agents_pos],
+                                              facecolor="red", edgecolor="none", alpha=alpha))
 
 
 
-    """task for each process - creates models, runs the simulations and returns the simulation data to the queue"""
+    """creates the metric object from its name used in the params"""
     @staticmethod
-    def _run_task(model_params: list[dict], queue: mp.Queue, stop_time: int, models_num: int, counter: mp.Value, lock: mp.Lock) -> None:
-
-        def get_coord_value(i: int, j: int) -> dict:
-            grid = model.grid
-            return grid.GRASS_POPULARITY.data[i,j] + grid.SIDEWALK.data[i,j]
-
-        def get_map_matrix() -> np.array:
-            map_data = np.zeros((model.grid.height, model.grid.width), dtype=np.uint8)
-            for j in range(model.grid.height):
-                for i in range(model.grid.width):
-                    map_data[j, i] = get_coord_value(j,i)
-            return map_data
-
-        models_data = []
-        for model_item in model_params:
-            try:
-                if model_item[2] == "normal":
-                    model_metric = ClosestMetric()
-                elif model_item[2] == "mixed":
-                    model_metric = MixedMetric()
-                elif model_item[2] == "balanced":
-                    model_metric = RandomBalancedMetric()
-                else:
-                    model_metric = AffordanceMetric()
-
-                model = ParkModel(agent_params=model_item[0], seed=model_item[1], metric=model_metric, park_name=model_item[3])
-                model.setup()
-                for _ in range(stop_time):
-                    model.step()
-                models_data.append({"params" : model_item, "heatmap": model.heatmap, "cells": get_map_matrix(), "agents": [agent.cell.coordinate for agent in model.agents], "accuracy" : model.calculate_accuracy(), "metric" : str(model.metric)})
-
-            except Exception as e:
-                print(f"!!! CRASH processing model {model_item}: {e}")
-
-            finally:
-                with counter.get_lock():
-                    counter.value += 1
-                    curr_count = counter.value
-                progress = curr_count / models_num * 100
-
-                curr_pct = int((curr_count / models_num) * 100)
-
-                prev_pct = int(((curr_count - 1) / models_num) * 100)
-
-                """The percentages might not show for samples less than 1000"""
-
-                if curr_pct % 10 == 0 and curr_pct != prev_pct:
-                    with lock:
-                        print(f"""
-                              \033[92m Current progress: {progress:.0f}% ({curr_count}/{models_num})  \033[0m
-                              """)
+    def _create_metric(name: str) -> AbstractMetric:
+        return create_metric(name)
 
+    """key identifying the params of a model in the manifest"""
+    @staticmethod
+    def params_key(model_item: tuple[dict, int, str, str]) -> str:
+        return json.dumps(list(model_item), sort_keys=True)
 
-        queue.put(models_data)
-
-    """creates processes for running simulations and runs the tasks there"""
-    def run_models(self):
-
-        """Multiprocessing stuff so it will return models (cuz u cant pass as ref)"""
-        manager = mp.Manager()
-        results_queue = manager.Queue()
-        chunk_size = (self.samples + self.n_workers - 1) // self.n_workers
-        processes = []
-
-        shared_counter = mp.Value('i', 0)
-        print_lock = mp.Lock()
-
-        for i in range(self.n_workers):
+    """task for a worker - creates one model, runs the simulation until stop_time or until the monitor created from
+    the early_stopping args stops it and returns its compact results or None if the simulation crashed,
+    with warm_start the model is forked from that snapshot. With checkpoints the model continues from its snapshot
+    in that directory if there is one and is saved there when it stops"""
+    @staticmethod
+    def _run_task(model_item: tuple[dict, int, str, str], stop_time: int, early_stopping: dict | None = None,
+                  prune_thresholds=None, profile: bool = False, warm_start: str | None = None,
+                  checkpoints: str | None = None) -> dict | None:
+        try:
+            monitor = None
+            if early_stopping is not None:
+                monitor = ConvergenceMonitor(**early_stopping, prune_thresholds=prune_thresholds)
+            profiler = Profiler(enabled=profile)
+            checkpoint = None
+            if checkpoints is not None:
+                checkpoint = os.path.join(checkpoints, hashlib.sha1(GridSearch.params_key(model_item).encode()).hexdigest() + ".npz")
+            if checkpoint is not None and os.path.exists(checkpoint):
+                model = ParkModel.restore(checkpoint, GridSearch._create_metric(model_item[2]), monitor=monitor, profiler=profiler)
+            elif warm_start is not None:
+                model = ParkModel.restore(warm_start, GridSearch._create_metric(model_item[2]), seed=model_item[1], agent_params=model_item[0], park_name=model_item[3], monitor=monitor, profiler=profiler)
+            else:
+                model = ParkModel(agent_params=model_item[0], seed=model_item[1], metric=GridSearch._create_metric(model_item[2]), park_name=model_item[3], monitor=monitor, profiler=profiler)
+                model.setup()
+            while model.running and model.step_count < stop_time:
+                model.step()
+            if checkpoint is not None:
+                model.snapshot(checkpoint)
+
+            accuracy, created_paths, _ = model.calculate_accuracy()
+            return {
+                "key": GridSearch.params_key(model_item),
+                "params": model_item,
+                "accuracy": float(accuracy),
+                "steps": model.step_count,
+                "stop_reason": model.stop_reason or ConvergenceMonitor.MAX_STEPS,
+                "curve": monitor.accuracy_curve if monitor is not None else [],
+                "profile": profiler.sections,
+                "agents": [agent.cell.coordinate for agent in model.agents],
+                "arrays": {
+                    "heatmap": model.heatmap,
+                    "cells": (model.grid.GRASS_POPULARITY.data + model.grid.SIDEWALK.data).astype(np.uint8),
+                    "created_paths": created_paths.astype(np.uint8),
+                },
+            }
+
+        except Exception as e:
+            print(f"!!! CRASH processing model {model_item}: {e}")
+            return None
+
+    """task for a worker - runs the models of one park together in a BatchParkModel and returns the compact results
+    of every model in the same layout as _run_task, all None if the simulation crashed"""
+    @staticmethod
+    def _run_batch_task(model_items: list[tuple[dict, int, str, str]], stop_time: int,
+                        profile: bool = False) -> list[dict | None]:
+        try:
+            profiler = Profiler(enabled=profile)
+            model = BatchParkModel([(agent_params, seed, metric) for agent_params, seed, metric, _ in model_items],
+                                   park_name=model_items[0][3], profiler=profiler)
+            model.setup()
+            for _ in range(stop_time):
+                model.step()
+
+            """the profile of the whole batch goes with its first model, so it is merged once"""
+            return [{"key": GridSearch.params_key(model_item), "params": model_item, "steps": stop_time,
+                     "stop_reason": ConvergenceMonitor.MAX_STEPS, "curve": [],
+                     "profile": profiler.sections if i == 0 else {}, **result}
+                    for i, (model_item, result) in enumerate(zip(model_items, model.results()))]
+
+        except Exception as e:
+            print(f"!!! CRASH processing batch of {len(model_items)} models on {model_items[0][3]}: {e}")
+            return [None] * len(model_items)
+
+    """splits the models into batches of at most batch_size models on the same park"""
+    def _batches(self, model_items: list[tuple[dict, int, str, str]]) -> list[list[tuple[dict, int, str, str]]]:
+        by_park = {}
+        for model_item in model_items:
+            by_park.setdefault(model_item[3], []).append(model_item)
+        return [items[start: start + self.batch_size] for items in by_park.values()
+                for start in range(0, len(items), self.batch_size)]
 
-            start_index: int = i * chunk_size
-            end_index: int = start_index + chunk_size
+    """
+    Runs the simulations in a pool of workers, each worker gets one model at a time, so long simulations
+    do not hold back the others. Every finished model is appended to the result store in <directory>/runs
+    (see ResultStore) right away, the params and the settings of the search are saved in plan.json. With resume=True
+    an existing plan of a search with the same settings (see plan_config) is used instead of the sampled params and
+    the models already in the store are not run again, so an interrupted search continues where it stopped. A plan of
+    a search with other settings is discarded with the store. Models with the same params are run only once.
+    With batch_size > 1 each worker gets a batch of models on the same park instead (see BatchParkModel).
+    With early_stopping the runs may stop before stop_step (see ConvergenceMonitor), with prune_quantile the pruning
+    thresholds are updated from the accuracy curves of the runs as they finish and shared with the workers.
+    With profile the section timings of the runs are merged into profiler and saved next to the results.
+    With sweep the ranking of the configurations across the parks is updated in runs/leaderboard.csv as the runs finish
+    (see Leaderboard) and written once more when the search ends.
+    The static arrays of the parks are published once in shared memory for all the workers (see SharedTerrain).
+    The adaptive searches run the rounds of models proposed by the sampler instead, only the runs of stop_step steps
+    are stored and the plan is written at the end.
+    models_data is then a lazy list reading the models from the store.
+    """
+    def run_models(self, resume: bool = True):
+        runs_dir = os.path.join(self.directory, "runs")
+        store = ResultStore(runs_dir, params=list(self.model_params))
+        plan_path = os.path.join(runs_dir, "plan.json")
+
+        if self.sampler.adaptive:
+            store.clear()
+            self.params = []
+        else:
+            plan = None
+            if resume and os.path.exists(plan_path):
+                with open(plan_path) as f:
+                    plan = json.load(f)
+                if not isinstance(plan, dict) or plan.get("config") != self.plan_config():
+                    print(f"The plan in {plan_path} was made with other settings, starting the search over")
+                    plan = None
+            if plan is not None:
+                self.params = [tuple(model_item) for model_item in plan["params"]]
+            else:
+                store.clear()
+                self._write_plan(plan_path)
+        finished = store.keys()
+
+        pending = list({self.params_key(model_item): model_item for model_item in self.params
+                        if self.params_key(model_item) not in finished}.values())
+        if self.sweep:
+            """the models of one park go one after another, so the workers mostly stay on the same park"""
+            parks = self.park_list()
+            pending.sort(key=lambda model_item: parks.index(model_item[3]))
+            self.leaderboard = Leaderboard(os.path.join(runs_dir, "leaderboard.csv"), parks)
+            for key, accuracy in zip(store.index["key"], store.index["accuracy"]):
+                self.leaderboard.add(tuple(json.loads(key)), float(accuracy), write=False)
+            self.leaderboard.write()
+        if len(finished):
+            print(f"Resuming: {len(finished)} models already finished, {len(pending)} to run")
+
+        curves = collections.defaultdict(list)
+        stop_reasons = collections.Counter()
+        with contextlib.ExitStack() as stack:
+            thresholds = None
+            if self.early_stopping is not None and self.prune_quantile is not None:
+                thresholds = stack.enter_context(mp.Manager()).dict()
+            """the terrain and the desired paths of the parks are loaded once and shared with the workers"""
+            terrain = stack.enter_context(SharedTerrain(self.parks if isinstance(self.parks, list) else [self.parks]))
+            pool = stack.enter_context(mp.Pool(processes=self.n_workers, initializer=attach, initargs=(terrain,)))
+            if self.leaderboard is not None:
+                stack.callback(self.leaderboard.write)
+
+            def store_result(result: dict) -> None:
+                finished[result["key"]] = store.append(result["key"], result["params"], result["accuracy"], result["agents"], result["arrays"],
+                                                       steps=result["steps"], stop_reason=result["stop_reason"])
+                stop_reasons[result["stop_reason"]] += 1
+                self.profiler.merge(result["profile"])
+                if self.leaderboard is not None:
+                    self.leaderboard.add(result["params"], result["accuracy"])
+                if thresholds is not None:
+                    self._update_thresholds(thresholds, curves, result["curve"])
+
+            if self.sampler.adaptive:
+                self._run_adaptive(pool, thresholds, store_result, runs_dir)
+                self._write_plan(plan_path)
+            else:
+                for curr_count, result in enumerate(self._results(pool, pending, self.stop_step, thresholds), start=1):
+                    if result is not None:
+                        store_result(result)
+                    self._print_progress(curr_count, len(pending))
+
+        if self.early_stopping is not None:
+            print("Stop reasons:", dict(stop_reasons))
+        if self.profile:
+            self.profiler.to_json(os.path.join(runs_dir, "profile.json"))
+            self.profiler.to_csv(os.path.join(runs_dir, "profile.csv"))
+
+        keys = dict.fromkeys(self.params_key(model_item) for model_item in self.params)
+        self.models_data = StoredModels(runs_dir, [finished[key] for key in keys if key in finished])
+
+    """results of the models run for stop_step steps by the workers in the order they finish (None for the crashed ones)"""
+    def _results(self, pool, model_items: list[tuple[dict, int, str, str]], stop_step: int, thresholds,
+                 checkpoints: str | None = None):
+        if self.batch_size > 1:
+            task = functools.partial(GridSearch._run_batch_task, stop_time=stop_step, profile=self.profile)
+            return itertools.chain.from_iterable(pool.imap_unordered(task, self._batches(model_items)))
+        task = functools.partial(GridSearch._run_task, stop_time=stop_step, early_stopping=self.early_stopping,
+                                 prune_thresholds=thresholds, profile=self.profile, warm_start=self.warm_start,
+                                 checkpoints=checkpoints)
+        return pool.imap_unordered(task, model_items)
+
+    """runs the rounds of models proposed by the adaptive sampler, the models run for stop_step steps are stored and
+    added to params, the shorter runs continue from their snapshots in runs/checkpoints in the next rounds"""
+    def _run_adaptive(self, pool, thresholds, store_result, runs_dir: str) -> None:
+        checkpoints = os.path.join(runs_dir, "checkpoints")
+        os.makedirs(checkpoints, exist_ok=True)
+        space = self.space()
+        history = []
+        try:
+            while (proposal := self.sampler.propose(space, self.samples, self.stop_step, history)) is not None:
+                points, steps = proposal
+                model_items = [self.model_item(point) for point in points]
+                print(f"Search round: {len(model_items)} models, {steps} steps")
+                crashed = {self.params_key(model_item): model_item for model_item in model_items}
+                for curr_count, result in enumerate(self._results(pool, model_items, steps, thresholds, checkpoints), start=1):
+                    if result is not None:
+                        crashed.pop(result["key"], None)
+                        history.append((self.model_point(result["params"]), steps, result["accuracy"]))
+                        if steps >= self.stop_step:
+                            store_result(result)
+                            self.params.append(result["params"])
+                    self._print_progress(curr_count, len(model_items))
+                history.extend((self.model_point(model_item), steps, 0.0) for model_item in crashed.values())
+        finally:
+            shutil.rmtree(checkpoints, ignore_errors=True)
 
-            process = mp.Process(target=GridSearch._run_task, args=(self.params[start_index: end_index], results_queue, self.stop_step, self.samples, shared_counter, print_lock))
-            processes.append(process)
-            process.start()
+    @staticmethod
+    def _print_progress(curr_count: int, models_num: int) -> None:
+        progress = curr_count / models_num * 100
 
-        for process in processes:
-            process.join()
+        curr_pct = int((curr_count / models_num) * 100)
 
+        prev_pct = int(((curr_count - 1) / models_num) * 100)
 
-        final_models = []
+        """The percentages might not show for samples less than 1000"""
 
-        while not results_queue.empty():
-            final_models.extend(results_queue.get())
+        if curr_pct % 10 == 0 and curr_pct != prev_pct:
+            print(f"""
+                          \033[92m Current progress: {progress:.0f}% ({curr_count}/{models_num})  \033[0m
+                          """)
 
-        self.models_data = final_models
+    """adds the accuracy curve of a finished run and updates the pruning thresholds of its steps,
+    a threshold is set once at least PRUNE_MIN_RUNS runs reached the step"""
+    def _update_thresholds(self, thresholds, curves: dict[int, list[float]], curve: list[tuple[int, float]]) -> None:
+        for step, accuracy in curve:
+            curves[step].append(accuracy)
+            if len(curves[step]) >= self.PRUNE_MIN_RUNS:
+                thresholds[step] = float(np.quantile(curves[step], self.prune_quantile))
 
     def slice_models(self, acc_thresh: float):
         # acc_thresh max value is 1 - 100% acc
-        self.models_data = [model for model in self.models_data if model['accuracy'][0] >= acc_thresh]
+        if not len(self.models_data):
+            """nothing was run yet, models_data is still the empty list"""
+            return
+        self.models_data = self.models_data.where(self.models_data.accuracy >= acc_thresh)
 
 
     """Checks whether exists the directory for plot directories and the plot directories as well"""
@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from utils import distance_fields
+from utils.distance_fields import euclidean
+from utils.kernels import get_kernels
+from utils.terrain_index import NEIGHBOUR_OFFSETS
+
+if TYPE_CHECKING:
+    from agent import ParkAgent
+    from model import ParkModel
+
+"""
+Array backend of ParkModel - the decisions of all the agents in one step made with the kernels of utils.kernels
+"""
+
+_OFFSETS = np.array(NEIGHBOUR_OFFSETS)
+
+
+class ArrayStepper:
+    """
+        Steps all the agents of a ParkModel at once instead of calling ParkAgent.action for each of them. The state of
+        the agents (positions, targets, subtargets, vision params and weights) is gathered into typed arrays, the
+        subtargets come from VisionEngine.scan_many and the neighbours are ranked by the kernel of the model metric
+        (AbstractMetric.kernel), so the agents take the same cells as with ParkAgent.action.
+
+        The agents are visited in the same shuffled order for the SUBTARGETS layer, nothing is drawn on the VISION
+        layer and ParkAgent.vision_range stays empty even with ParkModel.show_vision.
+
+        :param model: model with the "normal" kind of agents and a metric with a kernel
+        :type model: ParkModel
+
+        :param backend: "numpy" or "numba", see utils.kernels.get_kernels
+        :type backend: str
+    """
+
+    def __init__(self, model: ParkModel, backend: str = "numpy"):
+        if model.kind != "normal":
+            raise ValueError(f"Array backend steps only the normal kind of agents, got {model.kind}")
+        self.kernel = getattr(model.metric, "kernel", None)
+        if self.kernel is None:
+            raise ValueError(f"Metric {model.metric} has no array kernel, use the mesa backend")
+        self.model = model
+        self.kernels = get_kernels(backend)
+        self._fields, self._fields_index = None, None
+
+    def setup(self) -> None:
+        """Takes the gradient maps stacked for the vision of the model, called after ParkModel.setup created them"""
+        self._fields, self._fields_index = self.model.vision.fields, self.model.vision.fields_index
+
+    def _distance_to(self, dx, dy, x, y) -> np.ndarray:
+        return distance_fields.distances_to(self._fields, self._fields_index, dx, dy, x, y)
+
+    def step(self) -> None:
+        model = self.model
+        grid = model.grid
+        """Same draws from model.random as AgentSet.shuffle_do"""
+        agents: list[ParkAgent] = []
+        model.agents.shuffle_do(agents.append)
+        if not agents:
+            return
+
+        position = np.array([agent.cell.coordinate for agent in agents])
+        target = np.array([agent.target.coordinate for agent in agents])
+        subtarget = np.array([agent.subtarget.coordinate if agent.subtarget else (-1, -1) for agent in agents])
+
+        reached = (subtarget == position).all(axis=1)
+        searching = np.flatnonzero(reached | (subtarget[:, 0] < 0))
+        new_subtarget = subtarget.copy()
+        with model.profiler.section("vision"):
+            new_subtarget[searching] = self._select_subtargets([agents[i] for i in searching], position[searching],
+                                                              target[searching])
+
+        """SUBTARGETS updates in the order of ParkAgent.action, the agents may share their subtargets"""
+        for agent, was_reached, (sx, sy) in zip(agents, reached.tolist(), new_subtarget.tolist()):
+            if was_reached:
+                grid.SUBTARGETS.data[agent.subtarget.coordinate] = 0
+                agent.subtarget = None
+            if agent.subtarget is None and sx >= 0:
+                agent.subtarget = grid[(sx, sy)]
+            if agent.subtarget:
+                grid.SUBTARGETS.data[agent.subtarget.coordinate] += 1
+
+        has_subtarget = new_subtarget[:, 0] >= 0
+        destination = np.where(has_subtarget[:, None], new_subtarget, target)
+        with model.profiler.section("metric_ranking"):
+            moves = self._moves(agents, position, target, destination)
+
+        for agent, (x, y) in zip(agents, moves.tolist()):
+            agent.cell = grid[(x, y)]
+            model.occupancy.move(agent)
+            agent.visit(agent.cell)
+        model.occupancy.record_steps(np.array([agent.slot for agent in agents]), moves)
+
+    def _select_subtargets(self, agents: list[ParkAgent], position: np.ndarray, target: np.ndarray) -> np.ndarray:
+        """Best cells (n, 2) the agents see, (-1, -1) for the agents seeing nothing, see ParkAgent.select_subtarget"""
+        best = np.full((len(agents), 2), -1, dtype=np.int64)
+        if not agents:
+            return best
+        popularity = self.model.grid.GRASS_POPULARITY.data[None]
+        cones = np.array([(agent.distance, agent.angle) for agent in agents])
+        tile_weights = np.array([agent.tile_weight for agent in agents], dtype=float)
+        distance_weights = np.array([agent.distance_weight for agent in agents], dtype=float)
+        for distance, angle in np.unique(cones, axis=0).tolist():
+            group = np.flatnonzero((cones[:, 0] == distance) & (cones[:, 1] == angle))
+            best[group] = self.model.vision.scan_many(position[group], target[group], distance, angle,
+                                                      tile_weights[group], distance_weights[group], popularity,
+                                                      np.zeros(len(group), dtype=np.int64))
+        return best
+
+    def _moves(self, agents: list[ParkAgent], position: np.ndarray, target: np.ndarray,
+               destination: np.ndarray) -> np.ndarray:
+        """Cells (n, 2) the agents step to - the neighbour ranked first by the metric or the destination itself"""
+        terrain = self.model.terrain
+        width, height = terrain.width, terrain.height
+        ax, ay = position[:, 0, None], position[:, 1, None]
+        dx, dy = destination[:, 0, None], destination[:, 1, None]
+
+        nx, ny = ax + _OFFSETS[:, 0], ay + _OFFSETS[:, 1]
+        inside = (nx >= 0) & (nx < width) & (ny >= 0) & (ny < height)
+        nx, ny = np.clip(nx, 0, width - 1), np.clip(ny, 0, height - 1)
+        walkable = inside & terrain.walkable[nx, ny]
+        dist = self._distance_to(dx, dy, nx, ny)
+
+        if self.kernel == "closest":
+            choice = self.kernels.closest(dist, walkable)
+        elif self.kernel == "mixed":
+            possible = walkable & ~terrain.margin[nx, ny]
+            cells = nx * self.model.grid.height + ny
+            for i, agent in enumerate(agents):
+                if agent.visited:
+                    possible[i] &= [cell not in agent.visited for cell in cells[i].tolist()]
+            choice = self.kernels.mixed(dist, self._tile_values(nx, ny), possible)
+        else:
+            tx, ty = target[:, 0, None], target[:, 1, None]
+            affordances = self.kernels.affordances(
+                self._tile_values(nx, ny), euclidean(nx, ny, ax, ay), self._distance_to(tx, ty, nx, ny),
+                self._distance_to(tx, ty, ax, ay)[:, 0], np.array([agent.tile_weight for agent in agents], dtype=float),
+                np.array([agent.distance_weight for agent in agents], dtype=float))
+            current = self._distance_to(dx, dy, ax, ay)[:, 0]
+            if self.kernel == "affordance":
+                adjacent = np.maximum(np.abs(dx - ax), np.abs(dy - ay))[:, 0] == 1
+                choice = self.kernels.affordance(dist, current, affordances, walkable, adjacent)
+            else:
+                choice = self.kernels.balanced(dist, current, affordances, walkable)
+
+        picked = np.clip(choice, 0, None)[:, None]
+        moves = np.stack([np.take_along_axis(nx, picked, axis=1)[:, 0], np.take_along_axis(ny, picked, axis=1)[:, 0]], axis=1)
+        return np.where((choice >= 0)[:, None], moves, destination)
+
+    def _tile_values(self, nx: np.ndarray, ny: np.ndarray) -> np.ndarray:
+        terrain = self.model.terrain
+        return terrain.class_values(terrain.tile_class[nx, ny], self.model.grid.GRASS_POPULARITY.data[nx, ny])
@@ -0,0 +1,338 @@
+from __future__ import annotations
+
+import inspect
+import random
+
+import numpy as np
+from scipy.ndimage import binary_dilation, generate_binary_structure
+
+from agent import ParkAgent
+from utils import distance_fields, entrances, grass, images, scoring
+from utils.distance_fields import euclidean
+from utils.kernels import get_kernels
+from utils.occupancy import HISTORY, stuck_mask
+from utils.profiling import Profiler, DISABLED
+from utils.terrain_index import NEIGHBOUR_OFFSETS, TerrainIndex
+from utils.terrains import Terrain
+from utils.vision import VisionEngine
+
+"""
+Headless engine stepping many replicas of the ParkModel on the same park at once
+"""
+
+AGENT_DTYPE = np.dtype([
+    ("replica", np.int32),
+    ("unique_id", np.int32),
+    ("x", np.int32),
+    ("y", np.int32),
+    ("target_x", np.int32),
+    ("target_y", np.int32),
+    # -1 when the agent has no subtarget
+    ("subtarget_x", np.int32),
+    ("subtarget_y", np.int32),
+    # number of steps and the last visited cells (flat indices, -1 for no cell) as in OccupancyIndex
+    ("steps", np.int32),
+    ("recent", np.int64, (HISTORY,)),
+])
+
+"""Default params of the agents, the same as of ParkAgent"""
+AGENT_DEFAULTS = {name: parameter.default for name, parameter in inspect.signature(ParkAgent.__init__).parameters.items()
+                  if parameter.default is not inspect.Parameter.empty}
+
+"""Names of the metrics as in the GridSearch params, other names mean the affordance metric"""
+METRICS = ("normal", "affordance", "balanced", "mixed")
+
+_OFFSETS = np.array(NEIGHBOUR_OFFSETS)
+_PLANE_CROSS = generate_binary_structure(2, 1)[None]
+
+
+class BatchParkModel:
+    """
+        Headless version of the ParkModel running many replicas on the same park in lockstep. The GRASS_POPULARITY
+        layers of the replicas are one stacked (replicas, width, height) array and the agents of all replicas are one
+        structured array (see AGENT_DTYPE), so the terrain is loaded once and every step is a few array operations
+        for all the replicas instead of Python calls for every agent.
+
+        Every replica follows the rules of ParkModel.step, ParkAgent.action and the metrics of utils.step_metrics with
+        its own random generators seeded like the Mesa model, so its heatmap, grass and accuracy are the same as of
+        ParkModel(seed=seed, agent_params=agent_params) with the same metric. Only the "normal" kind of agents is
+        simulated and nothing is drawn on the VISION and SUBTARGETS layers.
+
+        :param replicas: (agent params, seed, metric name) of every replica, metric names as in GridSearch
+        :type replicas: list[tuple[dict, int, str]]
+
+        :param backend: kernels ranking the neighbours, "numpy" or "numba" (see utils.kernels)
+        :type backend: str
+
+        see ParkModel for the rest of the params
+    """
+
+    def __init__(self, replicas: list[tuple[dict, int, str]], width=100, height=100, park_name: str = "doria_pamphil",
+                 grass_decay_rate=0.2, grass_growth_probability=0.3, obstacle_margin_percentage=0.5, grass_rng="numpy",
+                 max_agents=15, geodesic_distance=False, backend="numpy",
+                 profiler: Profiler | None = None, remove_stuck=True):
+        self.park_name = park_name
+        self.width = width
+        self.height = height
+        self.grass_decay_rate = grass_decay_rate
+        self.grass_growth_probability = grass_growth_probability
+        self.obstacle_margin_percentage = obstacle_margin_percentage
+        self.grass_rng = grass_rng
+        self.max_agents = max_agents
+        self.remove_stuck = remove_stuck
+        self.geodesic_distance = geodesic_distance
+        # neighbour ranking kernels, see utils.kernels
+        self.kernels = get_kernels(backend)
+        self.profiler = profiler if profiler is not None else DISABLED
+
+        self.agent_params = [{**AGENT_DEFAULTS, **(agent_params or {})} for agent_params, _, _ in replicas]
+        self.seeds = [seed for _, seed, _ in replicas]
+        self.metrics = np.array([metric if metric in METRICS else "affordance" for _, _, metric in replicas])
+        self.tile_weight = np.array([params["tile_weight"] for params in self.agent_params], dtype=float)
+        self.distance_weight = np.array([params["distance_weight"] for params in self.agent_params], dtype=float)
+
+        """Same generators as mesa.Model(seed=seed) - self.random and self.rng of every replica"""
+        self.random = [random.Random(seed) for seed in self.seeds]
+        self.rng = [np.random.default_rng(seed) for seed in self.seeds]
+
+        self.step_count = 0
+        self.terrain = None
+        self.vision = None
+        self.spawn_cells = None
+        # stacked distance fields of the spawn cells and the index of the field of every cell (-1 for no field)
+        self.gradient_maps = None
+        self._gradient_index = None
+        self.popularity = None
+        self.heatmap = np.zeros((len(replicas), width, height), dtype=np.uint32)
+        self.agents = np.empty(0, dtype=AGENT_DTYPE)
+        # flat indices of the cells entered by every agent (ParkAgent.visited), used by the mixed metric
+        self.visited: list[set[int]] = []
+        self._next_ids = [1] * len(replicas)
+
+    def __len__(self) -> int:
+        return len(self.seeds)
+
+    def setup(self) -> None:
+        size = (self.width, self.height)
+        self.terrain = TerrainIndex.from_park(self.park_name, size)
+        self.spawn_cells = entrances.get_spawn_coordinates(self.park_name, size, self.terrain.free, images.base_size)
+        if self.geodesic_distance:
+            fields = distance_fields.load_distance_fields(self.park_name, size)
+            self.gradient_maps, self._gradient_index = distance_fields.stack_fields(fields, size)
+        self.vision = VisionEngine(self.terrain, self.gradient_maps, self._gradient_index)
+
+        self.popularity = np.zeros((len(self), *size), dtype=int)
+        self.popularity[:, self.terrain.grass] = Terrain.GRASS.value
+        self.spawn_agents(range(len(self)), 3)
+
+    """Spawns agents in the given replicas, same draws as ParkModel.spawn_agents with the cells taken by index"""
+    def spawn_agents(self, replicas, num_agents: int) -> None:
+        cells = range(len(self.spawn_cells))
+        rows = []
+        for replica in replicas:
+            rand = self.random[replica]
+            starting_points = rand.sample(cells, k=num_agents)
+            finish_points = [rand.choice([c for c in cells if c != starting_points[i]]) for i in range(num_agents)]
+            for start, finish in zip(starting_points, finish_points):
+                rows.append((replica, self._next_ids[replica], *self.spawn_cells[start], *self.spawn_cells[finish], -1, -1, 0,
+                             [-1] * HISTORY))
+                self._next_ids[replica] += 1
+
+        self.agents = np.concatenate([self.agents, np.array(rows, dtype=AGENT_DTYPE)])
+        self.visited.extend(set() for _ in rows)
+
+    def remove_agents(self, mask: np.ndarray) -> None:
+        if mask.any():
+            self.visited = [visited for visited, removed in zip(self.visited, mask) if not removed]
+            self.agents = self.agents[~mask]
+
+    def agents_count(self) -> np.ndarray:
+        return np.bincount(self.agents["replica"], minlength=len(self))
+
+    def step(self) -> None:
+        agents = self.agents
+        with self.profiler.section("data_collection"):
+            np.add.at(self.heatmap, (agents["replica"], agents["x"], agents["y"]), 1)
+
+        self.step_count += 1
+        if self.step_count % 10 == 0:
+            self.spawn_agents(np.flatnonzero(self.agents_count() <= self.max_agents), 3)
+
+        if self.remove_stuck:
+            self.remove_agents(stuck_mask(self.agents["steps"], self.agents["recent"]))
+        agents = self.agents
+        self.remove_agents((agents["x"] == agents["target_x"]) & (agents["y"] == agents["target_y"]))
+
+        """AgentSet.shuffle_do draws from self.random, the order itself does not matter as the agents only read
+        the grass during their step"""
+        for rand, count in zip(self.random, self.agents_count()):
+            rand.shuffle([None] * int(count))
+
+        self.move_agents()
+
+        counts = np.zeros(self.popularity.shape, dtype=np.int32)
+        np.add.at(counts, (self.agents["replica"], self.agents["x"], self.agents["y"]), 1)
+        with self.profiler.section("decay"):
+            grass.decay_grass(self.popularity, self.terrain.grass, self.terrain.margin, counts,
+                              self.grass_decay_rate, self.obstacle_margin_percentage)
+        with self.profiler.section("growth"):
+            grass.regrow_grass(self.popularity, self.terrain.grass, self.terrain.margin, counts,
+                               self.grass_growth_probability, self.obstacle_margin_percentage, self._grass_draws)
+
+    """Random numbers for the regrowth, the cells of every replica get the numbers of its own generator"""
+    def _grass_draws(self, cells: np.ndarray) -> np.ndarray:
+        counts = np.bincount(cells // (self.width * self.height), minlength=len(self))
+        if self.grass_rng == "legacy":
+            draws = [[rand.random() for _ in range(count)] for rand, count in zip(self.random, counts)]
+        else:
+            draws = [rng.random(count) for rng, count in zip(self.rng, counts)]
+        return np.concatenate([np.asarray(draw, dtype=float) for draw in draws])
+
+    """ParkAgent.action of all the agents at once"""
+    def move_agents(self) -> None:
+        agents = self.agents
+        reached = (agents["subtarget_x"] == agents["x"]) & (agents["subtarget_y"] == agents["y"])
+        agents["subtarget_x"][reached] = -1
+        agents["subtarget_y"][reached] = -1
+
+        with self.profiler.section("vision"):
+            self._select_subtargets(np.flatnonzero(agents["subtarget_x"] < 0))
+
+        has_subtarget = agents["subtarget_x"] >= 0
+        dx = np.where(has_subtarget, agents["subtarget_x"], agents["target_x"])
+        dy = np.where(has_subtarget, agents["subtarget_y"], agents["target_y"])
+
+        x, y = agents["x"].copy(), agents["y"].copy()
+        for metric, select in (("normal", self._closest), ("affordance", self._affordance_metric),
+                               ("balanced", self._balanced), ("mixed", self._mixed)):
+            rows = np.flatnonzero(self.metrics[agents["replica"]] == metric)
+            if len(rows) == 0:
+                continue
+            with self.profiler.section("metric_ranking"):
+                nx, ny, walkable = self._neighbourhood(rows)
+                choice = select(rows, dx[rows, None], dy[rows, None], nx, ny, walkable)
+
+            """Without any possible cell the agent goes straight to its destination"""
+            moves = choice >= 0
+            picked = np.clip(choice, 0, None)[:, None]
+            x[rows] = np.where(moves, np.take_along_axis(nx, picked, axis=1)[:, 0], dx[rows])
+            y[rows] = np.where(moves, np.take_along_axis(ny, picked, axis=1)[:, 0], dy[rows])
+
+        agents["x"], agents["y"] = x, y
+        agents["recent"][np.arange(len(agents)), agents["steps"] % HISTORY] = x * self.height + y
+        agents["steps"] += 1
+        for visited, cell in zip(self.visited, (x * self.height + y).tolist()):
+            visited.add(cell)
+
+    """Subtargets of the agents chosen by VisionEngine with the grass of their replicas, the agents with the same
+    vision distance and angle are scanned together"""
+    def _select_subtargets(self, rows: np.ndarray) -> None:
+        agents = self.agents[rows]
+        replicas = agents["replica"]
+        cones = np.array([(self.agent_params[replica]["distance"], self.agent_params[replica]["angle"])
+                          for replica in replicas.tolist()]).reshape(-1, 2)
+
+        for distance, angle in np.unique(cones, axis=0).tolist():
+            group = np.flatnonzero((cones[:, 0] == distance) & (cones[:, 1] == angle))
+            best = self.vision.scan_many(np.stack([agents["x"][group], agents["y"][group]], axis=1),
+                                         np.stack([agents["target_x"][group], agents["target_y"][group]], axis=1),
+                                         distance, angle, self.tile_weight[replicas[group]],
+                                         self.distance_weight[replicas[group]], self.popularity, replicas[group])
+            self.agents["subtarget_x"][rows[group]] = best[:, 0]
+            self.agents["subtarget_y"][rows[group]] = best[:, 1]
+
+    """Coordinates (rows, 8) of the neighbours of the agents in the neighbourhood order and the mask of the walkable
+    ones, coordinates outside the grid are clipped to the edge and never walkable"""
+    def _neighbourhood(self, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        nx = self.agents["x"][rows, None] + _OFFSETS[:, 0]
+        ny = self.agents["y"][rows, None] + _OFFSETS[:, 1]
+        inside = (nx >= 0) & (nx < self.width) & (ny >= 0) & (ny < self.height)
+        nx, ny = np.clip(nx, 0, self.width - 1), np.clip(ny, 0, self.height - 1)
+        return nx, ny, inside & self.terrain.walkable[nx, ny]
+
+    """TerrainIndex.tile_value of the cells with the grass of the agents replicas"""
+    def _tile_values(self, rows: np.ndarray, nx: np.ndarray, ny: np.ndarray) -> np.ndarray:
+        return self.terrain.class_values(self.terrain.tile_class[nx, ny],
+                                         self.popularity[self.agents["replica"][rows, None], nx, ny])
+
+    """ParkModel.distance_to of the cells (x, y) to the destinations (dx, dy)"""
+    def _distance_to(self, dx: np.ndarray, dy: np.ndarray, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        return distance_fields.distances_to(self.gradient_maps, self._gradient_index, dx, dy, x, y)
+
+    """AbstractMetric.affordance of the cells"""
+    def _affordances(self, rows: np.ndarray, nx: np.ndarray, ny: np.ndarray) -> np.ndarray:
+        agents = self.agents[rows]
+        replicas = agents["replica"]
+        ax, ay = agents["x"][:, None], agents["y"][:, None]
+        tx, ty = agents["target_x"][:, None], agents["target_y"][:, None]
+        return self.kernels.affordances(self._tile_values(rows, nx, ny), euclidean(nx, ny, ax, ay),
+                                        self._distance_to(tx, ty, nx, ny), self._distance_to(tx, ty, ax, ay)[:, 0],
+                                        self.tile_weight[replicas], self.distance_weight[replicas])
+
+    """
+    The metrics below return the column of the neighbour picked by get_cells_rank of the metric for every agent,
+    -1 when the metric sends the agent to its destination, see utils.kernels
+    """
+
+    def _closest(self, rows, dx, dy, nx, ny, walkable) -> np.ndarray:
+        return self.kernels.closest(self._distance_to(dx, dy, nx, ny), walkable)
+
+    def _affordance_metric(self, rows, dx, dy, nx, ny, walkable) -> np.ndarray:
+        ax, ay = self.agents["x"][rows, None], self.agents["y"][rows, None]
+        adjacent = np.maximum(np.abs(dx - ax), np.abs(dy - ay))[:, 0] == 1
+        return self.kernels.affordance(self._distance_to(dx, dy, nx, ny), self._distance_to(dx, dy, ax, ay)[:, 0],
+                                       self._affordances(rows, nx, ny), walkable, adjacent)
+
+    def _balanced(self, rows, dx, dy, nx, ny, walkable) -> np.ndarray:
+        ax, ay = self.agents["x"][rows, None], self.agents["y"][rows, None]
+        return self.kernels.balanced(self._distance_to(dx, dy, nx, ny), self._distance_to(dx, dy, ax, ay)[:, 0],
+                                     self._affordances(rows, nx, ny), walkable)
+
+    def _mixed(self, rows, dx, dy, nx, ny, walkable) -> np.ndarray:
+        possible = walkable & ~self.terrain.margin[nx, ny]
+        cells = nx * self.height + ny
+        for i, row in enumerate(rows.tolist()):
+            visited = self.visited[row]
+            if visited:
+                possible[i] &= [cell not in visited for cell in cells[i].tolist()]
+        return self.kernels.mixed(self._distance_to(dx, dy, nx, ny), self._tile_values(rows, nx, ny), possible)
+
+    def accuracy(self, include_dilatation=True) -> np.ndarray:
+        """ParkModel.accuracy of every replica"""
+        return scoring.accuracy(self.popularity, scoring.reference_mask(self.park_name, (self.width, self.height)),
+                                dilation=int(include_dilatation))
+
+    def score(self, thresholds=(scoring.ACCURACY_THRESHOLD,), dilations=(1,)) -> dict[str, np.ndarray]:
+        """ParkModel.score of every replica, the scores have shape (thresholds, dilations, replicas)"""
+        return scoring.score(self.popularity, scoring.reference_mask(self.park_name, (self.width, self.height)),
+                             thresholds, dilations)
+
+    def calculate_accuracy(self, include_dilatation=True) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ParkModel.calculate_accuracy of every replica - (replicas,) accuracies, (replicas, height, width) created
+        paths and the reference paths"""
+        created_paths = np.rot90(self.popularity > 10, k=1, axes=(1, 2))
+        if include_dilatation:
+            created_paths = binary_dilation(created_paths, structure=_PLANE_CROSS)
+        created_paths = created_paths.astype(int)
+        reference_paths = images.load_reference_paths(self.park_name, (self.width, self.height))
+        mask = reference_paths == 1
+        accuracy = np.sum(created_paths[:, mask] == 1, axis=1) / np.sum(mask)
+        return accuracy, created_paths, reference_paths
+
+    def results(self) -> list[dict]:
+        """Accuracy, final agents positions and the arrays of every replica in the layout of the GridSearch results"""
+        accuracy, created_paths, _ = self.calculate_accuracy()
+        cells = (self.popularity + np.where(self.terrain.sidewalk, Terrain.SIDEWALK.value, 0)).astype(np.uint8)
+        agents = [[] for _ in range(len(self))]
+        for replica, x, y in zip(*(self.agents[field].tolist() for field in ("replica", "x", "y"))):
+            agents[replica].append((x, y))
+
+        return [{
+            "accuracy": float(accuracy[replica]),
+            "agents": agents[replica],
+            "arrays": {
+                "heatmap": self.heatmap[replica],
+                "cells": cells[replica],
+                "created_paths": created_paths[replica].astype(np.uint8),
+            },
+        } for replica in range(len(self))]
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+from collections.abc import Mapping
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from model import ParkModel
+
+"""
+Early stopping of the simulations which stopped changing or fell behind the other runs
+"""
+
+
+class ConvergenceMonitor:
+    """
+        Watches a ParkModel and stops it (model.running = False, model.stop_reason set) when the run converged or is
+        hopeless. Every interval steps it records the mean change of GRASS_POPULARITY per grass cell and step since
+        the previous observation and the accuracy of the model, the records are kept in history.
+
+        The run plateaus when for patience observations in a row the change stays under popularity_tolerance and the
+        accuracy does not get better than the best one so far by accuracy_tolerance. The run is pruned when its
+        accuracy is under the threshold prune_thresholds gives for the step (steps without a threshold are skipped),
+        e.g. a quantile of the accuracies other runs had at that step. No run is stopped before min_steps.
+
+        One monitor watches one model.
+
+        :param interval: number of steps between the observations
+        :type interval: int
+
+        :param patience: number of observations in a row without a change needed for the plateau
+        :type patience: int
+
+        :param min_steps: the first step the run can be stopped at
+        :type min_steps: int
+
+        :param popularity_tolerance: mean change of the grass popularity per cell and step treated as no change
+        :type popularity_tolerance: float
+
+        :param accuracy_tolerance: accuracy gain treated as no change
+        :type accuracy_tolerance: float
+
+        :param prune_thresholds: step -> minimal accuracy of the run at that step
+        :type prune_thresholds: Mapping[int, float] | None
+    """
+    PLATEAU, PRUNED, MAX_STEPS = "plateau", "pruned", "max_steps"
+
+    def __init__(self, interval: int = 10, patience: int = 20, min_steps: int = 200, popularity_tolerance: float = 5e-4,
+                 accuracy_tolerance: float = 1e-3, prune_thresholds: Mapping[int, float] | None = None):
+        self.interval = interval
+        self.patience = patience
+        self.min_steps = min_steps
+        self.popularity_tolerance = popularity_tolerance
+        self.accuracy_tolerance = accuracy_tolerance
+        self.prune_thresholds = prune_thresholds
+        self.history: list[tuple[int, float, float]] = []
+        self.best_accuracy = -np.inf
+        self.stale = 0
+        self._previous = None
+
+    def observe(self, model: ParkModel) -> str | None:
+        """Records the state of the model, returns the stop reason if the model was stopped"""
+        popularity = model.grid.GRASS_POPULARITY.data
+        if self._previous is None:
+            change = np.inf
+        else:
+            steps = model.step_count - self.history[-1][0]
+            change = float(np.abs(popularity - self._previous)[model.terrain.grass].mean()) / steps
+        self._previous = popularity.copy()
+
+        accuracy = float(model.accuracy())
+        self.history.append((model.step_count, change, accuracy))
+
+        if accuracy > self.best_accuracy + self.accuracy_tolerance or change >= self.popularity_tolerance:
+            self.stale = 0
+        else:
+            self.stale += 1
+        self.best_accuracy = max(self.best_accuracy, accuracy)
+
+        if model.step_count < self.min_steps:
+            return None
+
+        reason = None
+        threshold = self.prune_thresholds.get(model.step_count) if self.prune_thresholds is not None else None
+        if threshold is not None and accuracy < threshold:
+            reason = self.PRUNED
+        elif self.stale >= self.patience:
+            reason = self.PLATEAU
+
+        if reason is not None:
+            model.running = False
+            model.stop_reason = reason
+        return reason
+
+    @property
+    def accuracy_curve(self) -> list[tuple[int, float]]:
+        """(step, accuracy) of the observations"""
+        return [(step, accuracy) for step, _, accuracy in self.history]
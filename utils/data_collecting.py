@@ -1,4 +1,212 @@
+import csv
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
 
 def gather_steps(model) -> list[tuple[int, int]]:
     return [agent.cell.coordinate for agent in model.agents]
 
+
+class TrajectoryRecorder:
+    """
+        Incremental recorder of the agents positions. Every step adds the positions to the heatmap and appends
+        them as (step, agent_id, x, y) rows to a preallocated history which grows by doubling when full - the steps
+        and the agents ids are kept as int32, the coordinates as int16.
+
+        :param heatmap: array the visits are accumulated into (modified in place)
+        :type heatmap: np.ndarray
+
+        :param capacity: number of rows allocated up front
+        :type capacity: int
+    """
+    COLUMNS = ("step", "agent_id", "x", "y")
+
+    def __init__(self, heatmap: np.ndarray, capacity: int = 4096):
+        self.heatmap = heatmap
+        # (step, agent_id) and (x, y) of the rows
+        self.ids = np.empty((capacity, 2), dtype=np.int32)
+        self.cells = np.empty((capacity, 2), dtype=np.int16)
+        self.size = 0
+
+    def _reserve(self, rows: int) -> None:
+        if self.size + rows > len(self.ids):
+            capacity = max(2 * len(self.ids), self.size + rows)
+            for name in ("ids", "cells"):
+                array = getattr(self, name)
+                grown = np.empty((capacity, 2), dtype=array.dtype)
+                grown[:self.size] = array[:self.size]
+                setattr(self, name, grown)
+
+    def record(self, step: int, agents) -> None:
+        rows = np.array([(step, agent.unique_id, *agent.cell.coordinate) for agent in agents], dtype=np.int64)
+        if len(rows) == 0:
+            return
+        if rows[:, :2].max() > np.iinfo(np.int32).max:
+            raise OverflowError(f"Step {step} or agents ids do not fit into the int32 history")
+
+        self._reserve(len(rows))
+        end = self.size + len(rows)
+        self.ids[self.size: end] = rows[:, :2]
+        self.cells[self.size: end] = rows[:, 2:]
+        self.size = end
+        np.add.at(self.heatmap, (rows[:, 2], rows[:, 3]), 1)
+
+    def load(self, history: np.ndarray) -> None:
+        """Replaces the recorded rows with history, the heatmap is not changed"""
+        self.size = 0
+        self._reserve(len(history))
+        self.ids[:len(history)] = history[:, :2]
+        self.cells[:len(history)] = history[:, 2:]
+        self.size = len(history)
+
+    @property
+    def history(self) -> np.ndarray:
+        """Recorded (step, agent_id, x, y) rows as int32"""
+        return np.concatenate([self.ids[:self.size], self.cells[:self.size]], axis=1)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(self.history, columns=list(self.COLUMNS))
+
+    def steps_dataframe(self) -> pd.DataFrame:
+        """Same layout as DataCollector model vars with gather_steps - one row per step with the list of coordinates
+        (steps without any agent are skipped)"""
+        history = self.history
+        steps, starts = np.unique(history[:, 0], return_index=True)
+        chunks = np.split(history[:, 2:], starts[1:])
+        return pd.DataFrame({"Steps": [list(map(tuple, chunk.tolist())) for chunk in chunks]}, index=steps)
+
+
+class TripExporter:
+    """
+        Streams the trips of the agents to a directory - the step stamped positions of every agent are kept while it
+        walks, every open_chunk of them are appended to the spill file of the trip (open/<trip>.bin), and when the
+        agent is removed (arrived, stuck) its trip goes to the export buffer, which is flushed once it holds
+        chunk_size points. The points of all trips are appended to points.bin (POINT_DTYPE rows, one trip after
+        another, the spilled points copied in front of the rest) and the trips are indexed in trips.csv (entrances,
+        first and last step, outcome, offset and length of the points) after their points are written, so the memory
+        holds at most open_chunk points of every walking agent and chunk_size buffered points however long the run is.
+        Read the export with load_trips.
+
+        :param directory: directory of the export, created if it does not exist, new trips are appended to it
+        :type directory: str
+
+        :param chunk_size: number of points of the finished trips buffered before they are written
+        :type chunk_size: int
+
+        :param open_chunk: number of points of a walking agent kept in memory before they are spilled
+        :type open_chunk: int
+    """
+    POINT_DTYPE = np.dtype([("trip", np.int32), ("step", np.int32), ("x", np.int16), ("y", np.int16)])
+    COLUMNS = ("trip", "origin_x", "origin_y", "target_x", "target_y", "start_step", "end_step", "outcome", "offset",
+               "length")
+    ARRIVED, STUCK, UNFINISHED = "arrived", "stuck", "unfinished"
+
+    def __init__(self, directory: str, chunk_size: int = 65536, open_chunk: int = 1024):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.open_chunk = open_chunk
+        os.makedirs(directory, exist_ok=True)
+        self.points_path = os.path.join(directory, "points.bin")
+        self.index_path = os.path.join(directory, "trips.csv")
+        self.open_directory = os.path.join(directory, "open")
+        # spill files left by a run which was not closed, their trips were never indexed
+        shutil.rmtree(self.open_directory, ignore_errors=True)
+        self._offset = os.path.getsize(self.points_path) // self.POINT_DTYPE.itemsize \
+            if os.path.exists(self.points_path) else 0
+        # (step, x, y) of the agents still walking
+        self._open: dict[int, list[tuple[int, int, int]]] = {}
+        # number of spilled points and first step of the walking agents with a spill file
+        self._spilled: dict[int, tuple[int, int]] = {}
+        self._points: list[np.ndarray] = []
+        self._rows: list[list] = []
+        self._buffered = 0
+
+    def record(self, step: int, agents) -> None:
+        for agent in agents:
+            points = self._open.get(agent.unique_id)
+            if points is None:
+                points = self._open[agent.unique_id] = []
+            points.append((step, *agent.cell.coordinate))
+            if len(points) >= self.open_chunk:
+                self._spill(agent.unique_id, points)
+
+    def _spill_path(self, trip: int) -> str:
+        return os.path.join(self.open_directory, f"{trip}.bin")
+
+    def _to_points(self, trip: int, walked: list[tuple[int, int, int]]) -> np.ndarray:
+        points = np.empty(len(walked), dtype=self.POINT_DTYPE)
+        points["trip"] = trip
+        if walked:
+            points["step"], points["x"], points["y"] = np.array(walked).T
+        return points
+
+    def _spill(self, trip: int, walked: list[tuple[int, int, int]]) -> None:
+        """Appends the points of the walking agent to its spill file and empties them"""
+        spilled, start_step = self._spilled.get(trip, (0, walked[0][0]))
+        os.makedirs(self.open_directory, exist_ok=True)
+        with open(self._spill_path(trip), "ab") as f:
+            self._to_points(trip, walked).tofile(f)
+        self._spilled[trip] = (spilled + len(walked), start_step)
+        walked.clear()
+
+    def _write_spilled(self, trip: int) -> None:
+        """Copies the spill file of the trip to points.bin after the buffer, so the rest of its points follow it"""
+        self.flush()
+        path = self._spill_path(trip)
+        with open(path, "rb") as spill, open(self.points_path, "ab") as f:
+            shutil.copyfileobj(spill, f)
+        self._offset += os.path.getsize(path) // self.POINT_DTYPE.itemsize
+        os.remove(path)
+
+    def finish(self, agent, step: int, outcome: str) -> None:
+        """Moves the trip of the removed agent to the buffer"""
+        walked = self._open.pop(agent.unique_id, [])
+        points = self._to_points(agent.unique_id, walked)
+        start_step = walked[0][0] if walked else step
+        spilled = 0
+        if agent.unique_id in self._spilled:
+            spilled, start_step = self._spilled.pop(agent.unique_id)
+            self._write_spilled(agent.unique_id)
+        self._rows.append([agent.unique_id, *agent.origin.coordinate, *agent.target.coordinate, start_step, step,
+                           outcome, self._offset + self._buffered - spilled, spilled + len(points)])
+        self._points.append(points)
+        self._buffered += len(points)
+        if self._buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._rows:
+            return
+        with open(self.points_path, "ab") as f:
+            np.concatenate(self._points).tofile(f)
+        new_index = not os.path.exists(self.index_path)
+        with open(self.index_path, "a", newline="") as f:
+            writer = csv.writer(f)
+            if new_index:
+                writer.writerow(self.COLUMNS)
+            writer.writerows(self._rows)
+        self._offset += self._buffered
+        self._points, self._rows, self._buffered = [], [], 0
+
+    def close(self, agents, step: int) -> None:
+        """Writes the trips of the agents still walking as unfinished and the rest of the buffer"""
+        for agent in agents:
+            self.finish(agent, step, self.UNFINISHED)
+        self.flush()
+
+
+def load_trips(directory: str) -> tuple[pd.DataFrame, np.ndarray]:
+    """Index of the trips written by TripExporter and their points (read only np.memmap), the points of a trip are
+    points[offset: offset + length]. A directory without trips (no trip finished or the trips were not closed) gives
+    an empty index."""
+    index_path = os.path.join(directory, "trips.csv")
+    if not os.path.exists(index_path):
+        return pd.DataFrame(columns=list(TripExporter.COLUMNS)), np.empty(0, dtype=TripExporter.POINT_DTYPE)
+    trips = pd.read_csv(index_path)
+    points_path = os.path.join(directory, "points.bin")
+    if not os.path.exists(points_path) or os.path.getsize(points_path) == 0:
+        return trips, np.empty(0, dtype=TripExporter.POINT_DTYPE)
+    return trips, np.memmap(points_path, dtype=TripExporter.POINT_DTYPE, mode="r")
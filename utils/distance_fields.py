@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import functools
+import hashlib
+import math
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from utils import entrances, images
+from utils.terrains import Terrain
+
+"""
+Geodesic distance fields - length of the shortest walk over the walkable cells (sidewalk or grass, steps to the
+8 neighbours, diagonal ones of sqrt(2)) from every cell to a park entrance. Unlike the straight line distance
+it goes around the obstacles. Cells the entrance cannot be reached from have the distance inf.
+"""
+
+# (dx, dy, length) of the steps, the opposite steps are the same edges of the undirected graph
+_STEPS = ((1, 0, 1.0), (0, 1, 1.0), (1, 1, math.sqrt(2)), (1, -1, math.sqrt(2)))
+
+
+def walk_graph(walkable: np.ndarray):
+    """Sparse graph of the steps between the walkable cells of the (width, height) mask, nodes are the flat indices"""
+    width, height = walkable.shape
+    index = np.arange(walkable.size).reshape(walkable.shape)
+    rows, cols, lengths = [], [], []
+    for dx, dy, length in _STEPS:
+        xs = slice(0, width - dx)
+        ys = slice(max(-dy, 0), height - max(dy, 0))
+        moved_ys = slice(max(dy, 0), height - max(-dy, 0))
+        both = walkable[xs, ys] & walkable[dx:, moved_ys]
+        rows.append(index[xs, ys][both])
+        cols.append(index[dx:, moved_ys][both])
+        lengths.append(np.full(np.count_nonzero(both), length))
+    rows, cols, lengths = np.concatenate(rows), np.concatenate(cols), np.concatenate(lengths)
+    return coo_matrix((lengths, (rows, cols)), shape=(walkable.size, walkable.size)).tocsr()
+
+
+def distance_fields(walkable: np.ndarray, sources: list[tuple[int, int]]) -> np.ndarray:
+    """(len(sources), width, height) geodesic distances to every source cell, all sources in one Dijkstra call"""
+    if not sources:
+        return np.empty((0, *walkable.shape))
+    indices = np.ravel_multi_index(tuple(np.array(sources).T), walkable.shape)
+    fields = dijkstra(walk_graph(walkable), directed=False, indices=indices)
+    return fields.reshape(len(sources), *walkable.shape)
+
+
+@functools.lru_cache(maxsize=None)
+def load_distance_fields(park_name: str, size: tuple[int, int] = images.base_size) -> dict[tuple[int, int], np.ndarray]:
+    """
+        Geodesic distance field of every spawn cell of the park (see entrances.get_spawn_coordinates) on the grid
+        of the given (width, height) size. Cached on disk next to the terrain and in memory for the process
+        lifetime - the returned arrays are read only.
+    """
+    coords, _ = images.load_terrain(park_name, size)
+    walkable = (coords == Terrain.SIDEWALK.value) | (coords == Terrain.GRASS.value)
+    sources = entrances.get_spawn_coordinates(park_name, size, coords != Terrain.OBSTACLE.value, images.base_size)
+
+    def build() -> dict[str, np.ndarray]:
+        return {"fields": distance_fields(walkable, sources)}
+
+    source = images.images[park_name] if size == images.base_size else images.high_resolution_images[park_name]
+    fields = images.cached_arrays(fields_name(park_name, size, sources), source, build)["fields"]
+    return dict(zip(sources, fields))
+
+
+def fields_name(park_name: str, size: tuple[int, int], sources: list[tuple[int, int]]) -> str:
+    """The spawn cells are a part of the cache name, so the fields are rebuilt after the entrances change"""
+    sources_digest = hashlib.sha1(np.array(sources, dtype=np.int64).tobytes()).hexdigest()[:8]
+    return f"{park_name}_geodesic_{size[0]}x{size[1]}_{sources_digest}"
+
+
+def euclidean(x1: np.ndarray, y1: np.ndarray, x2: np.ndarray, y2: np.ndarray) -> np.ndarray:
+    """Element-wise utils.terrain_index.distance"""
+    return np.sqrt(((x1 - x2) * (x1 - x2) + (y1 - y2) * (y1 - y2)).astype(float))
+
+
+def stack_fields(fields: dict[tuple[int, int], np.ndarray], size: tuple[int, int]) -> tuple[np.ndarray, np.ndarray]:
+    """The fields (see load_distance_fields) as one (fields, width, height) array and the (width, height) index
+    of the field of every cell, -1 for the cells without one"""
+    stack = np.stack(list(fields.values())) if fields else np.empty((0, *size))
+    index = np.full(size, -1)
+    for i, coordinate in enumerate(fields):
+        index[coordinate] = i
+    return stack, index
+
+
+def distances_to(stack: np.ndarray | None, index: np.ndarray | None, dx: np.ndarray, dy: np.ndarray,
+                 x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Element-wise ParkModel.distance_to from the cells (x, y) to the cells (dx, dy) with the stacked fields,
+    euclidean distances without them"""
+    dist = euclidean(dx, dy, x, y)
+    if stack is None:
+        return dist
+    field, x, y = np.broadcast_arrays(index[dx, dy], x, y)
+    known = field >= 0
+    geodesic = stack[field[known], x[known], y[known]]
+    dist[known] = np.where(np.isinf(geodesic), dist[known], geodesic)
+    return dist
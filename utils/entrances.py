@@ -125,3 +125,38 @@ entrances_map = {"doria_pamphil": [
     (92,99), (93,99), (94,99), (95,99)
 ]
 }
+
+
+def scale_entrance(coordinate: tuple[int, int], size: tuple[int, int], base_size: tuple[int, int] = (100, 100)) -> list[tuple[int, int]]:
+    """
+    Cells covering the entrance cell of the base raster on a grid of the given (width, height) size,
+    entrances lying on the edge of the base raster stay on the edge of the new grid
+    """
+    axes = []
+    for c, n, b in zip(coordinate, size, base_size):
+        if c == 0:
+            axes.append([0])
+        elif c == b - 1:
+            axes.append([n - 1])
+        else:
+            start = c * n // b
+            axes.append(list(range(start, max((c + 1) * n // b, start + 1))))
+    return [(x, y) for x in axes[0] for y in axes[1]]
+
+
+def get_entrances(park_name: str, size: tuple[int, int], base_size: tuple[int, int] = (100, 100)) -> list[tuple[int, int]]:
+    """Entrances of the park rescaled to the grid of the given (width, height) size"""
+    if size == base_size:
+        return list(entrances_map[park_name])
+    return sorted({cell for coordinate in entrances_map[park_name] for cell in scale_entrance(coordinate, size, base_size)})
+
+
+def get_spawn_coordinates(park_name: str, size: tuple[int, int], free, base_size: tuple[int, int] = (100, 100)) -> list[tuple[int, int]]:
+    """
+    Sorted cells the agents spawn at - the entrances of the park, without the obstacles (free is the mask of the cells
+    without obstacles), rescaled entrances may cover obstacles next to the original entrance cell
+    """
+    coordinates = sorted(set(get_entrances(park_name, size, base_size)))
+    if size != base_size:
+        coordinates = [coordinate for coordinate in coordinates if free[coordinate]]
+    return coordinates
@@ -0,0 +1,51 @@
+import numpy as np
+
+"""
+Vectorized grass dynamics - decay of the trampled cells and regrowth of the remaining ones.
+Both functions work in place on the GRASS_POPULARITY layer data, or on a stack of the layers (replicas, width, height)
+with the counts of the same shape and the terrain masks of one layer.
+"""
+
+
+def decay_grass(popularity: np.ndarray, grass: np.ndarray, margin: np.ndarray, counts: np.ndarray,
+                decay_rate: float, obstacle_margin_percentage: float) -> None:
+    """
+        Tramples the grass under the agents. Every agent standing on a cell applies the decay once,
+        so the cells with several agents are updated the same number of times, one after another.
+
+        :param popularity: GRASS_POPULARITY layer data
+        :param grass: mask of the grass cells
+        :param margin: mask of the obstacle margin cells
+        :param counts: number of agents on each cell, see OccupancyIndex.counts
+    """
+    for visit in range(1, counts.max(initial=0) + 1):
+        trampled = counts >= visit
+
+        cells = trampled & grass
+        value = popularity[cells]
+        increment = np.maximum(1, np.ceil(decay_rate * value)).astype(popularity.dtype)
+        popularity[cells] = np.where(value + increment > 100, 100, value + increment)
+
+        cells = trampled & margin
+        value = obstacle_margin_percentage * popularity[cells]
+        increment = np.maximum(1, np.ceil(decay_rate * value * obstacle_margin_percentage))
+        popularity[cells] = np.where(value + increment > 40, 40, popularity[cells] + increment)
+
+
+def regrow_grass(popularity: np.ndarray, grass: np.ndarray, margin: np.ndarray, counts: np.ndarray,
+                 growth_probability: float, obstacle_margin_percentage: float, draw) -> None:
+    """
+        Regrows the cells without agents. Only the medium paths (popularity between 40 and 60) of grass
+        cells regrow, each with growth_probability, the obstacle margin cells shrink by obstacle_margin_percentage.
+
+        :param draw: function returning one uniform [0, 1) number for each of the medium cells, called once per step
+                     with the flat indices of the medium cells (increasing, in the row-major order of the array)
+    """
+    free = counts == 0
+
+    medium = np.flatnonzero(grass & free & (popularity > 40) & (popularity < 60))
+    regrown = medium[np.asarray(draw(medium)) < growth_probability]
+    popularity.flat[regrown] -= 5
+
+    cells = margin & free
+    popularity[cells] = (popularity[cells] * obstacle_margin_percentage).astype(popularity.dtype)
@@ -2,8 +2,15 @@
 Function used for preprocessing images - creating grid coordinators
 """
 
+import functools
+import hashlib
+import os
+import tempfile
+
 import cv2
 import numpy as np
+from scipy.ndimage import binary_dilation
+
 from utils.terrains import Terrain
 
 images = {"doria_pamphil": "utils/park_imgs/doria_pamphil.png",
@@ -15,42 +22,148 @@ images = {"doria_pamphil": "utils/park_imgs/doria_pamphil.png",
               "clapham": "utils/park_imgs/clapham.png",
               "hampstead": "utils/park_imgs/hampstead.png"}
 
-def get_coordinates(image):
+high_resolution_images = {"doria_pamphil": "utils/park_imgs/high_resolution/doria_pix.png",
+                          "doria_pamphil_west": "utils/park_imgs/high_resolution/doria_west_pix.png",
+                          "greenwich": "utils/park_imgs/high_resolution/greenwich_pix.png",
+                          "blackheath": "utils/park_imgs/high_resolution/blackheath_pix.png",
+                          "hyde": "utils/park_imgs/high_resolution/hyde_pix.png",
+                          "richmond": "utils/park_imgs/high_resolution/richmond_pix.png",
+                          "clapham": "utils/park_imgs/high_resolution/clapham_pix.png",
+                          "hampstead": "utils/park_imgs/high_resolution/hampstead_pix.png"}
+
+desired_paths_images = {name: f"utils/park_imgs/with_desired_paths/{name}_DP.png" for name in images}
+
+# (width, height) raster of the images, the entrances and the desired paths matrixes
+base_size = (100, 100)
+
+terrain_cache_dir = "utils/terrain_cache"
+
+# arrays published by the parent process in shared memory (see utils.shared_terrain) by their cache name, used
+# instead of the disk cache
+shared_arrays: dict[str, dict[str, np.ndarray]] = {}
+
+"""
+Grid of the given (width, height) size - the base size uses the images above, the other sizes are resampled
+from the high resolution images with nearest neighbour, so no new colors (terrain types) are created on the edges
+"""
+def get_coordinates(image, size: tuple[int, int] = base_size):
     try:
-        path = images[image]
+        path = images[image] if size == base_size else high_resolution_images[image]
     except KeyError:
         print("Image " + image + " not found!")
         return None
 
     img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
     img = img.astype('uint8')
+    if img.shape != size[::-1]:
+        img = cv2.resize(img, size, interpolation=cv2.INTER_NEAREST)
     img = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
 
-    coords = np.zeros((100, 100))
+    return classify_pixels(img)
+
+
+"""Grass for the bright pixels, sidewalk for the grey ones, obstacles for the rest"""
+def classify_pixels(img: np.ndarray) -> np.ndarray:
+    return np.select(
+        [img >= 151, (146 <= img) & (img <= 150)],
+        [Terrain.GRASS.value, Terrain.SIDEWALK.value],
+        Terrain.OBSTACLE.value,
+    ).astype('uint8')
+
+
+"""Grass cells touching an obstacle (8 neighbours)"""
+def obstacle_margin(coords: np.ndarray) -> np.ndarray:
+    obstacles = coords == Terrain.OBSTACLE.value
+    return binary_dilation(obstacles, structure=np.ones((3, 3), dtype=bool)) & (coords == Terrain.GRASS.value)
+
+
+def cached_arrays(name: str, source: str, build) -> dict[str, np.ndarray]:
+    """
+        Arrays returned by build(), cached on disk in terrain_cache_dir under the name and the hash of the source file,
+        so they are built only once (and again after the source changes). The arrays shared by the parent process
+        are returned as they are.
+    """
+    if name in shared_arrays:
+        return shared_arrays[name]
+    with open(source, "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:16]
+    cache_path = os.path.join(terrain_cache_dir, f"{name}_{digest}.npz")
+
+    try:
+        with np.load(cache_path) as cached:
+            arrays = dict(cached)
+    except (FileNotFoundError, ValueError):
+        arrays = build()
+
+        """Temporary file + rename, so parallel workers never read half written cache"""
+        os.makedirs(terrain_cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=terrain_cache_dir, suffix=".npz")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, cache_path)
+
+    for array in arrays.values():
+        array.setflags(write=False)
+    return arrays
+
+
+def terrain_name(image: str, size: tuple[int, int]) -> str:
+    return f"{image}_{size[0]}x{size[1]}"
+
+
+def paths_name(park: str, size: tuple[int, int]) -> str:
+    return f"{park}_paths_{size[0]}x{size[1]}"
 
-    for i in range(100):
-        for j in range(100):
-            if img[i, j] >= 151:
-                coords[i, j] = Terrain.GRASS.value # value for grass
-            elif 146 <= img[i, j] <= 150:
-                coords[i, j] = Terrain.SIDEWALK.value # value for sidewalk
-            else:
-                coords[i, j] = Terrain.OBSTACLE.value # value for obstacles
 
+@functools.lru_cache(maxsize=None)
+def load_terrain(image: str, size: tuple[int, int] = base_size) -> tuple[np.ndarray, np.ndarray]:
+    """
+        Terrain of the park - classified coordinates (see get_coordinates) and the obstacle margin mask of the
+        (width, height) size. Results are cached on disk and in memory for the process lifetime - the returned
+        arrays are read only.
+    """
+    def build() -> dict[str, np.ndarray]:
+        coords = get_coordinates(image, size)
+        return {"coords": coords, "margin": obstacle_margin(coords)}
 
-    return coords.astype('uint8')
+    source = images[image] if size == base_size else high_resolution_images[image]
+    arrays = cached_arrays(terrain_name(image, size), source, build)
+    return arrays["coords"], arrays["margin"]
 
 
-def binarize_desired_paths(path, name):
+@functools.lru_cache(maxsize=None)
+def load_reference_paths(park: str, size: tuple[int, int] = base_size) -> np.ndarray:
+    """
+        Desired paths matrix of the park in the image orientation (height, width) - the base size is read
+        from utils/desired_paths_matrixes, the other sizes are binarized from the images with desired paths.
+        Loaded once per process, the returned array is read only.
+    """
+    if paths_name(park, size) in shared_arrays:
+        return shared_arrays[paths_name(park, size)]["paths"]
+    if size == base_size:
+        paths = np.load(f"utils/desired_paths_matrixes/" + park + ".npy")
+        paths.setflags(write=False)
+        return paths
+
+    def build() -> dict[str, np.ndarray]:
+        return {"paths": binarize(cv2.imread(desired_paths_images[park], cv2.IMREAD_GRAYSCALE), size)}
+
+    return cached_arrays(paths_name(park, size), desired_paths_images[park], build)["paths"]
+
+
+def binarize(img: np.ndarray, size: tuple[int, int] = base_size) -> np.ndarray:
+    img = cv2.resize(img, size, interpolation=cv2.INTER_BITS)
+    return (img > 200).astype('uint8')
+
+
+def binarize_desired_paths(path, name, size: tuple[int, int] = base_size):
     try:
         img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
     except Exception as e:
         print("Error when preprocessing file " + path + ": " + str(e))
         return -1
 
-    img = cv2.resize(img, (100, 100), interpolation=cv2.INTER_BITS)
-
-    binary = (img > 200).astype('uint8')
+    binary = binarize(img, size)
 
     np.save(f"{name}.npy", binary)
 
@@ -0,0 +1,229 @@
+import warnings
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+"""
+Neighbour ranking of the metrics (see utils.step_metrics) for many agents at once. The kernels take (agents, 8) arrays
+of the neighbours in the NEIGHBOUR_OFFSETS order and return the column of the neighbour get_cells_rank of the metric
+puts first, -1 when the metric sends the agent straight to its destination.
+
+NumpyKernels work on whole arrays, NumbaKernels compile loops over the agents with numba, which is optional -
+get_kernels falls back to NumpyKernels when it is not installed.
+"""
+
+BACKENDS = ("numpy", "numba")
+
+
+class NumpyKernels:
+    name = "numpy"
+
+    @staticmethod
+    def first_min(values: np.ndarray, valid: np.ndarray) -> np.ndarray:
+        """Column of the first minimal valid value of every row (what sorted(...)[0] picks), -1 for rows without any"""
+        row_min = np.where(valid, values, np.inf).min(axis=1, initial=np.inf)
+        choice = np.argmax(valid & (values == row_min[:, None]), axis=1)
+        return np.where(valid.any(axis=1), choice, -1)
+
+    @staticmethod
+    def ranks(keys: np.ndarray) -> np.ndarray:
+        """Rank of every value in the stable ascending order of its row"""
+        ranks = np.empty(keys.shape, dtype=np.int64)
+        np.put_along_axis(ranks, np.argsort(keys, axis=1, kind="stable"), np.arange(keys.shape[1])[None], axis=1)
+        return ranks
+
+    @staticmethod
+    def affordances(tile_values: np.ndarray, steps: np.ndarray, to_target: np.ndarray, target_distance: np.ndarray,
+                    tile_weight: np.ndarray, distance_weight: np.ndarray) -> np.ndarray:
+        """
+            AbstractMetric.affordance of the neighbours - tile_values and the distances of the step to the neighbour,
+            from the neighbour to the target (agents, 8), the distance of the agent to the target and its weights (agents,)
+        """
+        distance_diff = steps + to_target - target_distance[:, None]
+        return np.maximum(tile_weight[:, None] * tile_values - distance_diff * distance_weight[:, None], 0)
+
+    @classmethod
+    def closest(cls, dist: np.ndarray, walkable: np.ndarray) -> np.ndarray:
+        """ClosestMetric - dist is the distance of the neighbours to the destination"""
+        return cls.first_min(dist, walkable)
+
+    @classmethod
+    def affordance(cls, dist: np.ndarray, current: np.ndarray, affordances: np.ndarray, walkable: np.ndarray,
+                   adjacent: np.ndarray) -> np.ndarray:
+        """AffordanceMetric - current is the distance of the agent to the destination, adjacent marks the agents
+        next to it"""
+        closer = walkable & (current[:, None] >= dist)
+        choice = cls.first_min(-affordances, closer)
+        choice = np.where(choice < 0, cls.first_min(dist, walkable), choice)
+        return np.where(adjacent, -1, choice)
+
+    @classmethod
+    def balanced(cls, dist: np.ndarray, current: np.ndarray, affordances: np.ndarray, walkable: np.ndarray) -> np.ndarray:
+        """RandomBalancedMetric"""
+        closer = walkable & (current[:, None] >= dist)
+        """Not possible cells are ranked after all the possible ones, so they do not change their ranks"""
+        dist_rank = cls.ranks(np.where(closer, dist, np.inf))
+        aff_rank = cls.ranks(np.where(closer, -affordances, np.inf))
+        """Equal sums keep the order of the distances"""
+        return cls.first_min((dist_rank + aff_rank) * dist.shape[1] + dist_rank, closer)
+
+    @staticmethod
+    def mixed_combination(dist: np.ndarray, tile_values: np.ndarray, possible: np.ndarray) -> np.ndarray:
+        """Scaled distance divided by the scaled tile value of MixedMetric, with the same inf and nan as its _divide"""
+        min_dist = np.where(possible, dist, np.inf).min(axis=1, keepdims=True)
+        min_aff = np.where(possible, tile_values, np.inf).min(axis=1, keepdims=True)
+        d_dist = np.where(possible, dist, -np.inf).max(axis=1, keepdims=True) - min_dist
+        d_aff = np.where(possible, tile_values, -np.inf).max(axis=1, keepdims=True) - min_aff
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dist_scaled = (dist - min_dist) / d_dist
+            return np.where(d_aff == 0, dist_scaled, dist_scaled / ((tile_values - min_aff) / d_aff))
+
+    @classmethod
+    def mixed(cls, dist: np.ndarray, tile_values: np.ndarray, possible: np.ndarray) -> np.ndarray:
+        """MixedMetric - possible marks the walkable neighbours out of the obstacle margin the agent has not visited"""
+        combination = cls.mixed_combination(dist, tile_values, possible)
+        choice = cls.first_min(combination, possible)
+        """sorted puts nan keys in an order depending on the neighbours around them, so those rows are sorted the same way"""
+        for i in np.flatnonzero((np.isnan(combination) & possible).any(axis=1)):
+            columns = np.flatnonzero(possible[i])
+            keys = combination[i, columns].tolist()
+            choice[i] = columns[sorted(range(len(keys)), key=keys.__getitem__)[0]]
+        return choice
+
+
+"""
+Loop versions of the kernels compiled by NumbaKernels, they give the same results as NumpyKernels (and run as plain,
+slow Python without numba)
+"""
+
+
+def _first_min_loop(values, valid):
+    choice = np.full(values.shape[0], -1, dtype=np.int64)
+    for i in range(values.shape[0]):
+        best = np.inf
+        for j in range(values.shape[1]):
+            if valid[i, j] and (choice[i] < 0 or values[i, j] < best):
+                choice[i] = j
+                best = values[i, j]
+    return choice
+
+
+def _ranks_loop(keys):
+    ranks = np.zeros(keys.shape, dtype=np.int64)
+    for i in range(keys.shape[0]):
+        for j in range(keys.shape[1]):
+            for k in range(keys.shape[1]):
+                if keys[i, k] < keys[i, j] or (keys[i, k] == keys[i, j] and k < j):
+                    ranks[i, j] += 1
+    return ranks
+
+
+def _affordances_loop(tile_values, steps, to_target, target_distance, tile_weight, distance_weight):
+    result = np.empty(tile_values.shape)
+    for i in range(tile_values.shape[0]):
+        for j in range(tile_values.shape[1]):
+            distance_diff = steps[i, j] + to_target[i, j] - target_distance[i]
+            result[i, j] = max(tile_weight[i] * tile_values[i, j] - distance_diff * distance_weight[i], 0.0)
+    return result
+
+
+def _affordance_loop(dist, current, affordances, walkable, adjacent):
+    choice = np.full(dist.shape[0], -1, dtype=np.int64)
+    for i in range(dist.shape[0]):
+        if adjacent[i]:
+            continue
+        best = np.inf
+        for j in range(dist.shape[1]):
+            if walkable[i, j] and current[i] >= dist[i, j] and (choice[i] < 0 or -affordances[i, j] < best):
+                choice[i] = j
+                best = -affordances[i, j]
+        if choice[i] < 0:
+            for j in range(dist.shape[1]):
+                if walkable[i, j] and (choice[i] < 0 or dist[i, j] < best):
+                    choice[i] = j
+                    best = dist[i, j]
+    return choice
+
+
+def _balanced_loop(dist, current, affordances, walkable):
+    choice = np.full(dist.shape[0], -1, dtype=np.int64)
+    n = dist.shape[1]
+    for i in range(dist.shape[0]):
+        best = 0
+        for j in range(n):
+            if not (walkable[i, j] and current[i] >= dist[i, j]):
+                continue
+            dist_rank = 0
+            aff_rank = 0
+            for k in range(n):
+                if walkable[i, k] and current[i] >= dist[i, k]:
+                    if dist[i, k] < dist[i, j] or (dist[i, k] == dist[i, j] and k < j):
+                        dist_rank += 1
+                    if affordances[i, k] > affordances[i, j] or (affordances[i, k] == affordances[i, j] and k < j):
+                        aff_rank += 1
+            key = (dist_rank + aff_rank) * n + dist_rank
+            if choice[i] < 0 or key < best:
+                choice[i] = j
+                best = key
+    return choice
+
+
+def _mixed_combination_loop(dist, tile_values, possible):
+    combination = np.empty(dist.shape)
+    for i in range(dist.shape[0]):
+        min_dist, max_dist = np.inf, -np.inf
+        min_aff, max_aff = np.inf, -np.inf
+        for j in range(dist.shape[1]):
+            if possible[i, j]:
+                min_dist, max_dist = min(min_dist, dist[i, j]), max(max_dist, dist[i, j])
+                min_aff, max_aff = min(min_aff, tile_values[i, j]), max(max_aff, tile_values[i, j])
+        d_dist, d_aff = max_dist - min_dist, max_aff - min_aff
+        for j in range(dist.shape[1]):
+            dist_scaled = _divide(dist[i, j] - min_dist, d_dist)
+            if d_aff == 0:
+                combination[i, j] = dist_scaled
+            else:
+                combination[i, j] = _divide(dist_scaled, (tile_values[i, j] - min_aff) / d_aff)
+    return combination
+
+
+def _divide(numerator, denominator):
+    """Division of floats like numpy, without the ZeroDivisionError of plain Python"""
+    if denominator == 0:
+        if numerator == 0 or np.isnan(numerator):
+            return np.nan
+        return np.inf if numerator > 0 else -np.inf
+    return numerator / denominator
+
+
+if numba is not None:
+    _divide = numba.njit(cache=True)(_divide)
+
+
+class NumbaKernels(NumpyKernels):
+    """NumpyKernels with the loops above compiled by numba, only available when numba is installed"""
+    name = "numba"
+
+    if numba is not None:
+        first_min = staticmethod(numba.njit(cache=True)(_first_min_loop))
+        ranks = staticmethod(numba.njit(cache=True)(_ranks_loop))
+        affordances = staticmethod(numba.njit(cache=True)(_affordances_loop))
+        affordance = staticmethod(numba.njit(cache=True)(_affordance_loop))
+        balanced = staticmethod(numba.njit(cache=True)(_balanced_loop))
+        mixed_combination = staticmethod(numba.njit(cache=True)(_mixed_combination_loop))
+
+
+def get_kernels(backend: str = "numpy") -> type[NumpyKernels]:
+    """Kernels of the backend, the numba backend falls back to numpy (with a warning) when numba is not installed"""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+    if backend == "numba":
+        if numba is not None:
+            return NumbaKernels
+        warnings.warn("numba is not installed, falling back to the numpy kernels")
+    return NumpyKernels
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import TYPE_CHECKING
+
+import cv2
+import numpy as np
+from matplotlib.colors import to_rgba
+
+from utils import rendering
+
+if TYPE_CHECKING:
+    from model import ParkModel
+
+"""
+Stepping of a ParkModel in a background thread for the interactive app - the UI draws the frames the thread publishes
+instead of the model itself, so it never waits for the steps and never reads a model in the middle of one
+"""
+
+VISION_COLOR = np.array(to_rgba("yellow"))
+SUBTARGET_COLOR = np.array(to_rgba("turquoise"))
+
+
+class Frame:
+    """
+        Copy of the state of the model the UI draws - map cells (GRASS_POPULARITY + SIDEWALK), heatmap, VISION and
+        SUBTARGETS masks and the agents positions after step steps. version grows with every published frame.
+    """
+    __slots__ = ("version", "step", "cells", "heatmap", "vision", "subtargets", "agents", "_images")
+
+    def __init__(self, version: int, model: ParkModel):
+        grid = model.grid
+        self.version = version
+        self.step = model.step_count
+        self.cells = (grid.GRASS_POPULARITY.data + grid.SIDEWALK.data).astype(np.uint8)
+        self.heatmap = model.heatmap.copy()
+        self.vision = grid.VISION.data == 1
+        self.subtargets = grid.SUBTARGETS.data > 0
+        self.agents = [agent.cell.coordinate for agent in model.agents]
+        self._images = {}
+
+    def image(self, heat: bool = False, scale: int = 6) -> np.ndarray:
+        """RGBA map of the frame (see utils.rendering) with the cells seen by the agents and the subtargets, rendered
+        once per frame"""
+        key = (heat, scale)
+        if key not in self._images:
+            colors = rendering.map_colors(self.cells)
+            if heat:
+                colors = rendering.blend(colors, rendering.heat_colors(self.heatmap), 0.3)
+            colors[self.vision] = rendering.blend(colors[self.vision], VISION_COLOR, 1 / 3)
+            colors[self.subtargets] = SUBTARGET_COLOR
+            self._images[key] = rendering.to_image(colors, scale, self.agents)
+        return self._images[key]
+
+    def png(self, heat: bool = False, scale: int = 6) -> bytes:
+        return cv2.imencode(".png", cv2.cvtColor(self.image(heat, scale), cv2.COLOR_RGBA2BGRA))[1].tobytes()
+
+
+class LiveRunner:
+    """
+        Steps the model in a daemon thread as fast as it can while playing and publishes a Frame at most every
+        publish_interval seconds (and after every step taken with step), the UI polls frame and redraws only when
+        its version changed.
+
+        :param model: set up model
+        :type model: ParkModel
+
+        :param publish_interval: minimal number of seconds between the published frames
+        :type publish_interval: float
+    """
+
+    def __init__(self, model: ParkModel, publish_interval: float = 0.25):
+        self.model = model
+        self.publish_interval = publish_interval
+        self.frame = Frame(0, model)
+        self.steps_per_second = 0.0
+        self._lock = threading.Lock()
+        self._playing = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def playing(self) -> bool:
+        return self._playing.is_set()
+
+    def play(self) -> None:
+        self._playing.set()
+
+    def pause(self) -> None:
+        self._playing.clear()
+
+    def step(self, steps: int = 1) -> None:
+        """Makes the steps right away (when paused) and publishes the frame"""
+        with self._lock:
+            for _ in range(steps):
+                self.model.step()
+            self._publish()
+
+    def reset(self, model: ParkModel) -> None:
+        """Continues with another (set up) model, paused"""
+        self.pause()
+        with self._lock:
+            self.model = model
+            self._publish()
+
+    def _publish(self) -> None:
+        self.frame = Frame(self.frame.version + 1, self.model)
+
+    def _run(self) -> None:
+        published, steps = time.perf_counter(), 0
+        while True:
+            self._playing.wait()
+            with self._lock:
+                if not self.model.running:
+                    self.pause()
+                    self._publish()
+                    continue
+                self.model.step()
+                steps += 1
+                now = time.perf_counter()
+                if now - published >= self.publish_interval:
+                    self.steps_per_second = steps / (now - published)
+                    self._publish()
+                    published, steps = now, 0
+            if not self._playing.is_set():
+                with self._lock:
+                    self._publish()
+                published, steps = time.perf_counter(), 0
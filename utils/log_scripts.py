@@ -1,30 +1,23 @@
 import pandas as pd
-import re
 
-def time_info():
-    data = []
-    log_file = "simulation_performance.log"
+from utils.profiling import Profiler, CSV_COLUMNS
 
 
-    pattern = re.compile(r"INFO - (\w+) took ([\d\.]+)s")
-
+def time_info(profile_file: str = "runs/profile.json") -> pd.DataFrame | None:
+    """Statistics of the section timings saved by Profiler.to_json (e.g. runs/profile.json of a GridSearch with profile=True)"""
     try:
-        with open(log_file, "r") as f:
-            for line in f:
-                match = pattern.search(line)
-                if match:
-                    func_name = match.group(1)
-                    duration = float(match.group(2))
-                    data.append({"function": func_name, "duration": duration})
+        profiler = Profiler.from_json(profile_file)
     except FileNotFoundError:
-        print(f"Error: Could not find file '{log_file}'")
-        return
+        print(f"Error: Could not find file '{profile_file}'")
+        return None
 
-    if not data:
-        print("No matches found! Check your regex or if the log file is empty.")
-        return
+    if not profiler.sections:
+        print("No sections were timed! Check if the profiler was enabled.")
+        return None
 
-    df = pd.DataFrame(data)
+    df = pd.DataFrame([{"section": name, **stats} for name, stats in profiler.summary().items()],
+                      columns=CSV_COLUMNS).set_index("section")
 
     print("--- STATISTICS ---")
-    print(df.groupby("function")["duration"].describe())
\ No newline at end of file
+    print(df)
+    return df
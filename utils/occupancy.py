@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from agent import ParkAgent
+
+"""
+Occupancy index of the agents - the per step questions about all the agents answered with array operations
+"""
+
+# number of the last visited cells kept for every agent and the steps an agent makes before it can be stuck
+HISTORY = 10
+STUCK_MIN_STEPS = 10
+
+
+def stuck_mask(steps: np.ndarray, recent: np.ndarray, min_steps: int = STUCK_MIN_STEPS) -> np.ndarray:
+    """Agents which made more than min_steps steps and went back and forth between two cells in their last HISTORY
+    steps - recent holds the flat indices of the last cells of every agent (-1 for no cell)"""
+    ordered = np.sort(recent, axis=1)
+    distinct = np.count_nonzero((ordered[:, 1:] != ordered[:, :-1]) & (ordered[:, 1:] >= 0), axis=1) + (ordered[:, 0] >= 0)
+    return (distinct == 2) & (steps > min_steps)
+
+
+class OccupancyIndex:
+    """
+        Number of agents on every cell and the compact state of every agent - position, target, number of steps and
+        the last HISTORY visited cells (a ring indexed by the steps) - kept in preallocated arrays. Every agent gets a slot (agent.slot) when it is added,
+        the arrays are updated as the agents move and the slot is reused after the agent is removed.
+        The arrays grow by doubling when all the slots are taken.
+
+        :param shape: (width, height) of the grid
+        :type shape: tuple[int, int]
+
+        :param capacity: number of slots allocated up front
+        :type capacity: int
+    """
+    def __init__(self, shape: tuple[int, int], capacity: int = 64):
+        self.shape = shape
+        self.counts = np.zeros(shape, dtype=np.int32)
+        self.positions = np.zeros((capacity, 2), dtype=np.int32)
+        self.targets = np.zeros((capacity, 2), dtype=np.int32)
+        self.steps = np.zeros(capacity, dtype=np.int32)
+        # flat indices of the last HISTORY visited cells of every agent, -1 for no cell
+        self.recent = np.full((capacity, HISTORY), -1, dtype=np.int64)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.agents: list[ParkAgent | None] = [None] * capacity
+        self._free_slots = list(range(capacity - 1, -1, -1))
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self.alive))
+
+    def state(self) -> dict[str, np.ndarray]:
+        """Arrays of the index without the agents, restored with load_state"""
+        return {"steps": self.steps, "recent": self.recent, "alive": self.alive,
+                "free_slots": np.array(self._free_slots, dtype=np.int64)}
+
+    def load_state(self, state: dict[str, np.ndarray], agents: list[ParkAgent]) -> None:
+        """Puts the agents (with their slots set) back into the slots they had when state was taken"""
+        capacity = len(state["alive"])
+        self.counts = np.zeros(self.shape, dtype=np.int32)
+        self.positions = np.zeros((capacity, 2), dtype=np.int32)
+        self.targets = np.zeros((capacity, 2), dtype=np.int32)
+        self.alive = np.array(state["alive"], dtype=bool)
+        """snapshots saved while the steps were not recorded have no steps and recent cells"""
+        self.steps = np.array(state.get("steps", np.zeros(capacity)), dtype=np.int32)
+        self.recent = np.array(state.get("recent", np.full((capacity, HISTORY), -1)), dtype=np.int64)
+        self.agents = [None] * capacity
+        self._free_slots = state["free_slots"].tolist()
+        for agent in agents:
+            self.agents[agent.slot] = agent
+            self.positions[agent.slot] = agent.cell.coordinate
+            self.targets[agent.slot] = agent.target.coordinate
+            self.counts[agent.cell.coordinate] += 1
+
+    def _grow(self) -> None:
+        capacity = len(self.alive)
+        self.positions = np.concatenate([self.positions, np.zeros_like(self.positions)])
+        self.targets = np.concatenate([self.targets, np.zeros_like(self.targets)])
+        self.steps = np.concatenate([self.steps, np.zeros_like(self.steps)])
+        self.recent = np.concatenate([self.recent, np.full_like(self.recent, -1)])
+        self.alive = np.concatenate([self.alive, np.zeros_like(self.alive)])
+        self.agents.extend([None] * capacity)
+        self._free_slots.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def add(self, agent: ParkAgent) -> int:
+        if not self._free_slots:
+            self._grow()
+        slot = self._free_slots.pop()
+        agent.slot = slot
+        self.agents[slot] = agent
+        self.alive[slot] = True
+        self.positions[slot] = agent.cell.coordinate
+        self.targets[slot] = agent.target.coordinate
+        self.steps[slot] = 0
+        self.recent[slot] = -1
+        self.counts[agent.cell.coordinate] += 1
+        return slot
+
+    def remove(self, agent: ParkAgent) -> None:
+        slot = agent.slot
+        self.counts[tuple(self.positions[slot])] -= 1
+        self.alive[slot] = False
+        self.agents[slot] = None
+        self._free_slots.append(slot)
+
+    def move(self, agent: ParkAgent) -> None:
+        """Updates the position of the agent after its cell changed"""
+        slot = agent.slot
+        self.counts[tuple(self.positions[slot])] -= 1
+        self.positions[slot] = agent.cell.coordinate
+        self.counts[agent.cell.coordinate] += 1
+
+    def record_step(self, agent: ParkAgent) -> None:
+        """Counts a step of the agent and adds its cell to its last visited cells"""
+        slot = agent.slot
+        x, y = agent.cell.coordinate
+        self.recent[slot, self.steps[slot] % HISTORY] = x * self.shape[1] + y
+        self.steps[slot] += 1
+
+    def record_steps(self, slots: np.ndarray, positions: np.ndarray) -> None:
+        """record_step of many agents at once, positions (n, 2) are their cells after the step"""
+        self.recent[slots, self.steps[slots] % HISTORY] = positions[:, 0] * self.shape[1] + positions[:, 1]
+        self.steps[slots] += 1
+
+    def _select(self, mask: np.ndarray) -> list[ParkAgent]:
+        return [self.agents[slot] for slot in np.flatnonzero(mask & self.alive)]
+
+    def arrived(self) -> list[ParkAgent]:
+        """Agents standing on their target"""
+        return self._select((self.positions == self.targets).all(axis=1))
+
+    def stuck(self) -> list[ParkAgent]:
+        """Agents going back and forth between two cells, see stuck_mask"""
+        return self._select(stuck_mask(self.steps, self.recent))
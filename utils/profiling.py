@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import collections
+import csv
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+"""
+In-memory timings of the named sections of the simulation step (vision, metric ranking, grass decay and growth,
+data collection), kept as counters and histograms instead of log lines, and a sampling profiler of whole runs
+"""
+
+# durations are counted in log2 buckets of microseconds - bucket 0 holds everything under 1us, bucket i the durations
+# in [2 ** (i - 1), 2 ** i) us and the last one everything longer
+BUCKETS = 32
+BUCKET_EDGES_US = [0.0] + [2.0 ** i for i in range(BUCKETS - 1)]
+CSV_COLUMNS = ("section", "count", "total_s", "mean_s", "min_s", "max_s", "p50_s", "p95_s")
+
+
+class _Timer:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler: Profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Profiler:
+    """
+        Counters and histograms of the durations of the named sections, used as
+        with model.profiler.section("vision"): ...
+        A disabled profiler returns one shared no-op context manager, so the sections cost next to nothing.
+        sections holds plain dicts and lists, so the profiles of the GridSearch workers are sent back with the results
+        and merged (see merge).
+
+        :param enabled: whether the sections are timed
+        :type enabled: bool
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.sections: dict[str, dict] = {}
+
+    def section(self, name: str):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def record(self, name: str, seconds: float) -> None:
+        stats = self.sections.get(name)
+        if stats is None:
+            stats = self.sections[name] = {"count": 0, "total_s": 0.0, "min_s": math.inf, "max_s": 0.0,
+                                           "histogram": [0] * BUCKETS}
+        stats["count"] += 1
+        stats["total_s"] += seconds
+        stats["min_s"] = min(stats["min_s"], seconds)
+        stats["max_s"] = max(stats["max_s"], seconds)
+        microseconds = seconds * 1e6
+        bucket = 0 if microseconds < 1 else min(int(math.log2(microseconds)) + 1, BUCKETS - 1)
+        stats["histogram"][bucket] += 1
+
+    def merge(self, other: Profiler | dict[str, dict]) -> Profiler:
+        """Adds the sections of other (a profiler or its sections) to this profiler"""
+        sections = other.sections if isinstance(other, Profiler) else other
+        for name, stats in sections.items():
+            mine = self.sections.get(name)
+            if mine is None:
+                self.sections[name] = {**stats, "histogram": list(stats["histogram"])}
+                continue
+            mine["count"] += stats["count"]
+            mine["total_s"] += stats["total_s"]
+            mine["min_s"] = min(mine["min_s"], stats["min_s"])
+            mine["max_s"] = max(mine["max_s"], stats["max_s"])
+            mine["histogram"] = [a + b for a, b in zip(mine["histogram"], stats["histogram"])]
+        return self
+
+    @staticmethod
+    def _quantile(stats: dict, q: float) -> float:
+        """Upper edge (in seconds) of the histogram bucket holding the quantile, capped by the longest duration"""
+        target = q * stats["count"]
+        seen = 0
+        for bucket, count in enumerate(stats["histogram"]):
+            seen += count
+            if seen >= target and count:
+                upper = 2.0 ** bucket / 1e6 if bucket < BUCKETS - 1 else math.inf
+                return min(upper, stats["max_s"])
+        return stats["max_s"]
+
+    def summary(self) -> dict[str, dict]:
+        """count, total, mean, min, max and approximate p50 and p95 in seconds of every section"""
+        return {name: {"count": stats["count"], "total_s": stats["total_s"],
+                       "mean_s": stats["total_s"] / stats["count"] if stats["count"] else 0.0,
+                       "min_s": stats["min_s"] if stats["count"] else 0.0, "max_s": stats["max_s"],
+                       "p50_s": self._quantile(stats, 0.5), "p95_s": self._quantile(stats, 0.95)}
+                for name, stats in sorted(self.sections.items())}
+
+    def to_json(self, path: str) -> None:
+        """Writes the summary with the raw histograms, load it back with Profiler.from_json"""
+        with open(path, "w") as f:
+            json.dump({"bucket_edges_us": BUCKET_EDGES_US, "summary": self.summary(), "sections": self.sections},
+                      f, indent=2)
+
+    @classmethod
+    def from_json(cls, path: str) -> Profiler:
+        with open(path) as f:
+            return cls().merge(json.load(f)["sections"])
+
+    def to_csv(self, path: str) -> None:
+        """Writes one row of the summary per section"""
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_COLUMNS)
+            for name, stats in self.summary().items():
+                writer.writerow([name] + [stats[column] for column in CSV_COLUMNS[1:]])
+
+
+# shared by the models without a profiler
+DISABLED = Profiler(enabled=False)
+
+
+class SamplingProfiler:
+    """
+        Statistical profiler of a whole run - a daemon thread takes the stack of the profiled thread every interval
+        seconds, which slows the run down far less than cProfile. Used as
+        with SamplingProfiler() as sampler: ...
+        profiling the thread entering it. stacks counts the sampled stacks as "outer;...;inner" lines, the collapsed
+        format read by flamegraph.pl and speedscope (see write_collapsed).
+
+        :param interval: seconds between the samples
+        :type interval: float
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks: collections.Counter[str] = collections.Counter()
+        self.samples = 0
+        self._thread_id = None
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def __enter__(self):
+        self._thread_id = threading.get_ident()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._run, daemon=True)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._sampler.join()
+        return False
+
+    @staticmethod
+    def _name(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            names = []
+            while frame is not None:
+                names.append(self._name(frame))
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+                self.samples += 1
+
+    def summary(self, top: int = 20) -> list[dict]:
+        """The top functions by their share of the samples spent in the function itself (self) and in the function
+        with everything it called (total)"""
+        own, total = collections.Counter(), collections.Counter()
+        for stack, count in self.stacks.items():
+            functions = stack.split(";")
+            own[functions[-1]] += count
+            for function in set(functions):
+                total[function] += count
+        samples = max(self.samples, 1)
+        return [{"function": function, "self": count / samples, "total": total[function] / samples}
+                for function, count in own.most_common(top)]
+
+    def write_collapsed(self, path: str) -> None:
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
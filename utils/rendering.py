@@ -0,0 +1,79 @@
+import cv2
+import numpy as np
+from matplotlib import colormaps
+from matplotlib.colors import Normalize, to_rgba
+
+from utils.terrains import Terrain
+
+"""
+Raster rendering of the simulation results - the maps are coloured with lookup tables and written as PNG
+straight from numpy, without drawing any matplotlib figure
+"""
+
+
+def _map_lut() -> np.ndarray:
+    """RGBA colour of every value of the cells matrix (GRASS_POPULARITY + SIDEWALK, uint8) - sidewalks grey,
+    cells without grass black and the grass in the summer colormap by its popularity"""
+    lut = np.empty((256, 4))
+    lut[1:] = colormaps["summer"](Normalize(vmin=1, vmax=100)(np.arange(1, 256)))
+    lut[0] = to_rgba("black")
+    lut[Terrain.SIDEWALK.value:] = to_rgba("grey")
+    return lut
+
+
+MAP_LUT = _map_lut()
+HEAT_LUT = colormaps["Oranges"](np.linspace(0, 1, 256))
+AGENT_COLOR = to_rgba("red")
+
+
+def map_colors(cells: np.ndarray, alpha: float = 1) -> np.ndarray:
+    """(width, height, 4) RGBA colours of the cells"""
+    colors = MAP_LUT[np.asarray(cells, dtype=np.uint8)]
+    colors[..., 3] = alpha
+    return colors
+
+
+def heat_colors(heatmap: np.ndarray) -> np.ndarray:
+    """(width, height, 4) RGBA colours of the heatmap, scaled from 0 to the maximum like GridSearch.get_heatmap"""
+    vmax = max(int(heatmap.max()), 1)
+    return HEAT_LUT[np.round(heatmap * (255 / vmax)).astype(np.uint8)]
+
+
+def blend(base: np.ndarray, overlay: np.ndarray, alpha: float) -> np.ndarray:
+    """overlay drawn over base with the given opacity"""
+    return base * (1 - alpha) + overlay * alpha
+
+
+def to_image(colors: np.ndarray, scale: int = 8, agents=(), agent_radius: float = 1) -> np.ndarray:
+    """
+        uint8 RGBA image of the (width, height, 4) colours with scale pixels per cell and the y axis pointing up,
+        the agents are drawn as discs of agent_radius cells centred on the corner of their cell like the Circle patches
+        of GridSearch.get_map_state
+    """
+    image = np.repeat(np.repeat(colors, scale, axis=0), scale, axis=1)
+    width, height = image.shape[:2]
+    radius = agent_radius * scale
+    for x, y in agents:
+        cx, cy = x * scale, y * scale
+        x0, x1 = max(int(cx - radius), 0), min(int(np.ceil(cx + radius)) + 1, width)
+        y0, y1 = max(int(cy - radius), 0), min(int(np.ceil(cy + radius)) + 1, height)
+        px, py = np.ogrid[x0:x1, y0:y1]
+        disc = (px + 0.5 - cx) ** 2 + (py + 0.5 - cy) ** 2 <= radius ** 2
+        image[x0:x1, y0:y1][disc] = AGENT_COLOR
+
+    image = np.round(np.clip(image, 0, 1) * 255).astype(np.uint8)
+    return np.ascontiguousarray(image.transpose(1, 0, 2)[::-1])
+
+
+def render_map(model_data: dict, heat: bool = False, agents: bool = True, scale: int = 8, heat_alpha: float = 0.3) -> np.ndarray:
+    """Image of the map state of the model (see GridSearch models data), with the heatmap blended over it if heat"""
+    colors = map_colors(model_data["cells"])
+    if heat:
+        colors = blend(colors, heat_colors(model_data["heatmap"]), heat_alpha)
+    return to_image(colors, scale, model_data["agents"] if agents else ())
+
+
+def write_png(path: str, image: np.ndarray) -> None:
+    """Writes the RGBA uint8 image"""
+    if not cv2.imwrite(path, cv2.cvtColor(image, cv2.COLOR_RGBA2BGRA)):
+        raise OSError(f"Could not write {path}")
@@ -0,0 +1,275 @@
+import csv
+import json
+import os
+import tempfile
+from collections.abc import Sequence
+
+import numpy as np
+import pandas as pd
+
+from utils import images
+
+"""
+Columnar on-disk store of the grid search results
+"""
+
+
+class ResultStore:
+    """
+        Results of the simulations kept in a directory - every array field is one raw binary file with the rows
+        of all models stacked one after another (read back as read only np.memmap), index.csv keeps the params,
+        accuracy, number of steps, stop reason (see ConvergenceMonitor) and final agents positions of every row. Rows are appended as the models finish, the arrays
+        are written before the index row, so a run interrupted in the middle of an append loses only that row.
+        A field is widened to a larger integer type (its file rewritten once) when a row does not fit its type.
+
+        :param directory: directory of the store, created if it does not exist
+        :type directory: str
+
+        :param params: names of all the agent params of the rows, the columns of index.csv are fixed by the first row
+                       if not given. Rows with params outside of the columns are rejected.
+        :type params: list[str] | None
+    """
+    FIELDS = {"heatmap": np.uint16, "cells": np.uint8, "created_paths": np.uint8}
+    COLUMNS = ["key", "seed", "metric", "park", "accuracy", "steps", "stop_reason", "agents"]
+
+    def __init__(self, directory: str, params: list[str] | None = None):
+        self.directory = directory
+        self.params = params
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, "index.csv")
+        self.meta_path = os.path.join(directory, "meta.json")
+        self._index = None
+        self._fieldnames = None
+        self._rows = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path, newline="") as f:
+                reader = csv.reader(f)
+                self._fieldnames = next(reader, None)
+                self._rows = sum(1 for _ in reader)
+        self.shapes = {}
+        self.dtypes = {field: np.dtype(dtype) for field, dtype in self.FIELDS.items()}
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            if "shapes" not in meta:
+                """stores written before the fields could be widened keep only the shapes"""
+                meta = {"shapes": meta, "dtypes": {}}
+            self.shapes = {field: tuple(shape) for field, shape in meta["shapes"].items()}
+            self.dtypes.update({field: np.dtype(dtype) for field, dtype in meta["dtypes"].items()})
+        self._drop_unindexed_rows()
+
+    def _field_path(self, field: str) -> str:
+        return os.path.join(self.directory, f"{field}.bin")
+
+    def _row_bytes(self, field: str) -> int:
+        return int(np.prod(self.shapes[field])) * self.dtypes[field].itemsize
+
+    def _write_meta(self) -> None:
+        with open(self.meta_path, "w") as f:
+            json.dump({"shapes": self.shapes, "dtypes": {field: dtype.str for field, dtype in self.dtypes.items()}}, f)
+
+    def _widen(self, field: str, array: np.ndarray) -> None:
+        """Rewrites the rows of the field with a type the array fits into, if the current one is too small"""
+        dtype = self.dtypes[field]
+        if not np.issubdtype(dtype, np.integer) or array.size == 0:
+            return
+        info = np.iinfo(dtype)
+        low, high = array.min(), array.max()
+        if low >= info.min and high <= info.max:
+            return
+        wider = np.result_type(dtype, np.min_scalar_type(low), np.min_scalar_type(high))
+        path = self._field_path(field)
+        if os.path.exists(path):
+            rows = np.fromfile(path, dtype=dtype).astype(wider)
+            rows.tofile(path + ".tmp")
+            os.replace(path + ".tmp", path)
+        self.dtypes[field] = wider
+        self._write_meta()
+
+    """Cuts the array rows written by an append interrupted before its index row"""
+    def _drop_unindexed_rows(self) -> None:
+        rows = len(self)
+        for field in self.shapes:
+            path = self._field_path(field)
+            if os.path.exists(path) and os.path.getsize(path) > rows * self._row_bytes(field):
+                os.truncate(path, rows * self._row_bytes(field))
+
+    def clear(self) -> None:
+        for path in [self.index_path, self.meta_path, *(self._field_path(field) for field in self.FIELDS)]:
+            if os.path.exists(path):
+                os.remove(path)
+        self.shapes = {}
+        self.dtypes = {field: np.dtype(dtype) for field, dtype in self.FIELDS.items()}
+        self._index = None
+        self._fieldnames = None
+        self._rows = 0
+
+    @property
+    def index(self) -> pd.DataFrame:
+        if self._index is None:
+            if self._rows:
+                self._index = pd.read_csv(self.index_path)
+            else:
+                self._index = pd.DataFrame(columns=self.COLUMNS)
+        return self._index
+
+    def __len__(self) -> int:
+        return self._rows
+
+    def keys(self) -> dict[str, int]:
+        """params key -> row"""
+        return {key: row for row, key in enumerate(self.index["key"])}
+
+    def append(self, key: str, params: tuple[dict, int, str, str], accuracy: float, agents: list[tuple[int, int]],
+               arrays: dict[str, np.ndarray], steps: int | None = None, stop_reason: str | None = None) -> int:
+        agent_params, seed, metric, park = params
+        header = self._fieldnames is None
+        fieldnames = self._fieldnames
+        if header:
+            fieldnames = self.COLUMNS + sorted(self.params if self.params is not None else agent_params)
+        unknown = sorted(set(agent_params) - set(fieldnames))
+        if unknown:
+            raise ValueError(f"Params {unknown} are not columns of the store in {self.directory}")
+
+        if not self.shapes:
+            self.shapes = {field: tuple(arrays[field].shape) for field in self.FIELDS}
+            self._write_meta()
+
+        for field in self.FIELDS:
+            array = arrays[field]
+            if tuple(array.shape) != self.shapes[field]:
+                raise ValueError(f"{field} of shape {array.shape} does not fit the store of {self.shapes[field]} rows")
+            self._widen(field, array)
+            with open(self._field_path(field), "ab") as f:
+                f.write(np.ascontiguousarray(array, dtype=self.dtypes[field]).tobytes())
+
+        row = {"key": key, "seed": seed, "metric": metric, "park": park, "accuracy": accuracy, "steps": steps,
+               "stop_reason": stop_reason, "agents": json.dumps([list(agent) for agent in agents]), **agent_params}
+
+        with open(self.index_path, "a", newline="") as f:
+            if header:
+                self._fieldnames = fieldnames
+                csv.writer(f).writerow(self._fieldnames)
+            csv.DictWriter(f, fieldnames=self._fieldnames).writerow(row)
+
+        self._index = None
+        self._rows += 1
+        return self._rows - 1
+
+    def array(self, field: str) -> np.ndarray:
+        """All rows of the field as (rows, *shape) read only memory map"""
+        if len(self) == 0:
+            return np.empty((0, *self.shapes.get(field, (0,))), dtype=self.dtypes[field])
+        return np.memmap(self._field_path(field), dtype=self.dtypes[field], mode="r", shape=(len(self), *self.shapes[field]))
+
+    def model_data(self, row: int) -> dict:
+        """Data of the model in the layout of the GridSearch models data"""
+        entry = self.index.iloc[row]
+        params = tuple(json.loads(entry["key"]))
+        created_paths = np.asarray(self.array("created_paths")[row])
+        reference_paths = images.load_reference_paths(params[3], created_paths.shape[::-1])
+        return {
+            "params": params,
+            "heatmap": np.asarray(self.array("heatmap")[row]),
+            "cells": np.asarray(self.array("cells")[row]),
+            "agents": [tuple(agent) for agent in json.loads(entry["agents"])],
+            "accuracy": (entry["accuracy"], created_paths, reference_paths),
+            "metric": entry["metric"],
+        }
+
+
+class StoredModels(Sequence):
+    """
+        Lazy list of the models data of selected rows of a ResultStore, the data of a model is read only when accessed.
+        Pickles only the directory and the rows, so it is cheap to send to the worker processes.
+    """
+
+    def __init__(self, directory: str, rows: list[int]):
+        self.directory = directory
+        self.rows = list(rows)
+        self._store = None
+
+    @property
+    def store(self) -> ResultStore:
+        if self._store is None:
+            self._store = ResultStore(self.directory)
+        return self._store
+
+    def __getstate__(self):
+        return {"directory": self.directory, "rows": self.rows, "_store": None}
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return StoredModels(self.directory, self.rows[item])
+        return self.store.model_data(self.rows[item])
+
+    @property
+    def accuracy(self) -> np.ndarray:
+        return self.store.index["accuracy"].to_numpy()[self.rows]
+
+    @property
+    def park(self) -> np.ndarray:
+        return self.store.index["park"].to_numpy()[self.rows]
+
+    def where(self, mask: np.ndarray) -> "StoredModels":
+        return StoredModels(self.directory, [row for row, keep in zip(self.rows, mask) if keep])
+
+
+class Leaderboard:
+    """
+        Ranking of the configurations (agent params, seed and metric) run on several parks by their mean and min
+        accuracy across the parks, with the accuracy on every park. The ranking is written to path again after every
+        write_every added results (and with write at the end), the configurations finished on all the parks come first.
+
+        :param path: CSV file of the ranking
+        :type path: str
+
+        :param parks: parks every configuration is run on
+        :type parks: list[str]
+
+        :param write_every: number of added results between the writes of the ranking
+        :type write_every: int
+    """
+    RANKING_COLUMNS = ["config", "seed", "metric", "parks", "mean_accuracy", "min_accuracy"]
+
+    def __init__(self, path: str, parks: list[str], write_every: int = 100):
+        self.path = path
+        self.parks = list(parks)
+        self.write_every = write_every
+        self.configs: dict[str, dict] = {}
+        self._unwritten = 0
+
+    def add(self, params: tuple[dict, int, str, str], accuracy: float, write: bool = True) -> None:
+        agent_params, seed, metric, park = params
+        key = json.dumps([agent_params, seed, metric], sort_keys=True)
+        config = self.configs.setdefault(key, {"config": key, "seed": seed, "metric": metric, **agent_params,
+                                               "accuracies": {}})
+        config["accuracies"][park] = accuracy
+        self._unwritten += 1
+        if write and self._unwritten >= self.write_every:
+            self.write()
+
+    def ranking(self) -> pd.DataFrame:
+        rows = []
+        for config in self.configs.values():
+            accuracies = config["accuracies"]
+            rows.append({**{name: value for name, value in config.items() if name != "accuracies"},
+                         "parks": len(accuracies), "mean_accuracy": float(np.mean(list(accuracies.values()))),
+                         "min_accuracy": min(accuracies.values()),
+                         **{f"accuracy_{park}": accuracies.get(park) for park in self.parks}})
+        if not rows:
+            return pd.DataFrame(columns=self.RANKING_COLUMNS)
+        return pd.DataFrame(rows).sort_values(["parks", "mean_accuracy", "min_accuracy"], ascending=False,
+                                              kind="stable", ignore_index=True)
+
+    def write(self) -> None:
+        """Temporary file + rename, so the ranking can be read while the search runs"""
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".", suffix=".csv")
+        with os.fdopen(fd, "w", newline="") as f:
+            self.ranking().to_csv(f, index=False)
+        os.replace(tmp_path, self.path)
+        self._unwritten = 0
+
@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+import json
+import math
+import random
+
+import numpy as np
+from scipy.stats import norm
+
+"""
+Search strategies of GridSearch - how the params of the simulations are drawn from the search space. The space maps
+every param (the agent params, "seed", "metric" and "park") to a list of values or a fixed value, a point is one
+drawn value of every param
+"""
+
+
+def point_key(point: dict) -> str:
+    return json.dumps(point, sort_keys=True)
+
+
+def space_size(space: dict) -> int:
+    return math.prod(len(values) for values in space.values() if isinstance(values, list))
+
+
+class Sampler:
+    """
+        Draws the points independently with random.choice, the way GridSearch always did. Non adaptive samplers draw
+        the whole plan up front with sample.
+
+        :param seed: seed of the random generator, None draws from the global random module
+        :type seed: int | None
+    """
+    adaptive = False
+
+    def __init__(self, seed: int | None = None):
+        self.random = random.Random(seed) if seed is not None else random
+
+    def sample(self, space: dict, n: int) -> list[dict]:
+        return [{name: self.random.choice(values) if isinstance(values, list) else values
+                 for name, values in space.items()} for _ in range(n)]
+
+
+class LatinHypercubeSampler(Sampler):
+    """
+        Latin hypercube over the indices of the values - the range of every param is split into n strata and every
+        stratum is drawn once, so even a few samples cover every param evenly. Repeated points are drawn again
+        until there are n different points or the space is exhausted.
+    """
+
+    def _hypercube(self, space: dict, n: int) -> list[dict]:
+        columns = {}
+        for name, values in space.items():
+            if not isinstance(values, list):
+                columns[name] = [values] * n
+                continue
+            strata = list(range(n))
+            self.random.shuffle(strata)
+            columns[name] = [values[int((stratum + self.random.random()) / n * len(values))] for stratum in strata]
+        return [{name: columns[name][i] for name in space} for i in range(n)]
+
+    def sample(self, space: dict, n: int, exclude: set[str] = frozenset()) -> list[dict]:
+        n = min(n, space_size(space) - len(exclude))
+        points = {}
+        for _ in range(100):
+            if len(points) >= n:
+                break
+            for point in self._hypercube(space, n - len(points)):
+                key = point_key(point)
+                if key not in exclude:
+                    points.setdefault(key, point)
+        return list(points.values())[:n]
+
+
+class AdaptiveSampler(LatinHypercubeSampler):
+    """
+        Sampler choosing the next points from the accuracies of the points run so far. GridSearch.run_models calls
+        propose until it returns None and runs every proposed batch of points for the proposed number of steps.
+        history holds (point, steps, accuracy) of all the finished runs, the crashed runs with accuracy 0.
+        sample draws a latin hypercube.
+    """
+    adaptive = True
+
+    def propose(self, space: dict, samples: int, stop_step: int,
+                history: list[tuple[dict, int, float]]) -> tuple[list[dict], int] | None:
+        raise NotImplementedError
+
+
+class SuccessiveHalving(AdaptiveSampler):
+    """
+        Runs samples points (a latin hypercube) for a short budget, keeps the best 1 / eta of them, runs those eta times
+        longer and so on until the best ones are run for the full stop_step. The budgets are stop_step / eta ** k
+        for every k keeping the shortest one at least min_steps. GridSearch continues the kept runs from their
+        snapshots, so every run costs only its last budget.
+
+        :param eta: how many times fewer points and more steps every round has
+        :type eta: int
+
+        :param min_steps: the shortest budget
+        :type min_steps: int
+
+        :param seed: seed of the random generator
+        :type seed: int | None
+    """
+
+    def __init__(self, eta: int = 3, min_steps: int = 100, seed: int | None = None):
+        super().__init__(seed)
+        self.eta = eta
+        self.min_steps = min_steps
+
+    def budgets(self, stop_step: int) -> list[int]:
+        rounds = 0
+        while stop_step // self.eta ** (rounds + 1) >= self.min_steps:
+            rounds += 1
+        return [stop_step // self.eta ** k for k in range(rounds, -1, -1)]
+
+    def propose(self, space: dict, samples: int, stop_step: int,
+                history: list[tuple[dict, int, float]]) -> tuple[list[dict], int] | None:
+        budgets = self.budgets(stop_step)
+        if not history:
+            return self.sample(space, samples), budgets[0]
+
+        last = max(steps for _, steps, _ in history)
+        if last >= budgets[-1]:
+            return None
+        ranked = sorted((entry for entry in history if entry[1] == last), key=lambda entry: entry[2], reverse=True)
+        kept = [point for point, _, _ in ranked[:max(1, math.ceil(len(ranked) / self.eta))]]
+        return kept, budgets[budgets.index(last) + 1]
+
+
+class SurrogateSearch(AdaptiveSampler):
+    """
+        Bayesian optimization with a gaussian process - starts with initial points of a latin hypercube, then fits
+        the process to the accuracies so far and proposes the batch of candidate points with the highest expected
+        improvement, until samples points were run. Every run takes stop_step steps. The numeric params are scaled to
+        [0, 1] and the other ones one-hot encoded, the seed is left out and treated as noise.
+
+        :param initial: number of the first points, defaults to a quarter of the samples
+        :type initial: int | None
+
+        :param batch: number of points proposed at once, so the workers have something to run
+        :type batch: int
+
+        :param candidates: number of random not yet run points the best ones are chosen from
+        :type candidates: int
+
+        :param seed: seed of the random generator
+        :type seed: int | None
+    """
+    LENGTH_SCALES = (0.1, 0.2, 0.5, 1.0, 2.0)
+    NOISE = 1e-2
+
+    def __init__(self, initial: int | None = None, batch: int = 4, candidates: int = 2000, seed: int | None = None):
+        super().__init__(seed)
+        self.initial = initial
+        self.batch = batch
+        self.candidates = candidates
+
+    def propose(self, space: dict, samples: int, stop_step: int,
+                history: list[tuple[dict, int, float]]) -> tuple[list[dict], int] | None:
+        seen = {point_key(point) for point, _, _ in history}
+        count = min(samples, space_size(space)) - len(seen)
+        if count <= 0:
+            return None
+        if not history:
+            initial = self.initial if self.initial is not None else max(2, samples // 4)
+            return self.sample(space, min(initial, count)), stop_step
+
+        candidates = {point_key(point): point for point in Sampler.sample(self, space, self.candidates)
+                      if point_key(point) not in seen}
+        if not candidates:
+            """the random candidates missed the few points left, the hypercube finds them"""
+            points = self.sample(space, min(self.batch, count), exclude=seen)
+            return (points, stop_step) if points else None
+        candidates = list(candidates.values())
+        improvement = self.expected_improvement(self.encode(space, [point for point, _, _ in history]),
+                                                np.array([accuracy for _, _, accuracy in history]),
+                                                self.encode(space, candidates))
+        best = np.argsort(-improvement, kind="stable")[:min(self.batch, count)]
+        return [candidates[i] for i in best], stop_step
+
+    @staticmethod
+    def encode(space: dict, points: list[dict]) -> np.ndarray:
+        columns = []
+        for name, values in space.items():
+            if name == "seed" or not isinstance(values, list) or len(values) < 2:
+                continue
+            if all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values):
+                low, high = min(values), max(values)
+                columns.append([(point[name] - low) / (high - low) if high > low else 0.0 for point in points])
+            else:
+                columns.extend([float(point[name] == value) for point in points] for value in values)
+        if not columns:
+            return np.zeros((len(points), 1))
+        return np.array(columns, dtype=float).T
+
+    @classmethod
+    def _kernel(cls, a: np.ndarray, b: np.ndarray, length_scale: float) -> np.ndarray:
+        squared = ((a[:, None, :] - b[None, :, :]) ** 2).sum(axis=2)
+        return np.exp(-0.5 * squared / length_scale ** 2)
+
+    @classmethod
+    def expected_improvement(cls, x: np.ndarray, y: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+        """Expected improvement over the best accuracy of the gaussian process fitted to (x, y), the length scale
+        is the one with the highest marginal likelihood"""
+        std = y.std() if y.std() > 0 else 1.0
+        target = (y - y.mean()) / std
+        best = None
+        for length_scale in cls.LENGTH_SCALES:
+            covariance = cls._kernel(x, x, length_scale) + cls.NOISE * np.eye(len(x))
+            factor = np.linalg.cholesky(covariance)
+            alpha = np.linalg.solve(factor.T, np.linalg.solve(factor, target))
+            likelihood = -0.5 * target @ alpha - np.log(np.diag(factor)).sum()
+            if best is None or likelihood > best[0]:
+                best = (likelihood, length_scale, factor, alpha)
+        _, length_scale, factor, alpha = best
+
+        cross = cls._kernel(candidates, x, length_scale)
+        mean = cross @ alpha
+        v = np.linalg.solve(factor, cross.T)
+        sigma = np.sqrt(np.clip(1.0 - (v ** 2).sum(axis=0), 1e-12, None))
+        z = (mean - target.max()) / sigma
+        return (mean - target.max()) * norm.cdf(z) + sigma * norm.pdf(z)
+
+
+def create_sampler(name: str, seed: int | None = None) -> Sampler:
+    """Sampler of the GridSearch search param"""
+    samplers = {"random": Sampler, "lhs": LatinHypercubeSampler, "halving": SuccessiveHalving,
+                "surrogate": SurrogateSearch}
+    if name not in samplers:
+        raise ValueError(f"Unknown search {name}, use one of {list(samplers)}")
+    return samplers[name](seed=seed)
@@ -0,0 +1,74 @@
+import functools
+
+import numpy as np
+from scipy.ndimage import binary_dilation, generate_binary_structure
+
+from utils import images
+
+"""
+Scores of the paths created by the simulation against the desired paths of the park, computed in the grid orientation
+(width, height) of the GRASS_POPULARITY layer, so the layer is never rotated
+"""
+
+# grass more popular than this is a created path
+ACCURACY_THRESHOLD = 10
+SCORES = ("recall", "precision", "iou", "f1")
+
+_CROSS = generate_binary_structure(2, 1)
+
+
+@functools.lru_cache(maxsize=None)
+def reference_mask(park: str, size: tuple[int, int] = images.base_size) -> np.ndarray:
+    """Desired paths of the park (see images.load_reference_paths) as a read only mask in the grid orientation,
+    loaded once per process"""
+    mask = np.ascontiguousarray(np.rot90(images.load_reference_paths(park, size), k=-1) == 1)
+    mask.setflags(write=False)
+    return mask
+
+
+def created_paths(popularity: np.ndarray, threshold: float = ACCURACY_THRESHOLD, dilation: int = 1) -> np.ndarray:
+    """Mask of the created paths - cells more popular than threshold, dilated dilation times with the cross.
+    popularity may be a stack (..., width, height) of layers"""
+    return dilate(popularity > threshold, dilation)
+
+
+def dilate(paths: np.ndarray, iterations: int) -> np.ndarray:
+    """Dilation of the (..., width, height) masks with the cross, each mask on its own"""
+    if iterations <= 0:
+        return paths
+    structure = _CROSS.reshape((1,) * (paths.ndim - 2) + _CROSS.shape)
+    return binary_dilation(paths, structure=structure, iterations=iterations)
+
+
+def score(popularity: np.ndarray, reference: np.ndarray, thresholds=(ACCURACY_THRESHOLD,),
+          dilations=(1,)) -> dict[str, np.ndarray]:
+    """
+        Recall (the accuracy of ParkModel), precision, IoU and F1 of the created paths against the reference mask
+        for every threshold and dilation radius, the created paths of all the thresholds are built in one pass.
+
+        :param popularity: GRASS_POPULARITY data (width, height) or a stack of them (..., width, height)
+        :param reference: mask of the desired paths in the grid orientation, see reference_mask
+        :return: score name -> array (thresholds, dilations, ...) with the leading shape of the stack at the end
+    """
+    thresholds = np.asarray(thresholds, dtype=float).reshape((-1,) + (1,) * popularity.ndim)
+    paths = popularity[None] > thresholds
+    reference_count = np.count_nonzero(reference)
+    axes = (-2, -1)
+
+    scores = {name: [] for name in SCORES}
+    for dilation in dilations:
+        dilated = dilate(paths, dilation)
+        hits = np.count_nonzero(dilated & reference, axis=axes)
+        created = np.count_nonzero(dilated, axis=axes)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores["recall"].append(hits / reference_count)
+            scores["precision"].append(np.where(created > 0, hits / created, 0.0))
+            scores["iou"].append(hits / (created + reference_count - hits))
+            scores["f1"].append(2 * hits / (created + reference_count))
+    return {name: np.stack(values, axis=1) for name, values in scores.items()}
+
+
+def accuracy(popularity: np.ndarray, reference: np.ndarray, dilation: int = 1) -> float | np.ndarray:
+    """Share of the reference cells covered by the created paths, the same value as ParkModel.calculate_accuracy"""
+    hits = np.count_nonzero(created_paths(popularity, dilation=dilation) & reference, axis=(-2, -1))
+    return hits / np.count_nonzero(reference)
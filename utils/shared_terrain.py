@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from utils import distance_fields, images
+
+"""
+Static arrays of the parks (terrain, obstacle margin, desired paths and the distance fields) prepared once by the
+parent process and shared with the worker processes through multiprocessing.shared_memory
+"""
+
+# shared memory blocks attached by this process, the views of images.shared_arrays point into them
+_attached: list[shared_memory.SharedMemory] = []
+
+
+class SharedTerrain:
+    """
+        Context manager publishing the static arrays of the parks in shared memory, the blocks are removed on exit.
+        It gives the description of the blocks, which is passed to attach in the workers (e.g. as the initializer
+        of the pool), so their images.load_terrain, images.load_reference_paths and
+        distance_fields.load_distance_fields return read only views of the shared arrays instead of loading them.
+
+        :param parks: names of the parks
+        :type parks: list[str]
+
+        :param size: (width, height) of the grid
+        :type size: tuple[int, int]
+
+        :param geodesic: whether the distance fields of the entrances are shared as well
+        :type geodesic: bool
+    """
+
+    def __init__(self, parks: list[str], size: tuple[int, int] = images.base_size, geodesic: bool = False):
+        self.parks = parks
+        self.size = size
+        self.geodesic = geodesic
+        self.blocks: list[shared_memory.SharedMemory] = []
+
+    def _arrays(self, park: str) -> dict[str, dict[str, np.ndarray]]:
+        coords, margin = images.load_terrain(park, self.size)
+        arrays = {images.terrain_name(park, self.size): {"coords": coords, "margin": margin},
+                  images.paths_name(park, self.size): {"paths": images.load_reference_paths(park, self.size)}}
+        if self.geodesic:
+            fields = distance_fields.load_distance_fields(park, self.size)
+            arrays[distance_fields.fields_name(park, self.size, list(fields))] = {
+                "fields": np.stack(list(fields.values())) if fields else np.empty((0, *self.size))}
+        return arrays
+
+    def __enter__(self) -> dict[str, dict[str, tuple[str, tuple, str]]]:
+        """name -> field -> (shared memory block, shape, dtype)"""
+        description = {}
+        try:
+            for park in dict.fromkeys(self.parks):
+                for name, arrays in self._arrays(park).items():
+                    description[name] = {}
+                    for field, array in arrays.items():
+                        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                        self.blocks.append(block)
+                        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+                        description[name][field] = (block.name, array.shape, array.dtype.str)
+        except BaseException:
+            self.__exit__()
+            raise
+        return description
+
+    def __exit__(self, *exc_info):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+        return False
+
+
+def attach(description: dict[str, dict[str, tuple[str, tuple, str]]]) -> None:
+    """Makes the arrays published by SharedTerrain the arrays of the parks in this process"""
+    for name, fields in description.items():
+        arrays = {}
+        for field, (block_name, shape, dtype) in fields.items():
+            """the workers of a pool share the resource tracker of the parent, so the block stays registered once
+            and is removed only by the parent"""
+            block = shared_memory.SharedMemory(name=block_name)
+            _attached.append(block)
+            array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+            array.setflags(write=False)
+            arrays[field] = array
+        images.shared_arrays[name] = arrays
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import itertools
+import json
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from agent import ParkAgent
+
+if TYPE_CHECKING:
+    from model import ParkModel
+
+"""
+Snapshots of the whole state of a ParkModel in one npz file - the layers changed by the simulation, the heatmap and
+the trajectories, the agents, the occupancy index and the random generators - see ParkModel.snapshot and
+ParkModel.restore
+"""
+
+# ParkModel params the park and the grid size of the snapshot cannot be changed by when it is restored
+FIXED_PARAMS = ("width", "height", "park_name")
+AGENT_PARAMS = ("angle", "distance", "tile_weight", "distance_weight")
+
+
+def _next_agent_id(model: ParkModel) -> int:
+    """Id the next agent of the model gets, the mesa counter is replaced so no id is skipped"""
+    next_id = next(ParkAgent._ids[model])
+    ParkAgent._ids[model] = itertools.count(next_id)
+    return next_id
+
+
+def _coordinates(cells) -> np.ndarray:
+    return np.array([cell.coordinate if cell is not None else (-1, -1) for cell in cells], dtype=np.int64).reshape(-1, 2)
+
+
+def save(model: ParkModel, path: str) -> None:
+    """Writes the state of the model set up with ParkModel.setup to path (np.savez adds .npz to other names)"""
+    agents = list(model.agents)
+    visited = [np.sort(np.fromiter(agent.visited, dtype=np.int64, count=len(agent.visited))) for agent in agents]
+    version, internal_state, gauss_next = model.random.getstate()
+    meta = {
+        "params": {"num_agents": model.num_agents, "width": model.grid.width, "height": model.grid.height,
+                   "park_name": model.park_name, "seed": model._seed, "kind": model.kind,
+                   "grass_decay_rate": model.grass_decay_rate,
+                   "grass_growth_probability": model.grass_growth_probability, "agent_params": model.agent_params,
+                   "obstacle_margin_percentage": model.obstacle_margin_percentage, "grass_rng": model.grass_rng,
+                   "max_agents": model.max_agents, "geodesic_distance": model.geodesic_distance,
+                   "backend": model.backend, "remove_stuck": model.remove_stuck},
+        "metric": str(model.metric),
+        "step_count": model.step_count,
+        "steps": model.steps,
+        "running": model.running,
+        "stop_reason": model.stop_reason,
+        "next_agent_id": _next_agent_id(model),
+        "agent_params": [{name: getattr(agent, name) for name in AGENT_PARAMS} for agent in agents],
+        "random": [version, list(internal_state), gauss_next],
+        "rng": model.rng.bit_generator.state,
+    }
+    np.savez(
+        path,
+        meta=np.array(json.dumps(meta)),
+        grass_popularity=model.grid.GRASS_POPULARITY.data,
+        subtargets=model.grid.SUBTARGETS.data,
+        vision=model.grid.VISION.data,
+        heatmap=model.heatmap,
+        trajectories=model.trajectories.history,
+        agent_ids=np.array([agent.unique_id for agent in agents], dtype=np.int64),
+        agent_slots=np.array([agent.slot for agent in agents], dtype=np.int64),
+        agent_cells=_coordinates(agent.cell for agent in agents),
+        agent_origins=_coordinates(agent.origin for agent in agents),
+        agent_targets=_coordinates(agent.target for agent in agents),
+        agent_subtargets=_coordinates(agent.subtarget for agent in agents),
+        agent_previous_cells=_coordinates(agent.previous_cell for agent in agents),
+        visited=np.concatenate(visited) if visited else np.empty(0, dtype=np.int64),
+        visited_offsets=np.cumsum([0] + [len(cells) for cells in visited]),
+        **{f"occupancy_{name}": array for name, array in model.occupancy.state().items()},
+    )
+
+
+def read(path: str) -> tuple[dict, dict[str, np.ndarray]]:
+    """Meta data and arrays of the snapshot"""
+    with np.load(path) as data:
+        arrays = {name: data[name] for name in data.files}
+    return json.loads(str(arrays.pop("meta"))), arrays
+
+
+def model_params(meta: dict, seed: int | None, params: dict) -> dict:
+    """ParkModel params of the restored model - the saved ones updated with params and seed"""
+    saved = meta["params"]
+    for name in FIXED_PARAMS:
+        if name in params and params[name] != saved[name]:
+            raise ValueError(f"Snapshot of {saved['park_name']} on {saved['width']}x{saved['height']} grid cannot be "
+                             f"restored with {name}={params[name]}")
+    return {**saved, **params, "seed": seed if seed is not None else saved["seed"]}
+
+
+def load(model: ParkModel, meta: dict, arrays: dict[str, np.ndarray], keep_random: bool = True) -> None:
+    """
+    Puts the saved state into a model set up without agents (ParkModel.setup(initial_agents=0)). With keep_random
+    the random generators continue from the saved state, so the restored run makes the same steps as the saved one,
+    otherwise they stay seeded with the seed of the model
+    """
+    grid = model.grid
+    grid.GRASS_POPULARITY.data[:] = arrays["grass_popularity"]
+    grid.SUBTARGETS.data[:] = arrays["subtargets"]
+    grid.VISION.data[:] = arrays["vision"]
+    model.heatmap[:] = arrays["heatmap"]
+    model.trajectories.load(arrays["trajectories"])
+
+    agents = []
+    offsets = arrays["visited_offsets"]
+    for i, unique_id in enumerate(arrays["agent_ids"].tolist()):
+        agent = ParkAgent(model, grid[tuple(arrays["agent_cells"][i].tolist())],
+                          grid[tuple(arrays["agent_targets"][i].tolist())], **meta["agent_params"][i])
+        agent.unique_id = unique_id
+        agent.slot = int(arrays["agent_slots"][i])
+        agent.origin = grid[tuple(arrays["agent_origins"][i].tolist())]
+        subtarget, previous_cell = arrays["agent_subtargets"][i].tolist(), arrays["agent_previous_cells"][i].tolist()
+        agent.subtarget = grid[tuple(subtarget)] if subtarget[0] >= 0 else None
+        agent.previous_cell = grid[tuple(previous_cell)] if previous_cell[0] >= 0 else None
+        agent.visited = set(arrays["visited"][offsets[i]: offsets[i + 1]].tolist())
+        agents.append(agent)
+    model.occupancy.load_state({name[len("occupancy_"):]: array for name, array in arrays.items()
+                                if name.startswith("occupancy_")}, agents)
+    ParkAgent._ids[model] = itertools.count(meta["next_agent_id"])
+
+    model.step_count = meta["step_count"]
+    model.steps = meta["steps"]
+    model.running = meta["running"]
+    model.stop_reason = meta["stop_reason"]
+    if keep_random:
+        version, internal_state, gauss_next = meta["random"]
+        model.random.setstate((version, tuple(internal_state), gauss_next))
+        model.rng.bit_generator.state = meta["rng"]
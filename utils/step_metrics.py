@@ -1,13 +1,17 @@
 from __future__ import annotations
 
+import math
 from typing import TYPE_CHECKING
 from abc import ABC, abstractmethod
 from mesa.discrete_space import Cell
-from utils.terrains import Terrain
+from utils.terrain_index import distance
 from agent import  ParkAgent
 
 
 class AbstractMetric(ABC):
+    # name of the NumpyKernels method ranking the neighbours like get_cells_rank, None for metrics without one
+    kernel = None
+
     @abstractmethod
     def get_cells_rank(self, agent: ParkAgent) -> list[tuple[Cell, float]]:
         pass
@@ -15,16 +19,35 @@ class AbstractMetric(ABC):
     def __str__(self):
         return "abstract"
 
+    """Cell the agent is heading to - subtarget if it has one, target otherwise"""
+    @staticmethod
+    def destination(agent: ParkAgent) -> Cell:
+        if agent.subtarget:
+            return agent.subtarget
+        return agent.target
+
+    """Walkable (sidewalk or grass) neighbours of the agent cell as (cell, x, y, tile class, is obstacle margin)"""
+    @staticmethod
+    def walkable_neighbours(agent: ParkAgent) -> tuple:
+        return agent.model.terrain.neighbours(agent.cell.coordinate)
+
+    """Affordance of the neighbour at (x, y), same value as ParkAgent.return_cell_affordance"""
+    @staticmethod
+    def affordance(agent: ParkAgent, x: int, y: int, tile_class: int) -> float:
+        ax, ay = agent.cell.coordinate
+        model = agent.model
+        tile_val = agent.tile_weight * model.terrain.tile_value(x, y, tile_class)
+        distance_diff = distance(x, y, ax, ay) + model.distance_to(agent.target, x, y) - model.distance_to(agent.target, ax, ay)
+        return max(tile_val - distance_diff * agent.distance_weight, 0)
+
 class ClosestMetric(AbstractMetric):
+    kernel = "closest"
 
     def get_cells_rank(self, agent: ParkAgent) -> list[tuple[Cell, float]]:
-        cell_dist = agent.target
-
-        if agent.subtarget:
-            cell_dist = agent.subtarget
+        cell_dist = self.destination(agent)
+        distance_to = agent.model.distance_to
 
-        possible_cells = [(c, agent.calc_dest_dist(cell_dist, c)) for c in agent.cell.neighborhood if
-                          (c.SIDEWALK == Terrain.SIDEWALK.value or c.GRASS == Terrain.GRASS.value)]
+        possible_cells = [(c, distance_to(cell_dist, x, y)) for c, x, y, _, _ in self.walkable_neighbours(agent)]
 
         possible_cells = sorted(possible_cells, key=lambda c: c[1])
 
@@ -37,27 +60,27 @@ class ClosestMetric(AbstractMetric):
         return "normal"
 
 class AffordanceMetric(AbstractMetric):
+    kernel = "affordance"
 
     def get_cells_rank(self, agent: ParkAgent) -> list[tuple[Cell, float]]:
 
-        cell_dist = agent.target
+        cell_dist = self.destination(agent)
+        dx, dy = cell_dist.coordinate
+        ax, ay = agent.cell.coordinate
 
-        if agent.subtarget:
-            cell_dist = agent.subtarget
-
-        if cell_dist in agent.cell.neighborhood:
+        if max(abs(dx - ax), abs(dy - ay)) == 1:
             return [(cell_dist, -1)]
 
-        min_dist = ParkAgent.calc_dest_dist(cell_dist, agent.cell)
+        distance_to = agent.model.distance_to
+        min_dist = distance_to(cell_dist, ax, ay)
 
-        possible_cells = [(c, agent.return_cell_affordance(c)) for c in agent.cell.neighborhood if
-                          (c.SIDEWALK == Terrain.SIDEWALK.value or c.GRASS == Terrain.GRASS.value) and min_dist >= ParkAgent.calc_dest_dist(cell_dist, c)]
+        possible_cells = [(c, self.affordance(agent, x, y, tile_class)) for c, x, y, tile_class, _ in self.walkable_neighbours(agent)
+                          if min_dist >= distance_to(cell_dist, x, y)]
 
         possible_cells = sorted(possible_cells, key=lambda c: c[1], reverse=True)
 
         if len(possible_cells) == 0:
-            possible_cells = [(c, agent.calc_dest_dist(cell_dist, c)) for c in agent.cell.neighborhood if
-                          (c.SIDEWALK == Terrain.SIDEWALK.value or c.GRASS == Terrain.GRASS.value)]
+            possible_cells = [(c, distance_to(cell_dist, x, y)) for c, x, y, _, _ in self.walkable_neighbours(agent)]
             possible_cells = sorted(possible_cells, key=lambda c: c[1])
 
         if len(possible_cells) == 0:
@@ -69,21 +92,22 @@ class AffordanceMetric(AbstractMetric):
         return "affordance"
 
 class RandomBalancedMetric(AbstractMetric):
-    def get_cells_rank(self, agent: ParkAgent) -> list[tuple[Cell, float]]:
-        cell_dist = agent.target
-        if agent.subtarget:
-            cell_dist = agent.subtarget
+    kernel = "balanced"
 
-        min_dist = ParkAgent.calc_dest_dist(cell_dist, agent.cell)
-
-        possible_cells_dist = [(c, agent.calc_dest_dist(cell_dist, c)) for c in agent.cell.neighborhood if
-                          (c.SIDEWALK == Terrain.SIDEWALK.value or c.GRASS == Terrain.GRASS.value)
-                               and min_dist >= ParkAgent.calc_dest_dist(cell_dist, c)]
+    def get_cells_rank(self, agent: ParkAgent) -> list[tuple[Cell, float]]:
+        cell_dist = self.destination(agent)
+        ax, ay = agent.cell.coordinate
+        distance_to = agent.model.distance_to
 
+        min_dist = distance_to(cell_dist, ax, ay)
 
-        possible_cells_aff = [(c, agent.return_cell_affordance(c)) for c in agent.cell.neighborhood if
-                          (c.SIDEWALK == Terrain.SIDEWALK.value or c.GRASS == Terrain.GRASS.value)
-                               and min_dist >= ParkAgent.calc_dest_dist(cell_dist, c)]
+        possible_cells_dist = []
+        possible_cells_aff = []
+        for c, x, y, tile_class, _ in self.walkable_neighbours(agent):
+            dist = distance_to(cell_dist, x, y)
+            if min_dist >= dist:
+                possible_cells_dist.append((c, dist))
+                possible_cells_aff.append((c, self.affordance(agent, x, y, tile_class)))
 
         possible_cells_dist = sorted(possible_cells_dist, key=lambda c: c[1])
         possible_cells_aff = sorted(possible_cells_aff, key=lambda c: c[1], reverse=True)
@@ -109,35 +133,34 @@ class RandomBalancedMetric(AbstractMetric):
 
 
 class MixedMetric(AbstractMetric):
-    def get_cells_rank(self, agent: ParkAgent) -> list[tuple[Cell, float]]:
-        cell_dist = agent.target
+    kernel = "mixed"
 
-        if agent.subtarget:
-            cell_dist = agent.subtarget
+    def get_cells_rank(self, agent: ParkAgent) -> list[tuple[Cell, float]]:
+        cell_dist = self.destination(agent)
+        terrain = agent.model.terrain
+        distance_to = agent.model.distance_to
 
-        possible_cells= [(c, agent.calc_dest_dist(cell_dist, c), agent.get_tile_value(c)) for c in agent.cell.neighborhood if
-                          (c.SIDEWALK == Terrain.SIDEWALK.value or c.GRASS == Terrain.GRASS.value) and
-                         c.OBSTACLE_MARGIN != Terrain.OBSTACLE_MARGIN.value and c not in agent.previous_cells]
+        possible_cells = [(c, distance_to(cell_dist, x, y), terrain.tile_value(x, y, tile_class))
+                          for c, x, y, tile_class, margin in self.walkable_neighbours(agent)
+                          if not margin and not agent.has_visited(x, y)]
 
         #if there is no possible steps for our agent - send him to the target and forget about him
         if len(possible_cells) == 0:
             return [(cell_dist, -1)]
 
         #for scaling values to the range 0-1
-        min_dist = min(possible_cells, key=lambda x: x[1])
-        max_dist = max(possible_cells, key=lambda x: x[1])
-        min_aff = min(possible_cells, key=lambda x: x[2])
-        max_aff = max(possible_cells, key=lambda x: x[2])
-        d_dist = max_dist[1] - min_dist[1]
-        d_aff = max_aff[2] - min_aff[2]
+        min_dist = min(c[1] for c in possible_cells)
+        min_aff = min(c[2] for c in possible_cells)
+        d_dist = max(c[1] for c in possible_cells) - min_dist
+        d_aff = max(c[2] for c in possible_cells) - min_aff
 
         def calculate_combination(c : tuple[Cell, float, float]) -> float:
             if d_aff == 0:
-                return (c[1] - min_dist[1]) / d_dist #all have the same affordance
+                return _divide(c[1] - min_dist, d_dist) #all have the same affordance
             else:
-                dist_scaled = (c[1] - min_dist[1]) / d_dist
-                aff_scaled = (c[2] - min_aff[2]) / d_aff
-                return dist_scaled/aff_scaled
+                dist_scaled = _divide(c[1] - min_dist, d_dist)
+                aff_scaled = (c[2] - min_aff) / d_aff
+                return _divide(dist_scaled, aff_scaled)
 
         candidates = [(c[0], calculate_combination(c)) for c in possible_cells]
         candidates = sorted(candidates, key=lambda c: c[1])
@@ -147,4 +170,16 @@ class MixedMetric(AbstractMetric):
         return "mixed"
 
 
+# metrics by the names used in the params of the grid search and the command line, other names give AffordanceMetric
+METRICS = {"normal": ClosestMetric, "mixed": MixedMetric, "balanced": RandomBalancedMetric, "affordance": AffordanceMetric}
+
+
+def create_metric(name: str) -> AbstractMetric:
+    return METRICS.get(name, AffordanceMetric)()
+
 
+"""Division of non negative numbers which follows numpy floats instead of raising for the zero denominator"""
+def _divide(numerator: float, denominator: float) -> float:
+    if denominator == 0:
+        return math.nan if numerator == 0 or math.isnan(numerator) else math.inf
+    return numerator / denominator
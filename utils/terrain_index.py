@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import math
+
+import numpy as np
+from mesa.discrete_space import OrthogonalMooreGrid
+
+from utils import images
+from utils.terrains import Terrain
+
+"""
+Static tables of the terrain built once per model, so the hot paths do not go through the cells property layers
+"""
+
+# same order as the neighbourhood of the OrthogonalMooreGrid cells, the order matters for picking between equal cells
+NEIGHBOUR_OFFSETS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+
+
+def distance(x1: int, y1: int, x2: int, y2: int) -> float:
+    """Euclidean distance between two cells, same value as ParkAgent.calc_dest_dist"""
+    return math.sqrt((x1 - x2) * (x1 - x2) + (y1 - y2) * (y1 - y2))
+
+
+class TerrainIndex:
+    """
+        Precomputed terrain masks, terrain class codes and walkable neighbours of the cells.
+        The terrain does not change during the simulation, only the GRASS_POPULARITY layer does,
+        so it is read from the grid when the tile values are needed.
+        Use from_grid for a model grid or from_park for the headless engines without a grid
+        (neighbours and tile_value need the grid).
+
+        :param sidewalk: mask of the sidewalk cells
+        :param grass: mask of the grass cells
+        :param margin: mask of the obstacle margin cells
+        :param free: mask of the cells without obstacles
+        :param grid: grid of the model with the terrain property layers already added
+        :type grid: OrthogonalMooreGrid | None
+    """
+    OTHER, MARGIN, GRASS, SIDEWALK = range(4)
+
+    def __init__(self, sidewalk: np.ndarray, grass: np.ndarray, margin: np.ndarray, free: np.ndarray,
+                 grid: OrthogonalMooreGrid | None = None):
+        self.grid = grid
+        self.free = free
+        self.sidewalk = sidewalk
+        self.grass = grass
+        self.margin = margin
+        self.walkable = self.sidewalk | self.grass
+
+        """Class deciding the tile value, in the priority of ParkAgent.get_tile_value"""
+        self.tile_class = np.select([self.sidewalk, self.grass, self.margin],
+                                    [self.SIDEWALK, self.GRASS, self.MARGIN], self.OTHER).astype(np.uint8)
+
+        self.width, self.height = self.walkable.shape
+        self._neighbours = {}
+
+    @classmethod
+    def from_grid(cls, grid: OrthogonalMooreGrid) -> TerrainIndex:
+        return cls(sidewalk=grid.SIDEWALK.data == Terrain.SIDEWALK.value,
+                   grass=grid.GRASS.data == Terrain.GRASS.value,
+                   margin=grid.OBSTACLE_MARGIN.data == Terrain.OBSTACLE_MARGIN.value,
+                   free=grid.OBSTACLE.data == 0,
+                   grid=grid)
+
+    """Index of the park terrain of the given (width, height) size, same masks as the grid of TestEnvironment"""
+    @classmethod
+    def from_park(cls, park_name: str, size: tuple[int, int]) -> TerrainIndex:
+        coords, margin = images.load_terrain(park_name, size)
+        return cls(sidewalk=coords == Terrain.SIDEWALK.value,
+                   grass=coords == Terrain.GRASS.value,
+                   margin=margin,
+                   free=coords != Terrain.OBSTACLE.value)
+
+    def neighbours(self, coordinate: tuple[int, int]) -> tuple:
+        """(cell, x, y, tile class, is obstacle margin) of the walkable neighbours, in the neighbourhood order.
+        Built on the first request for the cell, so the large grids do not pay for the cells nobody walks on"""
+        try:
+            return self._neighbours[coordinate]
+        except KeyError:
+            x, y = coordinate
+            neighbours = tuple(
+                (self.grid[(nx, ny)], nx, ny, int(self.tile_class[nx, ny]), bool(self.margin[nx, ny]))
+                for nx, ny in ((x + ox, y + oy) for ox, oy in NEIGHBOUR_OFFSETS)
+                if 0 <= nx < self.width and 0 <= ny < self.height and self.walkable[nx, ny]
+            )
+            self._neighbours[coordinate] = neighbours
+            return neighbours
+
+    """Tile value of the cell for the given tile class, see ParkAgent.get_tile_value"""
+    def tile_value(self, x: int, y: int, tile_class: int) -> float:
+        if tile_class == self.SIDEWALK:
+            return 100.0
+        elif tile_class == self.GRASS:
+            return int(self.grid.GRASS_POPULARITY.data[x, y])
+        elif tile_class == self.MARGIN:
+            return min(0.1 * int(self.grid.GRASS_POPULARITY.data[x, y]), 1)
+        return 0.0
+
+    """Tile values of the cells in the window, same as tile_value for every cell"""
+    def tile_values(self, window: tuple[slice, slice], popularity: np.ndarray | None = None) -> np.ndarray:
+        """popularity - GRASS_POPULARITY data to use instead of the grid layer (whole grid, not the window)"""
+        if popularity is None:
+            popularity = self.grid.GRASS_POPULARITY.data
+        return self.class_values(self.tile_class[window], popularity[window])
+
+    """Tile values of cells of the given classes and popularity (arrays of the same shape)"""
+    @classmethod
+    def class_values(cls, tile_class: np.ndarray, popularity: np.ndarray) -> np.ndarray:
+        values = np.where(tile_class == cls.MARGIN, np.minimum(0.1 * popularity, 1), 0.0)
+        values = np.where(tile_class == cls.GRASS, popularity, values)
+        return np.where(tile_class == cls.SIDEWALK, 100.0, values)
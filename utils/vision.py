@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import functools
+from typing import TYPE_CHECKING
+
+import numpy as np
+from scipy.ndimage import label
+
+from utils import distance_fields
+from utils.terrain_index import NEIGHBOUR_OFFSETS, TerrainIndex
+
+if TYPE_CHECKING:
+    from agent import ParkAgent
+
+"""
+Batched vision cone used by the agents for selecting their subtargets
+"""
+
+_CONNECTIVITY = np.ones((3, 3), dtype=bool)
+# connectivity inside the planes of a stack of windows, the windows of different agents are never connected
+_PLANE_CONNECTIVITY = np.pad(_CONNECTIVITY[None], ((1, 1), (0, 0), (0, 0)))
+
+
+@functools.lru_cache(maxsize=None)
+def vision_stencil(distance: int, angle: int) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, float]:
+    """Offsets (dx, dy) of the (2 * distance + 1)^2 box around the agent, their norms,
+    the mask of offsets lying in the vision radius and the minimal cosine of the vision angle"""
+    dx, dy = np.meshgrid(np.arange(-distance, distance + 1), np.arange(-distance, distance + 1), indexing="ij")
+    in_radius = dx ** 2 + dy ** 2 <= distance ** 2
+    norms = np.sqrt((dx ** 2 + dy ** 2).astype(float))
+    for array in (dx, dy, norms, in_radius):
+        array.setflags(write=False)
+    return dx, dy, norms, in_radius, np.cos(np.deg2rad(angle / 2))
+
+
+class VisionEngine:
+    """
+        Finds the cells visible by an agent and scores them in one array pass.
+
+        A cell is visible when it is in the vision radius, in the vision angle (measured from the vector pointing
+        to the target), it is not an obstacle and it can be reached from the agent through other visible cells.
+        The best cell is the same cell the recursive search over the cells neighbourhood would pick, ties are
+        resolved by the order in which that search visits the cells. With the distance fields the distances to the
+        target in the affordances are geodesic (see ParkModel.distance_to), the vision angle stays measured from the
+        straight line to the target.
+
+        :param terrain: static terrain tables of the model
+        :type terrain: TerrainIndex
+
+        :param fields: stacked distance fields of the entrances (see distance_fields.stack_fields), None for the
+                       euclidean distances
+        :type fields: np.ndarray | None
+
+        :param fields_index: index of the field of every cell, given with fields
+        :type fields_index: np.ndarray | None
+    """
+
+    def __init__(self, terrain: TerrainIndex, fields: np.ndarray | None = None, fields_index: np.ndarray | None = None):
+        self.terrain = terrain
+        self.width, self.height = terrain.width, terrain.height
+        self.fields, self.fields_index = fields, fields_index
+
+    def scan(self, agent: ParkAgent) -> tuple[np.ndarray, np.ndarray, int | None]:
+        """Returns coordinates (n, 2) of visible cells, their affordances and the index of the best cell
+        (None if agent sees nothing)"""
+        return self.scan_at(agent.cell.coordinate, agent.target.coordinate, agent.distance, agent.angle,
+                            agent.tile_weight, agent.distance_weight)
+
+    def scan_at(self, position: tuple[int, int], target: tuple[int, int], distance: int, angle: int,
+                tile_weight: float, distance_weight: float,
+                popularity: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray, int | None]:
+        """Same as scan for an agent given by its position, target and params, popularity is the
+        GRASS_POPULARITY data to use instead of the grid layer"""
+        x, y = position
+        tx, ty = target[0] - x, target[1] - y
+        d = distance
+        dx, dy, norms, in_radius, min_cos = vision_stencil(d, angle)
+
+        x0, x1 = max(x - d, 0), min(x + d + 1, self.width)
+        y0, y1 = max(y - d, 0), min(y + d + 1, self.height)
+        window = (slice(x0, x1), slice(y0, y1))
+        box = (slice(x0 - x + d, x1 - x + d), slice(y0 - y + d, y1 - y + d))
+        dx, dy, norms = dx[box], dy[box], norms[box]
+
+        target_norm = np.sqrt(float(tx * tx + ty * ty))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            in_angle = (dx * tx + dy * ty) / (norms * target_norm) >= min_cos
+
+        mask = in_radius[box] & in_angle & self.terrain.free[window]
+
+        """Only the cells connected to the agent through visible cells are visible"""
+        labels, _ = label(mask, structure=_CONNECTIVITY)
+        ax, ay = x - x0, y - y0
+        seen = labels[max(ax - 1, 0): ax + 2, max(ay - 1, 0): ay + 2]
+        visible = np.isin(labels, seen[seen > 0])
+
+        local = np.argwhere(visible)
+        if len(local) == 0:
+            return local, np.empty(0), None
+
+        ldx, ldy = dx[visible], dy[visible]
+        if self.fields is None:
+            to_target = np.sqrt(((tx - ldx) ** 2 + (ty - ldy) ** 2).astype(float))
+            target_distance = target_norm
+        else:
+            to_target = self._distances(target[0], target[1], x + ldx, y + ldy)
+            target_distance = float(self._distances(target[0], target[1], x, y)[0])
+        tile_val = tile_weight * self.terrain.tile_values(window, popularity)[visible]
+        distance_val = (norms[visible] + to_target - target_distance) * distance_weight
+        affordances = np.maximum(tile_val - distance_val, 0)
+
+        best = np.flatnonzero(affordances == affordances.max())
+        if len(best) == 1:
+            best = int(best[0])
+        else:
+            best = self._first_visited(visible, affordances == affordances.max(), ax, ay)
+
+        return local + (x0, y0), affordances, best
+
+    def scan_many(self, positions: np.ndarray, targets: np.ndarray, distance: int, angle: int,
+                  tile_weights: np.ndarray, distance_weights: np.ndarray, popularity: np.ndarray,
+                  layers: np.ndarray) -> np.ndarray:
+        """
+            Best cells (n, 2) of many agents with the same distance and angle, the same cells as scan_at picks for
+            every agent, (-1, -1) for the agents seeing nothing. The windows of the agents are stacked and labelled
+            in one pass, cells outside the grid are never visible.
+
+            :param positions: (n, 2) coordinates of the agents
+            :param targets: (n, 2) coordinates of their targets
+            :param tile_weights: (n,) tile weights of the agents
+            :param distance_weights: (n,) distance weights of the agents
+            :param popularity: (layers, width, height) stack of GRASS_POPULARITY data
+            :param layers: (n,) layer of the popularity seen by every agent
+        """
+        d = distance
+        dx, dy, norms, in_radius, min_cos = vision_stencil(d, angle)
+        x, y = positions[:, 0, None, None], positions[:, 1, None, None]
+        tx, ty = targets[:, 0, None, None] - x, targets[:, 1, None, None] - y
+
+        gx, gy = x + dx, y + dy
+        inside = (gx >= 0) & (gx < self.width) & (gy >= 0) & (gy < self.height)
+        gx, gy = np.clip(gx, 0, self.width - 1), np.clip(gy, 0, self.height - 1)
+
+        target_norm = np.sqrt((tx * tx + ty * ty).astype(float))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            in_angle = (dx * tx + dy * ty) / (norms * target_norm) >= min_cos
+
+        mask = inside & in_radius & in_angle & self.terrain.free[gx, gy]
+        labels, _ = label(mask, structure=_PLANE_CONNECTIVITY)
+        seen = labels[:, max(d - 1, 0): d + 2, max(d - 1, 0): d + 2]
+        visible = np.isin(labels, seen[seen > 0])
+
+        if self.fields is None:
+            to_target = np.sqrt(((tx - dx) ** 2 + (ty - dy) ** 2).astype(float))
+            target_distance = target_norm
+        else:
+            to_target = self._distances(targets[:, 0, None, None], targets[:, 1, None, None], gx, gy)
+            target_distance = self._distances(targets[:, 0], targets[:, 1], positions[:, 0], positions[:, 1])[:, None, None]
+        tile_values = self.terrain.class_values(self.terrain.tile_class[gx, gy], popularity[layers[:, None, None], gx, gy])
+        tile_val = tile_weights[:, None, None] * tile_values
+        distance_val = (norms + to_target - target_distance) * distance_weights[:, None, None]
+        affordances = np.where(visible, np.maximum(tile_val - distance_val, 0), -np.inf).reshape(len(positions), -1)
+
+        top = affordances.max(axis=1)
+        is_best = affordances == top[:, None]
+        best = np.full((len(positions), 2), -1, dtype=np.int64)
+        for i in np.flatnonzero(np.isfinite(top)):
+            cells = np.flatnonzero(is_best[i])
+            if len(cells) > 1:
+                visible_cells = np.flatnonzero(visible[i])
+                cells = visible_cells[[self._first_visited(visible[i], is_best[i][visible_cells], d, d)]]
+            best[i] = gx[i].flat[cells[0]], gy[i].flat[cells[0]]
+        return best
+
+    def _distances(self, tx, ty, x, y) -> np.ndarray:
+        """Geodesic distances from the cells (x, y) to the targets (tx, ty), see distance_fields.distances_to"""
+        return distance_fields.distances_to(self.fields, self.fields_index, *map(np.atleast_1d, (tx, ty, x, y)))
+
+    @staticmethod
+    def _first_visited(visible: np.ndarray, is_best: np.ndarray, ax: int, ay: int) -> int:
+        """Walks the visible cells in the order of the recursive search and returns the index
+        (in the row-major order of visible cells) of the first best cell met"""
+        index = np.full(visible.shape, -1, dtype=np.int64)
+        index[visible] = np.arange(is_best.size)
+        w, h = visible.shape
+        visited = np.zeros(visible.shape, dtype=bool)
+
+        def children(cx: int, cy: int):
+            for ox, oy in NEIGHBOUR_OFFSETS:
+                nx, ny = cx + ox, cy + oy
+                if 0 <= nx < w and 0 <= ny < h:
+                    yield nx, ny
+
+        for sx, sy in children(ax, ay):
+            if not visible[sx, sy] or visited[sx, sy]:
+                continue
+            visited[sx, sy] = True
+            if is_best[index[sx, sy]]:
+                return int(index[sx, sy])
+            stack = [children(sx, sy)]
+            while stack:
+                for nx, ny in stack[-1]:
+                    if visible[nx, ny] and not visited[nx, ny]:
+                        visited[nx, ny] = True
+                        if is_best[index[nx, ny]]:
+                            return int(index[nx, ny])
+                        stack.append(children(nx, ny))
+                        break
+                else:
+                    stack.pop()
+
+        raise RuntimeError("Best cell is not reachable from the agent")